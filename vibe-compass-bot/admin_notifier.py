@@ -0,0 +1,266 @@
+"""
+Сводки о новых лидах для администраторов
+
+Уведомление на каждый лид во время рекламной кампании заваливает
+админов сообщениями и упирается в лимиты Telegram на один чат. Поэтому
+лиды копятся в очереди, а раз в ADMIN_NOTIFY_INTERVAL секунд каждому чату
+из ADMIN_NOTIFY_CHAT_IDS уходит одно сообщение: «12 новых лидов за
+последнюю минуту» и компактная таблица последних ADMIN_NOTIFY_MAX_ROWS
+лидов. Сообщения отправляет бот запущенного приложения (application.bot),
+со своим общим HTTP-клиентом. Если отправка в чат не удалась, его лиды
+войдут в следующую сводку.
+
+При BOT_WORKERS > 1 сводки шлет только фронт (sharding.py), иначе админы
+получали бы по сводке от каждого воркера. Воркер с ADMIN_NOTIFY_FORWARD_URL
+сразу пересылает лиды фронту POST-запросом; лиды, которые не удалось
+переслать, уходят со следующей пересылкой.
+"""
+import asyncio
+import hmac
+import html
+import logging
+import math
+import time
+from collections import Counter, deque
+
+import httpx
+
+from config import (
+    ADMIN_NOTIFY_CHAT_IDS,
+    ADMIN_NOTIFY_INTERVAL,
+    ADMIN_NOTIFY_MAX_ROWS,
+    ADMIN_NOTIFY_FORWARD_URL,
+    TELEGRAM_WEBHOOK_SECRET
+)
+from telegram_webhook import SECRET_HEADER
+from web_server import Response
+
+logger = logging.getLogger(__name__)
+
+# Путь на HTTP-сервере фронта, куда воркеры пересылают лиды
+ADMIN_NOTIFY_PATH = '/internal/admin-leads'
+
+# Короткие подписи для колонок таблицы
+PAIN_SHORT = {
+    'pain_messages': 'вопросы',
+    'pain_data': 'таблицы',
+    'pain_deadlines': 'дедлайны',
+    'pain_documents': 'документы',
+    'pain_copying': 'копирование'
+}
+
+TIME_SHORT = {
+    'time_low': '<5 ч',
+    'time_medium': '5-10 ч',
+    'time_high': '>10 ч'
+}
+
+
+def _plural(n, one, few, many):
+    """Форма слова для числа: 1 лид, 2 лида, 5 лидов"""
+    if n % 10 == 1 and n % 100 != 11:
+        return one
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return few
+    return many
+
+
+def _period_text(seconds):
+    minutes = max(1, math.ceil(seconds / 60))
+    if minutes == 1:
+        return "за последнюю минуту"
+    return f"за последние {minutes} мин"
+
+
+def format_lead_row(lead_info):
+    """Строка таблицы: имя, username, проблема, время"""
+    name = (lead_info.get('first_name') or '—')[:12]
+    username = lead_info.get('username')
+    username = f"@{username}"[:16] if username else '—'
+    pain = PAIN_SHORT.get(lead_info.get('pain_point'), '—')
+    spent = TIME_SHORT.get(lead_info.get('time_spent'), '—')
+    return f"{name:<12} {username:<16} {pain:<11} {spent}"
+
+
+def format_digest(rows, count, seconds):
+    """Текст сводки (HTML): заголовок и таблица последних лидов"""
+    title = f"🎯 {count} {_plural(count, 'новый лид', 'новых лида', 'новых лидов')} {_period_text(seconds)}"
+    table = "\n".join(html.escape(row) for row in rows)
+    text = f"<b>{title}</b>\n<pre>{table}</pre>"
+    if count > len(rows):
+        text += f"\n…и еще {count - len(rows)} ранее"
+    return text
+
+
+class AdminNotifier:
+    """Очередь уведомлений о лидах со сводками раз в интервал"""
+
+    def __init__(self, chat_ids=ADMIN_NOTIFY_CHAT_IDS, interval=ADMIN_NOTIFY_INTERVAL,
+                 max_rows=ADMIN_NOTIFY_MAX_ROWS, bot=None, forward_url=ADMIN_NOTIFY_FORWARD_URL,
+                 secret=TELEGRAM_WEBHOOK_SECRET):
+        self.chat_ids = list(chat_ids)
+        self.interval = interval
+        self.max_rows = max_rows
+        self.bot = bot
+        # Воркер пересылает лиды на forward_url фронта; secret подписывает пересылку у воркера
+        # и проверяет ее у фронта (у воркеров это секрет фронта из TELEGRAM_WEBHOOK_SECRET)
+        self.forward_url = forward_url
+        self.secret = secret
+        self._forward = []  # лиды, ждущие пересылки фронту
+        self._client = None
+
+        # У каждого чата своя очередь: неудачная отправка в один чат не задваивает сводку в других
+        self._rows = {chat_id: deque(maxlen=max_rows) for chat_id in self.chat_ids}
+        self._counts = Counter()
+        self._since = {}
+        self._task = None
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+
+        self.digests = 0
+        self.leads = 0
+        self.forwarded = 0
+        self.received = 0
+        self.failures = 0
+
+    def add(self, lead_info):
+        """Поставить лид в следующую сводку"""
+        if not self.chat_ids:
+            # Сводки отключены: пересылать и копить некому, иначе очередь росла бы без конца
+            return
+        if self.forward_url:
+            # Пересылка не ждет интервала: сводку по таймеру соберет фронт
+            self._forward.append(lead_info)
+            self._wakeup.set()
+            return
+        row = format_lead_row(lead_info)
+        now = time.monotonic()
+        for chat_id in self.chat_ids:
+            self._rows[chat_id].append(row)
+            self._counts[chat_id] += 1
+            self._since.setdefault(chat_id, now)
+
+    @property
+    def pending(self):
+        """Сколько лидов ждут сводки (по самому отстающему чату) или пересылки фронту"""
+        if self.forward_url:
+            return len(self._forward)
+        return max(self._counts.values(), default=0)
+
+    async def _forward_leads(self):
+        """Переслать накопленные лиды фронту; возвращает 1, если запрос прошел"""
+        if not self._forward:
+            return 0
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=10)
+        leads = list(self._forward)
+        try:
+            response = await self._client.post(self.forward_url, json=leads, headers={SECRET_HEADER: self.secret or ''})
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            self.failures += 1
+            logger.error(f"❌ Ошибка пересылки {len(leads)} лидов фронту для сводки: {e!r}")
+            return 0
+        # Лиды, добавленные за время запроса, уйдут следующей пересылкой
+        del self._forward[:len(leads)]
+        self.forwarded += len(leads)
+        return 1
+
+    async def handle(self, request):
+        """POST от воркера: поставить пересланные лиды в сводку фронта"""
+        if not self.secret or not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            return Response(403)
+        try:
+            leads = request.json()
+        except ValueError:
+            return Response(400)
+        if not isinstance(leads, list) or not all(isinstance(lead_info, dict) for lead_info in leads):
+            return Response(400)
+        for lead_info in leads:
+            self.add(lead_info)
+        self.received += len(leads)
+        return Response(200)
+
+    def register(self, server, secret, path=ADMIN_NOTIFY_PATH):
+        """Подключить прием лидов от воркеров к HTTP-серверу фронта"""
+        self.secret = secret
+        server.route('POST', path, self.handle)
+
+    async def flush(self):
+        """Отправить сводки во все чаты, где есть новые лиды; возвращает число сообщений"""
+        if self.forward_url:
+            return await self._forward_leads()
+        if self.bot is None:
+            return 0
+        sent = 0
+        for chat_id in self.chat_ids:
+            count = self._counts[chat_id]
+            if not count:
+                continue
+            rows = list(self._rows[chat_id])
+            text = format_digest(rows, count, time.monotonic() - self._since[chat_id])
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML')
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"❌ Ошибка отправки сводки о лидах в чат {chat_id}: {e}")
+                continue
+
+            # Пока шел запрос, могли прийти новые лиды — они остаются до следующей сводки
+            added = self._counts[chat_id] - count
+            for _ in range(len(self._rows[chat_id]) - min(added, self.max_rows)):
+                self._rows[chat_id].popleft()
+            self._counts[chat_id] = added
+            if added:
+                self._since[chat_id] = time.monotonic()
+            else:
+                del self._since[chat_id]
+            self.digests += 1
+            self.leads += count
+            sent += 1
+        return sent
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._stopping:
+                await self.flush()
+
+    async def start(self, bot):
+        """Запустить отправку сводок через бот приложения"""
+        self.bot = bot
+        if not self.chat_ids:
+            logger.info("ADMIN_NOTIFY_CHAT_IDS не задан, сводки о лидах отключены")
+            return
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Отправить последнюю сводку и остановиться (пока бот еще работает)"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+            await self.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'digests': self.digests,
+            'leads': self.leads,
+            'forwarded': self.forwarded,
+            'received': self.received,
+            'failures': self.failures
+        }
+
+
+admin_notifier = AdminNotifier()
@@ -0,0 +1,1084 @@
+"""
+Нагрузочные бенчмарки бота
+Запуск: python benchmark.py [имя_бенчмарка]
+
+Бенчмарки работают с временной SQLite базой и не трогают рабочую БД.
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+# Временная БД должна быть выставлена до импорта database.py
+BENCH_DB = os.path.join(tempfile.gettempdir(), 'vibe_compass_bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{BENCH_DB}'
+os.environ.pop('ASYNC_DATABASE_URL', None)
+
+CONCURRENT_USERS = 500
+# Имитация сетевого вызова Telegram API внутри обработчика
+TELEGRAM_LATENCY = 0.05
+
+QUIZ_ANSWERS = [
+    ('emotion', 'emotion_tired', 'question_2'),
+    ('pain_point', 'pain_messages', 'question_3'),
+    ('time_spent', 'time_high', 'show_insight')
+]
+
+
+def reset_database():
+    """Пересоздать временную базу данных"""
+    import database
+    database.engine.dispose()
+    remove_database_files()
+    database.init_db()
+
+
+def remove_database_files():
+    """Удалить файл временной БД вместе с журналами WAL"""
+    for path in (BENCH_DB, BENCH_DB + '-wal', BENCH_DB + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def print_result(name, updates, elapsed, max_stall=None):
+    """Вывести результат замера"""
+    line = f"   {name}: {updates} апдейтов за {elapsed:.2f} с — {updates / elapsed:.1f} апдейтов/с"
+    if max_stall is not None:
+        line += f", макс. блокировка event loop {max_stall * 1000:.0f} мс"
+    print(line)
+
+
+async def _measure_loop_stall(stop_event, interval=0.01):
+    """Максимальная задержка event loop: насколько позже срабатывает таймер"""
+    max_stall = 0.0
+    while not stop_event.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        max_stall = max(max_stall, time.perf_counter() - expected)
+    return max_stall
+
+
+# ==================== БЛОКИРУЮЩИЙ vs АСИНХРОННЫЙ СЛОЙ БД ====================
+
+async def _sync_user_session(user_id):
+    """Пользователь проходит тест, обработчик вызывает блокирующие функции БД"""
+    import database
+    database.get_or_create_user(user_id, first_name=f'user{user_id}')
+    await asyncio.sleep(TELEGRAM_LATENCY)
+    for field, value, step in QUIZ_ANSWERS:
+        database.save_answer(user_id, field, value)
+        database.update_user_step(user_id, step)
+        await asyncio.sleep(TELEGRAM_LATENCY)
+
+
+async def _async_user_session(user_id):
+    """Пользователь проходит тест, обработчик ждет асинхронные функции БД"""
+    import database_async
+    await database_async.get_or_create_user(user_id, first_name=f'user{user_id}')
+    await asyncio.sleep(TELEGRAM_LATENCY)
+    for field, value, step in QUIZ_ANSWERS:
+        await database_async.save_answer(user_id, field, value)
+        await database_async.update_user_step(user_id, step)
+        await asyncio.sleep(TELEGRAM_LATENCY)
+
+
+async def _run_sessions(session_func, users):
+    stop_event = asyncio.Event()
+    monitor = asyncio.create_task(_measure_loop_stall(stop_event))
+    started = time.perf_counter()
+    await asyncio.gather(*(session_func(100000 + i) for i in range(users)))
+    elapsed = time.perf_counter() - started
+    stop_event.set()
+    return elapsed, await monitor
+
+
+def benchmark_db(users=CONCURRENT_USERS):
+    """Пропускная способность обработчиков: блокирующая БД против asyncio"""
+    print(f"\n=== БЕНЧМАРК СЛОЯ БД ({users} одновременных пользователей) ===")
+    updates = users * (len(QUIZ_ANSWERS) + 1)
+
+    reset_database()
+    elapsed, stall = asyncio.run(_run_sessions(_sync_user_session, users))
+    print_result("до (блокирующие вызовы)", updates, elapsed, stall)
+
+    reset_database()
+
+    async def run_async():
+        import database_async
+        try:
+            return await _run_sessions(_async_user_session, users)
+        finally:
+            await database_async.close_db()
+
+    elapsed, stall = asyncio.run(run_async())
+    print_result("после (asyncio)", updates, elapsed, stall)
+    print("   Главное — задержка event loop: пока идет запись, бот отвечает остальным.")
+    print("   Апдейтов/с на SQLite меньше: каждый вызов идет через поток aiosqlite,")
+    print("   а писатель все равно один. Горячий путь — пачки буфера (benchmark.py buffer).")
+
+
+# ==================== БУФЕР ОТЛОЖЕННОЙ ЗАПИСИ ====================
+
+def benchmark_buffer(users=CONCURRENT_USERS):
+    """Клики в секунду: запись на каждый клик против буфера с пачками"""
+    print(f"\n=== БЕНЧМАРК БУФЕРА ЗАПИСИ ({users} одновременных пользователей) ===")
+    import database_async
+    from write_buffer import WriteBehindBuffer
+
+    clicks = users * len(QUIZ_ANSWERS)
+
+    async def _clicks(user_id, buffer):
+        for field, value, step in QUIZ_ANSWERS:
+            if buffer is None:
+                await database_async.save_answer(user_id, field, value)
+                await database_async.update_user_step(user_id, step)
+            else:
+                buffer.save_answer(user_id, field, value)
+                buffer.update_user_step(user_id, step)
+            await asyncio.sleep(TELEGRAM_LATENCY)
+
+    async def run(buffered):
+        user_ids = [200000 + i for i in range(users)]
+        # Пользователи создаются заранее, замеряются только клики
+        await asyncio.gather(*(database_async.get_or_create_user(uid) for uid in user_ids))
+        started = time.perf_counter()
+        try:
+            if buffered:
+                buffer = WriteBehindBuffer()
+                await buffer.start()
+                await asyncio.gather(*(_clicks(uid, buffer) for uid in user_ids))
+                await buffer.stop()
+            else:
+                await asyncio.gather(*(_clicks(uid, None) for uid in user_ids))
+            return time.perf_counter() - started
+        finally:
+            await database_async.close_db()
+
+    reset_database()
+    elapsed = asyncio.run(run(buffered=False))
+    print_result("до (транзакция на каждый клик)", clicks, elapsed)
+
+    reset_database()
+    elapsed = asyncio.run(run(buffered=True))
+    print_result("после (пачки через буфер)", clicks, elapsed)
+
+
+# ==================== СТАТИСТИКА: СКАН vs СЧЕТЧИКИ ====================
+
+def _fill_users(count):
+    """Быстро залить count пользователей со случайными ответами"""
+    import random
+    import database
+
+    choices = {
+        'current_step': ['question_1', 'question_2', 'question_3', 'show_insight'],
+        'emotion': ['emotion_tired', 'emotion_annoyed', 'emotion_confused'],
+        'pain_point': ['pain_messages', 'pain_data', 'pain_deadlines', 'pain_documents', 'pain_copying'],
+        'time_spent': ['time_low', 'time_medium', 'time_high'],
+        'conversion_status': ['pending', 'converted', 'pdf_downloaded', 'postponed']
+    }
+    session = database.SessionLocal()
+    try:
+        database._ensure_codes(session, [key for keys in choices.values() for key in keys])
+    finally:
+        session.close()
+
+    rows = [
+        {
+            'user_id': 300000 + i,
+            'first_name': f'user{i}',
+            'is_completed': random.random() > 0.3,
+            **database._encode_values('users', {
+                column: random.choice(keys) for column, keys in choices.items()
+            })
+        }
+        for i in range(count)
+    ]
+    with database.engine.begin() as connection:
+        connection.execute(database.User.__table__.insert(), rows)
+    database.rebuild_funnel_counters()
+
+
+def _time_call(func, repeats=5):
+    """Среднее время вызова в миллисекундах"""
+    started = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - started) / repeats * 1000
+
+
+def benchmark_stats(sizes=(10_000, 100_000, 500_000)):
+    """Задержка /stats: полный скан users против таблицы счетчиков"""
+    print("\n=== БЕНЧМАРК СТАТИСТИКИ ===")
+    import database
+
+    for size in sizes:
+        reset_database()
+        _fill_users(size)
+
+        def scan():
+            session = database.SessionLocal()
+            try:
+                database._scan_counters(session)
+            finally:
+                session.close()
+
+        print(f"   {size} пользователей: скан users {_time_call(scan):.1f} мс, "
+              f"счетчики {_time_call(database.get_statistics):.2f} мс")
+
+
+# ==================== КОНКУРЕНЦИЯ ЧИТАТЕЛЕЙ И ПИСАТЕЛЕЙ ====================
+
+def _contention_run(profile, writers, readers, duration):
+    """Писатели сохраняют ответы, читатели читают пользователей из разных потоков"""
+    import random
+    import threading
+    from sqlalchemy.orm import sessionmaker
+    import database
+
+    remove_database_files()
+    engine = database.create_db_engine(os.environ['DATABASE_URL'], profile)
+    database.Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+    user_ids = [400000 + i for i in range(200)]
+    session = Session()
+    try:
+        for user_id in user_ids:
+            database._get_or_create_user(session, user_id, first_name=f'user{user_id}')
+    finally:
+        session.close()
+
+    counts = {'write': 0, 'read': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(kind):
+        while time.perf_counter() < deadline:
+            session = Session()
+            try:
+                user_id = random.choice(user_ids)
+                if kind == 'write':
+                    database._save_answer(session, user_id, 'pain_point', random.choice(['pain_data', 'pain_copying']))
+                else:
+                    database._get_user_data(session, user_id)
+                with lock:
+                    counts[kind] += 1
+            except Exception:
+                session.rollback()
+                with lock:
+                    counts['errors'] += 1
+            finally:
+                session.close()
+
+    threads = [threading.Thread(target=worker, args=('write',)) for _ in range(writers)]
+    threads += [threading.Thread(target=worker, args=('read',)) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+
+    print(f"   {profile}: записи {counts['write'] / duration:.0f}/с, "
+          f"чтения {counts['read'] / duration:.0f}/с, ошибки {counts['errors']}")
+
+
+def benchmark_contention(writers=4, readers=8, duration=5):
+    """Конкурентные читатели и писатели: профиль default против production"""
+    print(f"\n=== БЕНЧМАРК КОНКУРЕНЦИИ SQLite ({writers} писателей, {readers} читателей, {duration} с) ===")
+    for profile in ('default', 'production'):
+        _contention_run(profile, writers, readers, duration)
+
+
+# ==================== СНИМКИ vs ORM-ОБЪЕКТЫ ====================
+
+def benchmark_snapshot(users=20_000):
+    """Память и скорость чтения: ORM-объекты User против UserSnapshot"""
+    print(f"\n=== БЕНЧМАРК СНИМКОВ ПОЛЬЗОВАТЕЛЕЙ ({users} шт.) ===")
+    import tracemalloc
+    import database
+
+    reset_database()
+    _fill_users(users)
+    user_ids = [300000 + i for i in range(users)]
+
+    def load_orm(session, user_id):
+        return session.query(database.User).filter_by(user_id=user_id).first()
+
+    for name, loader in (('ORM User', load_orm), ('UserSnapshot', database._load_snapshot)):
+        session = database.SessionLocal()
+        try:
+            tracemalloc.start()
+            started = time.perf_counter()
+            loaded = []
+            for user_id in user_ids:
+                loaded.append(loader(session, user_id))
+                # Как в кэше: объекты живут после закрытия сессии
+                session.expunge_all()
+            elapsed = time.perf_counter() - started
+            memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            session.close()
+        print(f"   {name}: {memory / users:.0f} байт на пользователя, "
+              f"{elapsed / users * 1_000_000:.0f} мкс на чтение")
+
+
+# ==================== ОТЛОЖЕННЫЕ СООБЩЕНИЯ В ОБРАБОТЧИКАХ ====================
+
+class _FakeMessage:
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+
+    async def reply_text(self, *args, **kwargs):
+        await asyncio.sleep(TELEGRAM_LATENCY)
+
+
+class _FakeQuery:
+    def __init__(self, user_id, data):
+        self.from_user = type('FakeUser', (), {'id': user_id, 'first_name': 'bench', 'username': None})()
+        self.data = data
+        self.message = _FakeMessage(user_id)
+
+    async def answer(self, *args, **kwargs):
+        await asyncio.sleep(TELEGRAM_LATENCY)
+
+    async def edit_message_text(self, *args, **kwargs):
+        await asyncio.sleep(TELEGRAM_LATENCY)
+
+
+class _FakeJobQueue:
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, **kwargs):
+        self.jobs.append((callback, when, kwargs))
+
+
+class _FakeContext:
+    def __init__(self, job_queue):
+        self.job_queue = job_queue
+        self.user_data = {}
+
+
+async def _legacy_emotion_callback(update, context):
+    """Поведение до переноса в JobQueue: ответ + пауза внутри обработчика"""
+    import handlers
+    state = await handlers.emotion_callback(update, context)
+    await asyncio.sleep(1.5)
+    await update.callback_query.message.reply_text('question_2')
+    return state
+
+
+def benchmark_followup(users=100, legacy_users=10):
+    """Последовательная обработка апдейтов: пауза в обработчике против таймера"""
+    print("\n=== БЕНЧМАРК ОТЛОЖЕННЫХ СООБЩЕНИЙ (последовательная обработка) ===")
+    import handlers
+
+    async def run(handler, count):
+        job_queue = _FakeJobQueue()
+        started = time.perf_counter()
+        # Так обрабатывает апдейты Application по умолчанию: по одному
+        for i in range(count):
+            update = type('FakeUpdate', (), {'callback_query': _FakeQuery(500000 + i, 'emotion_tired')})()
+            await handler(update, _FakeContext(job_queue))
+        return time.perf_counter() - started
+
+    elapsed = asyncio.run(run(_legacy_emotion_callback, legacy_users))
+    print_result(f"до (asyncio.sleep в обработчике, {legacy_users} польз.)", legacy_users, elapsed)
+
+    elapsed = asyncio.run(run(handlers.emotion_callback, users))
+    print_result(f"после (JobQueue, {users} польз.)", users, elapsed)
+
+
+# ==================== БЛОКИРУЮЩИЕ ВЫЗОВЫ CRM ====================
+
+def _slow_crm_call(lead_info, latency=0.2):
+    """Имитация requests.post в AmoCRM"""
+    time.sleep(latency)
+    return {'success': True}
+
+
+def benchmark_pool(leads=40):
+    """Отправка лидов в CRM: прямой вызов в обработчике против пула потоков"""
+    print("\n=== БЕНЧМАРК ПУЛА БЛОКИРУЮЩИХ ВЫЗОВОВ ===")
+    from blocking_pool import BlockingPool
+
+    async def direct(lead_id):
+        _slow_crm_call({'user_id': lead_id})
+
+    async def run(send, count):
+        stop_event = asyncio.Event()
+        monitor = asyncio.create_task(_measure_loop_stall(stop_event))
+        started = time.perf_counter()
+        await asyncio.gather(*(send(i) for i in range(count)))
+        elapsed = time.perf_counter() - started
+        stop_event.set()
+        return elapsed, await monitor
+
+    elapsed, stall = asyncio.run(run(direct, leads // 4))
+    print_result(f"прямой вызов ({leads // 4} лидов)", leads // 4, elapsed, stall)
+
+    pool = BlockingPool(max_workers=8, max_queue=100)
+
+    async def pooled(lead_id):
+        await pool.run(_slow_crm_call, {'user_id': lead_id})
+
+    elapsed, stall = asyncio.run(run(pooled, leads))
+    pool.shutdown()
+    print_result(f"пул из {pool.max_workers} потоков ({leads} лидов)", leads, elapsed, stall)
+    stats = pool.stats()
+    print(f"   ожидание в очереди: среднее {stats['avg_wait_ms']:.0f} мс, макс. {stats['max_wait_ms']:.0f} мс; "
+          f"выполнение: среднее {stats['avg_run_ms']:.0f} мс")
+
+
+# ==================== HTTP-КЛИЕНТ CRM ====================
+
+def _self_signed_context():
+    """
+    Самоподписанный сертификат для 127.0.0.1 через openssl
+
+    Возвращает (серверный, клиентский) SSLContext или (None, None), если openssl нет.
+    """
+    import shutil
+    import ssl
+    import subprocess
+
+    if not shutil.which('openssl'):
+        return None, None
+    cert_dir = tempfile.mkdtemp(prefix='vibe_compass_tls_')
+    cert, key = os.path.join(cert_dir, 'cert.pem'), os.path.join(cert_dir, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+         '-keyout', key, '-out', cert],
+        check=True, capture_output=True
+    )
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(cert, key)
+    client_context = ssl.create_default_context(cafile=cert)
+    return server_context, client_context
+
+
+def start_stub_amocrm(handle_leads=None, ssl_context=None):
+    """
+    Локальный тестовый сервер AmoCRM в отдельном потоке
+
+    handle_leads(handler, leads) -> (status, body) позволяет подменить ответ;
+    по умолчанию каждый лид получает id. Возвращает (server, base_url).
+    """
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            # Список дополнительных полей: пусто, поля передаются по названию
+            self.send_response(204)
+            self.end_headers()
+
+        def do_POST(self):
+            leads = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if handle_leads:
+                status, body = handle_leads(self, leads)
+            else:
+                status, body = 200, {'_embedded': {'leads': [
+                    {'id': 1000 + i, 'request_id': lead.get('request_id', str(i))} for i, lead in enumerate(leads)
+                ]}}
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            try:
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # клиент (например, убитый воркер) уже закрыл соединение
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    scheme = 'http'
+    if ssl_context is not None:
+        server.socket = ssl_context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{scheme}://127.0.0.1:{server.server_address[1]}"
+
+
+def benchmark_crm_http(leads=300):
+    """Отправка лидов: новое соединение на каждый лид против общего клиента"""
+    print("\n=== БЕНЧМАРК HTTP-КЛИЕНТА CRM (локальный сервер AmoCRM) ===")
+    import httpx
+    import crm_integration
+
+    # Как у настоящей AmoCRM — по HTTPS, если есть openssl для сертификата
+    server_context, client_context = _self_signed_context()
+    server, base_url = start_stub_amocrm(ssl_context=server_context)
+    verify = client_context or True
+    print(f"   сервер: {base_url}")
+    lead_info = {'user_id': 1, 'first_name': 'Бенч', 'pain_point': 'pain_data'}
+    try:
+        # Как было (requests.post): новое соединение и рукопожатие на каждый лид
+        started = time.perf_counter()
+        for _ in range(leads):
+            httpx.post(f"{base_url}/api/v4/leads", json=[crm_integration.build_amocrm_lead(lead_info)],
+                       timeout=10, verify=verify)
+        elapsed = time.perf_counter() - started
+        print(f"   соединение на лид: {elapsed / leads * 1000:.2f} мс на лид")
+
+        async def pooled():
+            client = crm_integration.create_http_client(base_url=base_url, verify=verify)
+            try:
+                started = time.perf_counter()
+                for _ in range(leads):
+                    await crm_integration.send_to_amocrm(lead_info, client)
+                return time.perf_counter() - started
+            finally:
+                await client.aclose()
+
+        elapsed = asyncio.run(pooled())
+        print(f"   общий клиент, keep-alive: {elapsed / leads * 1000:.2f} мс на лид")
+    finally:
+        server.shutdown()
+
+
+def benchmark_crm_batch(leads=500):
+    """Всплеск лидов: запрос на каждый лид против пачек AmoCrmBatcher"""
+    print("\n=== БЕНЧМАРК ПАЧЕК ЛИДОВ AMOCRM ===")
+    import httpx
+    import crm_integration
+
+    reset_database()  # контакты пользователей читаются из crm_contacts
+    api_calls = []
+
+    def count_calls(handler, items):
+        api_calls.append(len(items))
+        return 200, {'_embedded': {'leads': [
+            {'id': 1000 + i, 'request_id': item['request_id']} for i, item in enumerate(items)
+        ]}}
+
+    server, base_url = start_stub_amocrm(count_calls)
+
+    async def run(send):
+        client = crm_integration.create_http_client(base_url=base_url)
+        # Запросы на каждый лид стоят в очереди пула соединений дольше обычного таймаута
+        client.timeout = httpx.Timeout(60)
+        try:
+            started = time.perf_counter()
+            results = await asyncio.gather(*(send({'user_id': i, 'first_name': f'Лид {i}'}, client) for i in range(leads)))
+            assert all(result['success'] for result in results)
+            return time.perf_counter() - started
+        finally:
+            await client.aclose()
+
+    async def batched(lead_info, client):
+        if batched.batcher is None:
+            batched.batcher = crm_integration.AmoCrmBatcher(client=client)
+        return await batched.batcher.submit(lead_info)
+    batched.batcher = None
+
+    try:
+        for name, send in (('запрос на лид', crm_integration.send_to_amocrm), ('пачки', batched)):
+            api_calls.clear()
+            elapsed = asyncio.run(run(send))
+            print(f"   {name}: {leads} лидов за {elapsed:.2f} с, запросов к API: {len(api_calls)}")
+    finally:
+        server.shutdown()
+
+
+# ==================== ВЕБХУКИ CRM ====================
+
+def benchmark_crm_webhook(events=5000, per_delivery=10, senders=8):
+    """Смены статусов из AmoCRM: транзакция на событие против буфера вебхуков"""
+    print(f"\n=== БЕНЧМАРК ВЕБХУКОВ CRM ({events} событий) ===")
+    import httpx
+    import database
+    import database_async
+    from crm_webhook import CrmWebhookReceiver, parse_amocrm_status_events
+    from web_server import WebServer
+
+    reset_database()
+    _fill_users(events)
+    session = database.SessionLocal()
+    try:
+        database._save_crm_contacts(session, 'amocrm', [(300000 + i, 100000 + i, 500000 + i) for i in range(events)])
+    finally:
+        session.close()
+
+    def delivery(start, account):
+        """Тело вебхука AmoCRM с per_delivery сменами статуса"""
+        form = {'account[id]': str(account)}
+        for i in range(per_delivery):
+            lead_id = 500000 + (start + i) % events
+            form.update({
+                f'leads[status][{i}][id]': str(lead_id),
+                f'leads[status][{i}][old_status_id]': '1',
+                f'leads[status][{i}][status_id]': str(142 + (start + i) % 2)
+            })
+        return form
+
+    async def one_by_one():
+        started = time.perf_counter()
+        for start in range(0, events, per_delivery):
+            for event in parse_amocrm_status_events(delivery(start, account=1)):
+                await database_async.apply_crm_status_events('amocrm', [(event[0], event[1], 'crm_won')])
+        return time.perf_counter() - started
+
+    async def buffered():
+        receiver = CrmWebhookReceiver(secret='bench', flush_interval=0.2)
+        server = WebServer(host='127.0.0.1', port=0, max_connections=senders * 2)
+        receiver.register(server, '/amocrm/webhook')
+        await server.start()
+        await receiver.start()
+        url = f"http://127.0.0.1:{server.port}/amocrm/webhook"
+        latencies = []
+        try:
+            started = time.perf_counter()
+            async with httpx.AsyncClient() as client:
+                async def sender(offset):
+                    for start in range(offset * per_delivery, events, senders * per_delivery):
+                        sent = time.perf_counter()
+                        response = await client.post(url, params={'secret': 'bench'}, data=delivery(start, account=2))
+                        assert response.status_code == 200
+                        latencies.append(time.perf_counter() - sent)
+                await asyncio.gather(*(sender(offset) for offset in range(senders)))
+            acked = time.perf_counter() - started
+            await receiver.stop()
+            return acked, time.perf_counter() - started, latencies, receiver.stats()
+        finally:
+            await server.stop()
+
+    elapsed = asyncio.run(one_by_one())
+    print(f"   транзакция на событие: {events / elapsed:.0f} событий/с")
+    acked, elapsed, latencies, stats = asyncio.run(buffered())
+    latencies.sort()
+    print(f"   буфер через HTTP ({senders} отправителей): {events / elapsed:.0f} событий/с, "
+          f"ответ вебхуку {sum(latencies) / len(latencies) * 1000:.1f} мс (p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} мс), "
+          f"применено {stats['applied']}")
+
+
+# ==================== ВЕБХУК TELEGRAM ====================
+
+BENCH_BOT_TOKEN = '123456:BENCHMARK'
+
+
+def start_stub_bot_api(latency=0.0, replies=None):
+    """
+    Локальная имитация Bot API: getMe, setWebhook и sendMessage с задержкой latency
+
+    Если передан список replies, в него пишутся (chat_id, text) отправленных сообщений.
+    Возвращает (server, base_url) для Application.builder().base_url(...)
+    """
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qsl
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            # PTB отправляет параметры формой, другие клиенты — JSON
+            if 'json' in self.headers.get('Content-Type', ''):
+                params = json.loads(body or b'{}')
+            else:
+                params = dict(parse_qsl(body.decode()))
+            method = self.path.rsplit('/', 1)[-1]
+            if method == 'getMe':
+                result = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+            elif method == 'sendMessage':
+                time.sleep(latency)
+                if replies is not None:
+                    replies.append((int(params.get('chat_id', 0)), params.get('text', '')))
+                result = {'message_id': 1, 'date': 0, 'text': params.get('text', ''),
+                          'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}}
+            else:
+                result = True
+            data = json.dumps({'ok': True, 'result': result}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            try:
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # клиент (например, убитый воркер) уже закрыл соединение
+
+        do_GET = do_POST
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/bot"
+
+
+def synthetic_update(update_id, user_id):
+    """Апдейт с текстовым сообщением пользователя user_id"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': 'ping',
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+        }
+    }
+
+
+def post_updates(port, path, update_ids, users, secret, user_base=500000):
+    """
+    Отправить синтетические апдейты POST-запросами по одному keep-alive соединению
+
+    Как и Telegram, при ответе не 200 повторяет доставку. Возвращает время
+    ответа на каждый запрос (с) вместе с повторами
+    """
+    import http.client
+    import json
+
+    latencies = []
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret}
+    try:
+        for update_id in update_ids:
+            body = json.dumps(synthetic_update(update_id, user_base + update_id % users)).encode()
+            while True:
+                sent = time.perf_counter()
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status == 200:
+                    break
+                time.sleep(0.05)
+            latencies.append(time.perf_counter() - sent)
+    finally:
+        connection.close()
+    return latencies
+
+
+def benchmark_webhook(updates=1000, users=100, senders=10):
+    """Прием апдейтов через вебхук: подтверждение Telegram и обработка до ответа пользователю"""
+    print(f"\n=== БЕНЧМАРК ВЕБХУКА TELEGRAM ({updates} апдейтов, {senders} соединений) ===")
+    from telegram.ext import Application, MessageHandler, filters
+    from telegram_webhook import TelegramWebhook
+    from update_processor import PerUserUpdateProcessor
+    from web_server import WebServer
+
+    api_server, base_url = start_stub_bot_api(latency=TELEGRAM_LATENCY)
+
+    async def run():
+        done = asyncio.Event()
+        processed = []
+
+        async def echo(update, context):
+            await update.message.reply_text('pong')
+            processed.append(time.perf_counter())
+            if len(processed) == updates:
+                done.set()
+
+        application = (
+            Application.builder()
+            .token(BENCH_BOT_TOKEN)
+            .base_url(base_url)
+            .concurrent_updates(PerUserUpdateProcessor(256))
+            .build()
+        )
+        application.add_handler(MessageHandler(filters.TEXT, echo))
+        server = WebServer(host='127.0.0.1', port=0, max_connections=senders * 2)
+        webhook = TelegramWebhook(application, secret='bench')
+        webhook.register(server, '/telegram')
+
+        await application.initialize()
+        await application.start()
+        await server.start()
+        try:
+            # Отправители работают в своих потоках, как внешний клиент, а не в цикле событий бота
+            started = time.perf_counter()
+            chunks = await asyncio.gather(*(
+                asyncio.to_thread(post_updates, server.port, '/telegram', range(offset, updates, senders), users, 'bench')
+                for offset in range(senders)
+            ))
+            acked = time.perf_counter() - started
+            acks = sorted(latency for chunk in chunks for latency in chunk)
+            await asyncio.wait_for(done.wait(), timeout=120)
+            elapsed = time.perf_counter() - started
+        finally:
+            await server.stop()
+            await application.stop()
+            await application.shutdown()
+        return acked, elapsed, acks
+
+    try:
+        acked, elapsed, acks = asyncio.run(run())
+    finally:
+        api_server.shutdown()
+    print(f"   подтверждено {updates} апдейтов за {acked:.2f} с ({updates / acked:.0f}/с), "
+          f"ответ Telegram {acks[len(acks) // 2] * 1000:.1f} мс (p99 {acks[int(len(acks) * 0.99)] * 1000:.1f} мс)")
+    print_result(f"обработано с ответом через Bot API ({TELEGRAM_LATENCY * 1000:.0f} мс)", updates, elapsed)
+
+
+def run_shard_worker():
+    """
+    Процесс-воркер для benchmark_sharding: эхо-бот за фронтом
+
+    Порт и секрет приходят из окружения WorkerSupervisor, адрес имитации Bot API — из BENCH_BOT_API.
+    Отвечает пользователю именем воркера, чтобы было видно, кто обработал апдейт
+    """
+    import signal
+    from telegram.ext import Application, MessageHandler, filters
+    from config import BOT_WORKER_ID, WEB_SERVER_PORT, TELEGRAM_WEBHOOK_SECRET
+    from telegram_webhook import TelegramWebhook
+    from update_processor import PerUserUpdateProcessor
+    from web_server import WebServer
+
+    async def echo(update, context):
+        await update.message.reply_text(f'worker-{BOT_WORKER_ID}')
+
+    async def run():
+        stopping = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+        application = (
+            Application.builder()
+            .token(BENCH_BOT_TOKEN)
+            .base_url(os.environ['BENCH_BOT_API'])
+            .concurrent_updates(PerUserUpdateProcessor(256))
+            .build()
+        )
+        application.add_handler(MessageHandler(filters.TEXT, echo))
+        server = WebServer(host='127.0.0.1', port=WEB_SERVER_PORT)
+        TelegramWebhook(application, secret=TELEGRAM_WEBHOOK_SECRET).register(server, '/telegram')
+        await application.initialize()
+        await application.start()
+        await server.start()
+        try:
+            await stopping.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            await application.shutdown()
+
+    asyncio.run(run())
+
+
+def benchmark_sharding(updates=2000, users=200, senders=10, worker_counts=(1, 2, 4)):
+    """
+    Фронт и N процессов-воркеров на одной машине: пропускная способность
+    и перераспределение пользователей, когда воркер падает посреди нагрузки
+    """
+    print(f"\n=== БЕНЧМАРК ВОРКЕРОВ ЗА ФРОНТОМ ({updates} апдейтов, {users} пользователей, "
+          f"{senders} соединений, {os.cpu_count()} CPU) ===")
+    from collections import defaultdict
+    from sharding import ShardDispatcher, WorkerSupervisor
+    from web_server import WebServer
+
+    user_base = 500000
+    replies = []
+    api_server, base_url = start_stub_bot_api(latency=TELEGRAM_LATENCY, replies=replies)
+    command = [sys.executable, '-c', 'import benchmark; benchmark.run_shard_worker()']
+
+    async def run(count, kill):
+        replies.clear()
+        dispatcher = ShardDispatcher(secret='bench', health_interval=0.2, timeout=5)
+        supervisor = WorkerSupervisor(dispatcher, count=count, base_port=19100 + count * 10, command=command,
+                                      env={'BENCH_BOT_API': base_url}, restart_delay=0.5)
+        front = WebServer(host='127.0.0.1', port=0, max_connections=senders * 2)
+        dispatcher.register(front, '/telegram')
+        await supervisor.start()
+        await dispatcher.start()
+        await front.start()
+        try:
+            deadline = time.perf_counter() + 120
+            while len(dispatcher.ring) < count and time.perf_counter() < deadline:
+                await asyncio.sleep(0.1)
+
+            async def kill_first_worker():
+                while sum(dispatcher.forwarded.values()) < updates // 2:
+                    await asyncio.sleep(0.01)
+                supervisor.processes['worker-0'].kill()
+                return sum(dispatcher.forwarded.values())
+
+            killer = asyncio.create_task(kill_first_worker()) if kill else None
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                asyncio.to_thread(post_updates, front.port, '/telegram', range(offset, updates, senders),
+                                  users, 'bench', user_base)
+                for offset in range(senders)
+            ))
+            # Ждем, пока ответы перестанут приходить
+            seen = -1
+            while len(replies) != seen and len(replies) < updates:
+                seen = len(replies)
+                await asyncio.sleep(0.5)
+            elapsed = time.perf_counter() - started
+            killed_at = await killer if killer else None
+            restored = False
+            if kill:
+                deadline = time.perf_counter() + 60
+                while 'worker-0' not in dispatcher.ring and time.perf_counter() < deadline:
+                    await asyncio.sleep(0.1)
+                restored = 'worker-0' in dispatcher.ring
+            return elapsed, list(replies), dispatcher.stats(), supervisor.stats(), killed_at, restored
+        finally:
+            await front.stop()
+            await dispatcher.stop()
+            await supervisor.stop()
+
+    try:
+        for count in worker_counts:
+            kill = count == max(worker_counts) and count > 1
+            elapsed, done, stats, supervised, killed_at, restored = asyncio.run(run(count, kill))
+            workers_by_user = defaultdict(set)
+            for chat_id, text in done:
+                workers_by_user[chat_id].add(text)
+            moved = [names for names in workers_by_user.values() if len(names) > 1]
+            print_result(f"{count} воркер(а)", len(done), elapsed)
+            print(f"      по воркерам: {', '.join(f'{name} {n}' for name, n in sorted(stats['forwarded'].items()))}; "
+                  f"сменили воркер {len(moved)} из {len(workers_by_user)} пользователей"
+                  f"{' (все — пользователи worker-0)' if moved and all('worker-0' in names for names in moved) else ''}")
+            if kill:
+                print(f"      worker-0 убит после {killed_at} апдейтов: переадресовано {stats['rerouted']}, "
+                      f"отклонено с 503 и повторено {stats['failures'] + stats['rejected']}, "
+                      f"потеряно в очереди убитого процесса {updates - len(done)}, "
+                      f"перезапусков {supervised['restarts']}, вернулся в кольцо: {'да' if restored else 'нет'}")
+    finally:
+        api_server.shutdown()
+
+
+def benchmark_persistence(conversations=100_000, changed=1000):
+    """
+    Persistence диалогов: запись изменений пачкой против перезаписи всего
+    pickle-файла и время восстановления незавершенных диалогов при запуске
+    """
+    print(f"\n=== БЕНЧМАРК PERSISTENCE ДИАЛОГОВ ({conversations} незавершенных) ===")
+    from telegram.ext import Application, CommandHandler, ConversationHandler, PicklePersistence
+    import database_async
+    from db_persistence import DatabasePersistence
+
+    reset_database()
+    keys = [(700000 + i, 700000 + i) for i in range(conversations)]
+    api_server, base_url = start_stub_bot_api()
+
+    async def stage(persistence, items):
+        """Передать изменения так же, как Application.update_persistence: пачкой через gather"""
+        await asyncio.gather(*(
+            coroutine
+            for key, state in items
+            for coroutine in (
+                persistence.update_conversation('main_conversation', key, state),
+                persistence.update_user_data(key[1], {'pain_point': 'pain_data'})
+            )
+        ))
+
+    async def write_changes():
+        persistence = DatabasePersistence()
+        started = time.perf_counter()
+        await stage(persistence, [(key, 2) for key in keys])
+        await persistence.flush()
+        initial = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await stage(persistence, [(key, 3) for key in keys[:changed]])
+        await persistence.flush()
+        incremental = time.perf_counter() - started
+        await database_async.close_db()
+        return initial, incremental
+
+    async def restore():
+        async def noop(update, context):
+            return ConversationHandler.END
+
+        application = (
+            Application.builder()
+            .token(BENCH_BOT_TOKEN)
+            .base_url(base_url)
+            .persistence(DatabasePersistence())
+            .build()
+        )
+        handler = ConversationHandler(
+            entry_points=[CommandHandler('start', noop)],
+            states={state: [CommandHandler('start', noop)] for state in range(6)},
+            fallbacks=[],
+            name='main_conversation',
+            persistent=True
+        )
+        application.add_handler(handler)
+        started = time.perf_counter()
+        await application.initialize()
+        elapsed = time.perf_counter() - started
+        restored = len(application._conversation_handler_conversations['main_conversation'])
+        restored_user_data = len(application.user_data)
+        await application.shutdown()
+        await database_async.close_db()
+        return elapsed, restored, restored_user_data
+
+    async def pickle_update(path, updates=5):
+        persistence = PicklePersistence(path, on_flush=True)
+        await persistence.get_conversations('main_conversation')
+        await persistence.get_user_data()
+        await stage(persistence, [(key, 2) for key in keys])
+        await persistence.flush()
+
+        # Как у PicklePersistence по умолчанию (on_flush=False): файл переписывается на каждое изменение
+        persistence = PicklePersistence(path)
+        await persistence.get_conversations('main_conversation')
+        await persistence.get_user_data()
+        started = time.perf_counter()
+        for key in keys[:updates]:
+            await persistence.update_conversation('main_conversation', key, 3)
+        return (time.perf_counter() - started) / updates
+
+    pickle_path = os.path.join(tempfile.gettempdir(), 'vibe_compass_bench.pickle')
+    try:
+        initial, incremental = asyncio.run(write_changes())
+        print(f"   первая запись {conversations} диалогов и user_data: {initial:.2f} с")
+        print(f"   проход с {changed} изменившимися диалогами: {incremental * 1000:.0f} мс "
+              f"({incremental / changed * 1_000_000:.0f} мкс на диалог)")
+
+        per_update = asyncio.run(pickle_update(pickle_path))
+        print(f"   PicklePersistence: {per_update * 1000:.0f} мс на каждое изменение "
+              f"(файл {os.path.getsize(pickle_path) / 1024 / 1024:.1f} МБ переписывается целиком)")
+
+        elapsed, restored, restored_user_data = asyncio.run(restore())
+        print(f"   восстановление при запуске (Application.initialize): {elapsed:.2f} с, "
+              f"диалогов {restored}, user_data {restored_user_data}")
+    finally:
+        api_server.shutdown()
+        if os.path.exists(pickle_path):
+            os.remove(pickle_path)
+
+
+BENCHMARKS = {
+    'db': benchmark_db,
+    'buffer': benchmark_buffer,
+    'stats': benchmark_stats,
+    'contention': benchmark_contention,
+    'snapshot': benchmark_snapshot,
+    'followup': benchmark_followup,
+    'pool': benchmark_pool,
+    'crm_http': benchmark_crm_http,
+    'crm_batch': benchmark_crm_batch,
+    'crm_webhook': benchmark_crm_webhook,
+    'webhook': benchmark_webhook,
+    'sharding': benchmark_sharding,
+    'persistence': benchmark_persistence,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"⚠️  Неизвестный бенчмарк: {name}. Доступны: {', '.join(BENCHMARKS)}")
+            continue
+        BENCHMARKS[name]()
+    remove_database_files()
@@ -0,0 +1,120 @@
+"""
+Ограниченный пул потоков для блокирующих вызовов
+
+Все синхронные вызовы из обработчиков (синхронные функции отправки
+лидов, функции database.py) идут через один пул, чтобы не
+останавливать цикл событий бота. Одновременно выполняется не больше
+BLOCKING_POOL_WORKERS вызовов, еще BLOCKING_POOL_QUEUE могут ждать в
+очереди. Когда очередь заполнена, вызывающий ждет свободного места до
+BLOCKING_POOL_ACQUIRE_TIMEOUT секунд, после чего получает PoolSaturated.
+"""
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import BLOCKING_POOL_WORKERS, BLOCKING_POOL_QUEUE, BLOCKING_POOL_ACQUIRE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSaturated(Exception):
+    """Пул и его очередь заполнены, вызов не принят"""
+
+
+class BlockingPool:
+    """Пул потоков с обратным давлением и метриками ожидания"""
+
+    def __init__(self, max_workers=BLOCKING_POOL_WORKERS, max_queue=BLOCKING_POOL_QUEUE,
+                 acquire_timeout=BLOCKING_POOL_ACQUIRE_TIMEOUT):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.acquire_timeout = acquire_timeout
+
+        self._executor = None
+        # Места в пуле: выполняющиеся вызовы плюс ожидающие в очереди
+        self._slots = asyncio.Semaphore(max_workers + max_queue)
+
+        self.in_flight = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='blocking')
+        return self._executor
+
+    def _call(self, func, submitted_at):
+        """Выполняется в потоке пула: замеряем ожидание и выполнение"""
+        started = time.perf_counter()
+        wait = started - submitted_at
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.running += 1
+        try:
+            return func()
+        finally:
+            self.running -= 1
+            elapsed = time.perf_counter() - started
+            self.run_total += elapsed
+            self.run_max = max(self.run_max, elapsed)
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнить блокирующую функцию в пуле и дождаться результата"""
+        submitted_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise PoolSaturated(
+                f"Пул занят: {self.in_flight} вызовов при лимите {self.max_workers + self.max_queue}"
+            ) from None
+
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            call = functools.partial(func, *args, **kwargs)
+            result = await loop.run_in_executor(self._get_executor(), self._call, call, submitted_at)
+            self.completed += 1
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def shutdown(self, wait=True):
+        """Остановить потоки пула"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def stats(self):
+        """Счетчики для мониторинга"""
+        started = self.completed + self.failed + self.running
+        finished = self.completed + self.failed
+        return {
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'running': self.running,
+            'queued': self.in_flight - self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'avg_wait_ms': self.wait_total / started * 1000 if started else 0.0,
+            'max_wait_ms': self.wait_max * 1000,
+            'avg_run_ms': self.run_total / finished * 1000 if finished else 0.0,
+            'max_run_ms': self.run_max * 1000
+        }
+
+
+blocking_pool = BlockingPool()
@@ -4,24 +4,39 @@
 """
 import sys
 import os
+import asyncio
+import signal
 
 # Настройка UTF-8 для Windows
 if sys.platform == 'win32':
     os.environ['PYTHONIOENCODING'] = 'utf-8'
 
+from telegram import Bot
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler,
-    MessageHandler,
-    filters
+    TypeHandler
 )
 import logging
 
-from config import TELEGRAM_BOT_TOKEN, START, QUESTION_1_EMOTION, QUESTION_2_PAIN, QUESTION_3_TIME, SHOW_OFFER, COMPLETE
+from config import TELEGRAM_BOT_TOKEN, MAX_CONCURRENT_UPDATES, BOT_MODE, TELEGRAM_WEBHOOK_URL, BOT_WORKERS, BOT_WORKER_ID, WEB_SERVER_HOST, WEB_SERVER_PORT, CRM_WEBHOOK_SECRET, CRM_WEBHOOK_PUBLIC_URL, START, QUESTION_1_EMOTION, QUESTION_2_PAIN, QUESTION_3_TIME, SHOW_OFFER, COMPLETE
 from handlers import *
 from database import init_db
+from database_async import close_db
+from write_buffer import write_buffer
+from blocking_pool import blocking_pool
+from crm_outbox import outbox_dispatcher
+from crm_integration import start_http_client, close_http_client, close_sinks, setup_webhook
+from sheets_appender import sheets_appender
+from admin_notifier import admin_notifier, ADMIN_NOTIFY_PATH
+from crm_webhook import crm_webhook_receiver
+from web_server import WebServer
+from telegram_webhook import TelegramWebhook
+from sharding import ShardDispatcher, WorkerSupervisor, owned_by
+from update_processor import PerUserUpdateProcessor
+from db_persistence import DatabasePersistence
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,6 +45,144 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# HTTP-сервер для входящих вебхуков (запускается, если задан WEB_SERVER_PORT)
+web_server = WebServer()
+
+
+async def post_init(application):
+    """Запуск фоновых задач после инициализации бота"""
+    await write_buffer.start()
+    await start_http_client()
+    # У воркеров (BOT_WORKERS > 1) лиды в CRM и вебхуки AmoCRM обрабатывает фронт,
+    # он же шлет сводки админам: воркер только пересылает ему лиды
+    await admin_notifier.start(application.bot)
+    is_worker = BOT_WORKER_ID is not None
+    if not is_worker:
+        await sheets_appender.start()
+        await outbox_dispatcher.start()
+    if WEB_SERVER_PORT:
+        if CRM_WEBHOOK_SECRET and not is_worker:
+            crm_webhook_receiver.register(web_server)
+            await crm_webhook_receiver.start()
+        await web_server.start()
+        if CRM_WEBHOOK_SECRET and CRM_WEBHOOK_PUBLIC_URL and not is_worker:
+            await setup_webhook(CRM_WEBHOOK_PUBLIC_URL)
+
+
+async def post_stop(application):
+    """Остановка до завершения работы бота, пока он еще может отправлять сообщения"""
+    # Последняя сводка о лидах уходит через бот приложения
+    await admin_notifier.stop()
+
+
+async def post_shutdown(application):
+    """Освобождение ресурсов при остановке бота"""
+    # Дописываем в БД все, что осталось в буфере (неотправленные лиды
+    # остаются в crm_outbox до следующего запуска)
+    await web_server.stop()
+    await crm_webhook_receiver.stop()
+    await outbox_dispatcher.stop()
+    await write_buffer.stop()
+    # Неотправленные строки Google Sheets остаются в локальном файле
+    await sheets_appender.stop()
+    await close_sinks()
+    blocking_pool.shutdown(wait=True)
+    await close_http_client()
+    await close_db()
+
+
+def _stop_event():
+    """Событие остановки по SIGINT/SIGTERM"""
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stopping.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остановка через KeyboardInterrupt
+    return stopping
+
+
+async def run_webhook(application):
+    """
+    Режим вебхука: апдейты принимает встроенный HTTP-сервер (telegram_webhook.py)
+
+    Жизненный цикл тот же, что у run_polling: initialize -> post_init -> start,
+    а при остановке stop -> post_stop -> shutdown -> post_shutdown
+    """
+    stopping = _stop_event()
+    webhook = TelegramWebhook(application)
+    webhook.register(web_server)
+    await application.initialize()
+    try:
+        # post_init запускает HTTP-сервер; до application.start() вебхук отвечает 503
+        await application.post_init(application)
+        await application.start()
+        if BOT_WORKER_ID is None:
+            await webhook.set_webhook(TELEGRAM_WEBHOOK_URL)
+            logger.info("✅ Бот принимает апдейты через вебхук")
+        else:
+            logger.info(f"✅ Воркер {BOT_WORKER_ID} принимает апдейты от фронта")
+        await stopping.wait()
+    finally:
+        # Сначала перестаем принимать апдейты, потом останавливаем их обработку
+        await web_server.stop()
+        if application.running:
+            await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+
+async def run_front():
+    """
+    Фронт для BOT_WORKERS > 1 (sharding.py): принимает вебхук Telegram и раздает
+    апдейты процессам-воркерам по user_id
+
+    Сам фронт апдейты не обрабатывает: он отправляет лиды из crm_outbox в CRM,
+    принимает вебхуки AmoCRM и шлет админам сводки о лидах, которые пересылают
+    воркеры, а воркеры запускает и перезапускает WorkerSupervisor
+    """
+    stopping = _stop_event()
+    dispatcher = ShardDispatcher()
+    front_host = '127.0.0.1' if WEB_SERVER_HOST in ('0.0.0.0', '::', '') else WEB_SERVER_HOST
+    # Без чатов для сводок воркерам незачем пересылать лиды
+    admin_notify_url = f"http://{front_host}:{WEB_SERVER_PORT}{ADMIN_NOTIFY_PATH}" if admin_notifier.chat_ids else None
+    supervisor = WorkerSupervisor(dispatcher, admin_notify_url=admin_notify_url)
+    dispatcher.register(web_server)
+    admin_notifier.register(web_server, dispatcher.worker_secret)
+    bot = Bot(TELEGRAM_BOT_TOKEN)
+    if CRM_WEBHOOK_SECRET:
+        crm_webhook_receiver.register(web_server)
+        await crm_webhook_receiver.start()
+    await start_http_client()
+    await sheets_appender.start()
+    await outbox_dispatcher.start()
+    await supervisor.start()
+    await dispatcher.start()
+    try:
+        await bot.initialize()
+        await admin_notifier.start(bot)
+        await web_server.start()
+        await dispatcher.set_webhook(bot, TELEGRAM_WEBHOOK_URL)
+        if CRM_WEBHOOK_SECRET and CRM_WEBHOOK_PUBLIC_URL:
+            await setup_webhook(CRM_WEBHOOK_PUBLIC_URL)
+        await stopping.wait()
+    finally:
+        # Воркеры при остановке пересылают последние лиды: сервер фронта еще принимает их
+        await supervisor.stop()
+        await web_server.stop()
+        await dispatcher.stop()
+        await admin_notifier.stop()
+        await bot.shutdown()
+        await crm_webhook_receiver.stop()
+        await outbox_dispatcher.stop()
+        await sheets_appender.stop()
+        await close_sinks()
+        blocking_pool.shutdown(wait=True)
+        await close_http_client()
+        await close_db()
+
 
 def main():
     """Главная функция запуска бота"""
@@ -44,9 +197,32 @@ def main():
     logger.info("Инициализация базы данных...")
     init_db()
 
+    if BOT_MODE == 'webhook' and BOT_WORKERS > 1 and BOT_WORKER_ID is None:
+        if not WEB_SERVER_PORT or not TELEGRAM_WEBHOOK_URL:
+            logger.error("❌ Для BOT_MODE=webhook задайте WEB_SERVER_PORT и TELEGRAM_WEBHOOK_URL")
+            return
+        logger.info(f"Запуск фронта с {BOT_WORKERS} воркерами...")
+        asyncio.run(run_front())
+        return
+
+    # Воркер загружает диалоги только своих пользователей (sharding.py)
+    is_worker = BOT_WORKER_ID is not None
+    persistence = DatabasePersistence(owns=owned_by(BOT_WORKER_ID) if is_worker else None)
+
     # Создание приложения
     logger.info("Создание приложения бота...")
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        # Разные пользователи — параллельно, апдейты одного пользователя — по очереди
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        # Незавершенные диалоги и user_data переживают перезапуск (db_persistence.py)
+        .persistence(persistence)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Определение ConversationHandler для основного сценария
     conv_handler = ConversationHandler(
@@ -81,20 +257,31 @@ def main():
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         name="main_conversation",
-        persistent=False
+        persistent=True
     )
 
     # Регистрация обработчиков
+    if is_worker:
+        # Состояние пользователя, перешедшего от другого воркера, — из БД, до ConversationHandler
+        application.add_handler(TypeHandler(Update, persistence.reload_moved), group=-1)
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler('help', help_command))
     application.add_handler(CommandHandler('stats', stats_command))
+    application.add_handler(CommandHandler('rebuild_stats', rebuild_stats_command))
+    application.add_handler(CommandHandler('replay_leads', replay_leads_command))
 
     # Запуск бота
     logger.info("✅ Бот запущен и готов к работе!")
     logger.info("Нажмите Ctrl+C для остановки")
 
-    # Запуск polling
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        if not WEB_SERVER_PORT or (not TELEGRAM_WEBHOOK_URL and BOT_WORKER_ID is None):
+            logger.error("❌ Для BOT_MODE=webhook задайте WEB_SERVER_PORT и TELEGRAM_WEBHOOK_URL")
+            return
+        asyncio.run(run_webhook(application))
+    else:
+        # Запуск polling
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':
@@ -10,13 +10,176 @@ load_dotenv()
 # Telegram
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
+# Администраторы (Telegram ID через запятую). Пусто — админ-команды доступны всем
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv('ADMIN_IDS', '').split(',') if admin_id.strip()}
+# Куда присылать сводки о новых лидах (ID чатов через запятую, по умолчанию — ADMIN_IDS):
+# одно сообщение раз в ADMIN_NOTIFY_INTERVAL секунд с таблицей последних ADMIN_NOTIFY_MAX_ROWS лидов
+ADMIN_NOTIFY_CHAT_IDS = [
+    int(chat_id) for chat_id in os.getenv('ADMIN_NOTIFY_CHAT_IDS', '').split(',') if chat_id.strip()
+] or sorted(ADMIN_IDS)
+ADMIN_NOTIFY_INTERVAL = float(os.getenv('ADMIN_NOTIFY_INTERVAL', '60'))
+ADMIN_NOTIFY_MAX_ROWS = int(os.getenv('ADMIN_NOTIFY_MAX_ROWS', '20'))
+# Адрес фронта, которому воркер (BOT_WORKERS > 1) пересылает лиды для сводки; задает сам фронт
+ADMIN_NOTIFY_FORWARD_URL = os.getenv('ADMIN_NOTIFY_FORWARD_URL')
+
 # CRM
 AMOCRM_TOKEN = os.getenv('AMOCRM_TOKEN')
 AMOCRM_DOMAIN = os.getenv('AMOCRM_DOMAIN')
+# Адрес API можно переопределить (например, тестовый сервер)
+AMOCRM_BASE_URL = os.getenv('AMOCRM_BASE_URL', f"https://{AMOCRM_DOMAIN}")
+# Как часто перечитывать ID дополнительных полей сделок AmoCRM (с)
+AMOCRM_FIELDS_TTL = float(os.getenv('AMOCRM_FIELDS_TTL', '3600'))
+# Входящий вебхук Bitrix24 вида https://portal.bitrix24.ru/rest/1/ключ/
+BITRIX24_WEBHOOK_URL = os.getenv('BITRIX24_WEBHOOK_URL')
+
+# Куда отправлять лиды (через запятую): amocrm, bitrix24, google_sheets, log.
+# По умолчанию — AmoCRM, если задан токен, иначе лиды только пишутся в лог
+CRM_SINKS = [sink.strip() for sink in os.getenv('CRM_SINKS', '').split(',') if sink.strip()] or (
+    ['amocrm'] if AMOCRM_TOKEN and AMOCRM_TOKEN != 'your_amocrm_token_here' else ['log']
+)
+# Сколько ждать ответа одной системы, прежде чем считать попытку неудачной (с)
+CRM_SINK_TIMEOUT = float(os.getenv('CRM_SINK_TIMEOUT', '15'))
+
+# Google Sheets: таблица, диапазон и доступ (файл сервисного аккаунта — нужен пакет google-auth,
+# либо готовый OAuth-токен)
+GOOGLE_SHEETS_SPREADSHEET_ID = os.getenv('GOOGLE_SHEETS_SPREADSHEET_ID')
+GOOGLE_SHEETS_RANGE = os.getenv('GOOGLE_SHEETS_RANGE', 'Лиды!A:G')
+GOOGLE_SHEETS_CREDENTIALS_FILE = os.getenv('GOOGLE_SHEETS_CREDENTIALS_FILE')
+GOOGLE_SHEETS_ACCESS_TOKEN = os.getenv('GOOGLE_SHEETS_ACCESS_TOKEN')
+GOOGLE_SHEETS_API_URL = os.getenv('GOOGLE_SHEETS_API_URL', 'https://sheets.googleapis.com')
+# Строки копятся и добавляются одним запросом раз в N секунд или по M строк;
+# до отправки они хранятся в локальном файле и переживают перезапуск
+GOOGLE_SHEETS_FLUSH_INTERVAL = float(os.getenv('GOOGLE_SHEETS_FLUSH_INTERVAL', '10'))
+GOOGLE_SHEETS_BATCH_SIZE = int(os.getenv('GOOGLE_SHEETS_BATCH_SIZE', '100'))
+GOOGLE_SHEETS_PENDING_FILE = os.getenv('GOOGLE_SHEETS_PENDING_FILE', 'sheets_pending.jsonl')
+
+# HTTP-клиент CRM: таймауты (с), размер пула соединений, keep-alive, HTTP/2 (нужен пакет h2)
+CRM_CONNECT_TIMEOUT = float(os.getenv('CRM_CONNECT_TIMEOUT', '5'))
+CRM_READ_TIMEOUT = float(os.getenv('CRM_READ_TIMEOUT', '10'))
+CRM_MAX_CONNECTIONS = int(os.getenv('CRM_MAX_CONNECTIONS', '20'))
+CRM_KEEPALIVE_CONNECTIONS = int(os.getenv('CRM_KEEPALIVE_CONNECTIONS', '10'))
+CRM_KEEPALIVE_EXPIRY = float(os.getenv('CRM_KEEPALIVE_EXPIRY', '30'))
+CRM_HTTP2 = os.getenv('CRM_HTTP2', 'true').lower() in ('1', 'true', 'yes')
+# Лиды в AmoCRM уходят пачками: до CRM_BATCH_SIZE штук или раз в CRM_BATCH_WINDOW_MS мс
+CRM_BATCH_SIZE = int(os.getenv('CRM_BATCH_SIZE', '50'))
+CRM_BATCH_WINDOW_MS = int(os.getenv('CRM_BATCH_WINDOW_MS', '200'))
+# Не чаще CRM_RATE_LIMIT запросов/с (AmoCRM допускает 7), при 429 частота снижается сама
+CRM_RATE_LIMIT = float(os.getenv('CRM_RATE_LIMIT', '7'))
+CRM_RATE_BURST = int(os.getenv('CRM_RATE_BURST', '7'))
+# Предохранитель: после N ошибок подряд (таймауты, 5xx) пауза в запросах на M секунд
+CRM_BREAKER_FAILURES = int(os.getenv('CRM_BREAKER_FAILURES', '5'))
+CRM_BREAKER_RESET_TIMEOUT = float(os.getenv('CRM_BREAKER_RESET_TIMEOUT', '30'))
+
+# Как получать апдейты: polling (getUpdates) или webhook (Telegram присылает их на встроенный сервер)
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+# Публичный HTTPS-адрес вебхука (вместе с путем) и путь на встроенном сервере
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+TELEGRAM_WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH', '/telegram')
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token (не задан — случайный при каждом запуске)
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+# Сколько соединений Telegram открывает к вебхуку одновременно (1-100)
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv('TELEGRAM_WEBHOOK_MAX_CONNECTIONS', '40'))
+# Апдейты сверх этой очереди отклоняются с 503, Telegram повторит их позже
+TELEGRAM_WEBHOOK_QUEUE_LIMIT = int(os.getenv('TELEGRAM_WEBHOOK_QUEUE_LIMIT', '10000'))
+# В режиме webhook при BOT_WORKERS > 1 процесс-фронт раздает апдейты BOT_WORKERS процессам
+# бота по консистентному хешу user_id; воркеры слушают 127.0.0.1:BOT_WORKER_BASE_PORT+N
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+BOT_WORKER_BASE_PORT = int(os.getenv('BOT_WORKER_BASE_PORT', '9100'))
+# Раз в N секунд фронт проверяет выбывших воркеров; упавший воркер перезапускается через M секунд
+BOT_WORKER_HEALTH_INTERVAL = float(os.getenv('BOT_WORKER_HEALTH_INTERVAL', '1'))
+BOT_WORKER_RESTART_DELAY = float(os.getenv('BOT_WORKER_RESTART_DELAY', '1'))
+# Номер воркера: задает фронт при запуске процесса, вручную не указывается
+BOT_WORKER_ID = int(os.environ['BOT_WORKER_ID']) if os.getenv('BOT_WORKER_ID') else None
+
+# Встроенный HTTP-сервер для входящих вебхуков (порт 0 — сервер не запускается)
+WEB_SERVER_HOST = os.getenv('WEB_SERVER_HOST', '0.0.0.0')
+WEB_SERVER_PORT = int(os.getenv('WEB_SERVER_PORT', '0'))
+WEB_SERVER_MAX_CONNECTIONS = int(os.getenv('WEB_SERVER_MAX_CONNECTIONS', '100'))
+
+# Вебхуки AmoCRM о смене статуса сделок: адрес вида https://bot.example.com/amocrm/webhook?secret=...
+CRM_WEBHOOK_PATH = os.getenv('CRM_WEBHOOK_PATH', '/amocrm/webhook')
+CRM_WEBHOOK_SECRET = os.getenv('CRM_WEBHOOK_SECRET')
+# Публичный адрес вебхука с секретом: если задан, бот сам подписывается на события AmoCRM при запуске
+CRM_WEBHOOK_PUBLIC_URL = os.getenv('CRM_WEBHOOK_PUBLIC_URL')
+# События копятся и применяются одной транзакцией раз в N мс или по M событий;
+# ID примененных событий хранятся CRM_WEBHOOK_EVENT_TTL_DAYS дней
+CRM_WEBHOOK_FLUSH_MS = int(os.getenv('CRM_WEBHOOK_FLUSH_MS', '1000'))
+CRM_WEBHOOK_BATCH_SIZE = int(os.getenv('CRM_WEBHOOK_BATCH_SIZE', '1000'))
+CRM_WEBHOOK_EVENT_TTL_DAYS = int(os.getenv('CRM_WEBHOOK_EVENT_TTL_DAYS', '7'))
+# Статусы AmoCRM -> conversion_status (status_id:статус через запятую; 142 и 143 — системные
+# «Успешно реализовано» и «Закрыто и не реализовано»). Остальные статусы получают
+# AMOCRM_STATUS_DEFAULT, пустое значение — не отслеживаются
+AMOCRM_STATUS_MAP = {
+    int(status_id): status.strip()
+    for status_id, status in (
+        item.split(':', 1) for item in os.getenv('AMOCRM_STATUS_MAP', '142:crm_won,143:crm_lost').split(',') if ':' in item
+    )
+}
+AMOCRM_STATUS_DEFAULT = os.getenv('AMOCRM_STATUS_DEFAULT', 'crm_in_progress') or None
 
 # Database
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///vibe_compass.db')
 
+
+def _make_async_url(url):
+    """Подставляет асинхронный драйвер в URL базы данных"""
+    if url.startswith('sqlite:///'):
+        return url.replace('sqlite:///', 'sqlite+aiosqlite:///', 1)
+    if url.startswith('postgres://'):
+        return url.replace('postgres://', 'postgresql+asyncpg://', 1)
+    if url.startswith('postgresql://'):
+        return url.replace('postgresql://', 'postgresql+asyncpg://', 1)
+    return url
+
+
+# URL для асинхронного движка (aiosqlite / asyncpg)
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL', _make_async_url(DATABASE_URL))
+
+# Профиль движка БД: production (WAL и прагмы для SQLite, пул для Postgres) или default
+DB_PROFILE = os.getenv('DB_PROFILE', 'production')
+
+# SQLite (профиль production)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', str(64 * 1024)))
+
+# Пул соединений для PostgreSQL (профиль production)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+
+# Сколько апдейтов обрабатывается одновременно (апдейты одного пользователя — по очереди)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '256'))
+
+# Пул потоков для блокирующих вызовов (CRM, синхронная БД): потоки, очередь, ожидание места (с)
+BLOCKING_POOL_WORKERS = int(os.getenv('BLOCKING_POOL_WORKERS', '8'))
+BLOCKING_POOL_QUEUE = int(os.getenv('BLOCKING_POOL_QUEUE', '100'))
+BLOCKING_POOL_ACQUIRE_TIMEOUT = float(os.getenv('BLOCKING_POOL_ACQUIRE_TIMEOUT', '5'))
+
+# Очередь отправки лидов в CRM: опрос раз в N секунд, пачка, попытки и экспоненциальная пауза (с)
+CRM_OUTBOX_POLL_INTERVAL = float(os.getenv('CRM_OUTBOX_POLL_INTERVAL', '1'))
+CRM_OUTBOX_BATCH_SIZE = int(os.getenv('CRM_OUTBOX_BATCH_SIZE', '50'))
+CRM_OUTBOX_MAX_ATTEMPTS = int(os.getenv('CRM_OUTBOX_MAX_ATTEMPTS', '8'))
+CRM_OUTBOX_BACKOFF_BASE = float(os.getenv('CRM_OUTBOX_BACKOFF_BASE', '5'))
+CRM_OUTBOX_BACKOFF_MAX = float(os.getenv('CRM_OUTBOX_BACKOFF_MAX', '3600'))
+
+# Отложенная запись ответов: сброс в БД раз в N мс или при M накопленных изменениях
+WRITE_BUFFER_FLUSH_MS = int(os.getenv('WRITE_BUFFER_FLUSH_MS', '50'))
+WRITE_BUFFER_MAX_RECORDS = int(os.getenv('WRITE_BUFFER_MAX_RECORDS', '500'))
+
+# Кэш пользователей в памяти процесса (LRU с TTL)
+USER_CACHE_MAX_SIZE = int(os.getenv('USER_CACHE_MAX_SIZE', '100000'))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '3600'))
+
+# Состояния диалогов и user_data в БД: изменения пишутся пачкой раз в N секунд,
+# диалоги без изменений дольше PERSISTENCE_TTL_DAYS дней удаляются при запуске
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '5'))
+PERSISTENCE_TTL_DAYS = int(os.getenv('PERSISTENCE_TTL_DAYS', '30'))
+
+# Паузы перед следующим сообщением опроса (секунды), отправляются через JobQueue
+EMOTION_FOLLOW_UP_DELAY = float(os.getenv('EMOTION_FOLLOW_UP_DELAY', '1.5'))
+OFFER_FOLLOW_UP_DELAY = float(os.getenv('OFFER_FOLLOW_UP_DELAY', '2'))
+
 # States для ConversationHandler
 (
     START,
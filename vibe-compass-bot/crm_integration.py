@@ -2,16 +2,99 @@
 Интеграция с CRM системами
 Здесь реализованы функции для отправки лидов в различные CRM
 """
-import requests
+import asyncio
+import httpx
 import logging
-from config import AMOCRM_TOKEN, AMOCRM_DOMAIN
+import time
+from config import (
+    AMOCRM_TOKEN,
+    AMOCRM_BASE_URL,
+    AMOCRM_FIELDS_TTL,
+    CRM_CONNECT_TIMEOUT,
+    CRM_READ_TIMEOUT,
+    CRM_MAX_CONNECTIONS,
+    CRM_KEEPALIVE_CONNECTIONS,
+    CRM_KEEPALIVE_EXPIRY,
+    CRM_HTTP2,
+    CRM_BATCH_WINDOW_MS,
+    CRM_BATCH_SIZE,
+    CRM_RATE_LIMIT,
+    CRM_RATE_BURST,
+    CRM_BREAKER_FAILURES,
+    CRM_BREAKER_RESET_TIMEOUT,
+    CRM_SINKS,
+    CRM_SINK_TIMEOUT,
+    BITRIX24_WEBHOOK_URL
+)
+from resilience import CircuitBreaker, CircuitOpen, TokenBucket
+from blocking_pool import blocking_pool
 
 logger = logging.getLogger(__name__)
 
 
-def send_lead_to_crm(lead_info):
+# ==================== HTTP-КЛИЕНТ ====================
+# Один асинхронный клиент на процесс: соединения с CRM переиспользуются
+# (keep-alive), вместо нового TCP+TLS рукопожатия на каждый лид.
+# Создается в post_init и закрывается в post_shutdown (bot.py)
+
+_http_client = None
+
+
+def _http2_available():
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def create_http_client(base_url=AMOCRM_BASE_URL, http2=CRM_HTTP2, verify=True, headers=None):
+    """Создать клиент с пулом соединений и таймаутами из конфигурации"""
+    return httpx.AsyncClient(
+        base_url=base_url,
+        http2=http2 and _http2_available(),
+        verify=verify,
+        timeout=httpx.Timeout(CRM_READ_TIMEOUT, connect=CRM_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=CRM_MAX_CONNECTIONS,
+            max_keepalive_connections=CRM_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=CRM_KEEPALIVE_EXPIRY
+        ),
+        headers=headers
+    )
+
+
+def _create_amocrm_client():
+    return create_http_client(headers={'Authorization': f'Bearer {AMOCRM_TOKEN}'})
+
+
+async def start_http_client():
+    """Создать общий клиент CRM (вызывается при запуске бота)"""
+    global _http_client
+    if _http_client is None:
+        _http_client = _create_amocrm_client()
+    return _http_client
+
+
+def get_http_client():
+    """Общий клиент CRM; создается при первом обращении, если бот его не запустил"""
+    global _http_client
+    if _http_client is None:
+        _http_client = _create_amocrm_client()
+    return _http_client
+
+
+async def close_http_client():
+    """Закрыть соединения клиента CRM (вызывается при остановке бота)"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def send_lead_to_crm(lead_info, sinks=None):
     """
-    Отправка лида в CRM систему
+    Отправка лида во все включенные системы (CRM_SINKS) одновременно
 
     Args:
         lead_info (dict): Информация о лиде
@@ -21,176 +104,678 @@ def send_lead_to_crm(lead_info):
             - pain_point: Основная проблема
             - time_spent: Время, потраченное на рутину
             - emotion: Эмоциональное состояние
+        sinks (dict): имя -> LeadSink, по умолчанию get_sinks()
+
+    Returns:
+        dict: имя системы -> результат отправки
     """
+    sinks = sinks or get_sinks()
+    results = await asyncio.gather(
+        *(deliver_to_sink(sink, lead_info) for sink in sinks.values()),
+        return_exceptions=True
+    )
+    return {
+        name: result if isinstance(result, dict) else {'success': False, 'error': str(result)}
+        for name, result in zip(sinks, results)
+    }
+
+
+# Читаемые описания ответов для карточки лида
+PAIN_POINT_LABELS = {
+    'pain_messages': 'Ответы на повторяющиеся вопросы клиентов',
+    'pain_data': 'Сведение данных из таблиц',
+    'pain_deadlines': 'Напоминания о дедлайнах команде',
+    'pain_documents': 'Формирование документов',
+    'pain_copying': 'Копирование данных между системами'
+}
+
+TIME_LABELS = {
+    'time_low': 'Меньше 5 часов в неделю',
+    'time_medium': '5-10 часов в неделю',
+    'time_high': 'Больше 10 часов в неделю'
+}
+
+EMOTION_LABELS = {
+    'emotion_tired': 'Выжатый как лимон',
+    'emotion_annoyed': 'Раздраженный',
+    'emotion_confused': 'Запутавшийся'
+}
+
+
+def lead_labels(lead_info):
+    """(проблема, время, состояние) читаемым текстом"""
+    return (
+        PAIN_POINT_LABELS.get(lead_info.get('pain_point', ''), 'Не указано'),
+        TIME_LABELS.get(lead_info.get('time_spent', ''), 'Не указано'),
+        EMOTION_LABELS.get(lead_info.get('emotion', ''), 'Не указано')
+    )
+
+
+# Дополнительные поля сделки AmoCRM (названия как в настройках воронки)
+AMOCRM_LEAD_FIELDS = ('Основная проблема', 'Время на рутину', 'Эмоциональное состояние', 'Telegram ID')
+
+
+class AmoCrmFieldCache:
+    """
+    ID дополнительных полей сделок AmoCRM по названиям
 
-    # Выбираем CRM систему на основе конфигурации
-    if AMOCRM_TOKEN and AMOCRM_TOKEN != 'your_amocrm_token_here':
-        return send_to_amocrm(lead_info)
-    else:
-        # Если CRM не настроена, просто логируем
-        logger.info(f"📋 Новый лид (CRM не настроена): {lead_info}")
-        return {'success': True, 'message': 'CRM не настроена, лид залогирован'}
+    Список полей запрашивается один раз и перечитывается раз в
+    AMOCRM_FIELDS_TTL секунд или после отклоненной пачки (поле могли
+    переименовать). Пока ID не известен, поле передается по названию.
+    """
 
+    RETRY_AFTER_FAILURE = 60
+
+    def __init__(self, ttl=AMOCRM_FIELDS_TTL):
+        self.ttl = ttl
+        self._ids = {}
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+        self.loads = 0
+        self.failures = 0
+
+    async def _load(self, client, limiter=None):
+        ids = {}
+        page = 1
+        while True:
+            if limiter is not None:
+                await limiter.acquire()
+            response = await client.get('/api/v4/leads/custom_fields', params={'page': page, 'limit': 250})
+            if response.status_code == 204:  # полей нет
+                break
+            response.raise_for_status()
+            body = response.json()
+            for field in body.get('_embedded', {}).get('custom_fields', []):
+                ids[field['name']] = field['id']
+            if not body.get('_links', {}).get('next'):
+                break
+            page += 1
+        return ids
+
+    async def get(self, client, limiter=None):
+        """Название поля -> ID; запрос к AmoCRM только если список устарел (каждая страница — через limiter)"""
+        if time.monotonic() < self._expires_at:
+            return self._ids
+        async with self._lock:
+            if time.monotonic() >= self._expires_at:
+                try:
+                    self._ids = await self._load(client, limiter)
+                    self.loads += 1
+                    self._expires_at = time.monotonic() + self.ttl
+                except Exception as e:
+                    # Остаемся на прежних ID (или названиях) и не повторяем запрос на каждой пачке
+                    self.failures += 1
+                    self._expires_at = time.monotonic() + min(self.ttl, self.RETRY_AFTER_FAILURE)
+                    logger.warning(f"⚠️ Не удалось получить поля AmoCRM: {e}")
+        return self._ids
+
+    def invalidate(self):
+        """Перечитать поля перед следующей пачкой"""
+        self._expires_at = 0.0
+
+    def stats(self):
+        return {'fields': len(self._ids), 'loads': self.loads, 'failures': self.failures}
+
+
+def build_amocrm_lead(lead_info, field_ids=None, contact_id=None):
+    """
+    Один элемент массива для POST /api/v4/leads
 
-def send_to_amocrm(lead_info):
-    """Отправка лида в AmoCRM"""
-    try:
-        url = f"https://{AMOCRM_DOMAIN}/api/v4/leads"
+    field_ids — ID полей по названиям (AmoCrmFieldCache), contact_id —
+    уже существующий контакт пользователя: тогда сделка привязывается
+    к нему, а не создает новый
+    """
+    field_ids = field_ids or {}
+    pain_text, time_text, emotion_text = lead_labels(lead_info)
+    values = dict(zip(AMOCRM_LEAD_FIELDS, (pain_text, time_text, emotion_text, str(lead_info.get('user_id', '')))))
 
-        headers = {
-            'Authorization': f'Bearer {AMOCRM_TOKEN}',
-            'Content-Type': 'application/json'
+    if contact_id:
+        contact = {'id': contact_id}
+    else:
+        contact = {
+            'first_name': lead_info.get('first_name', ''),
+            'custom_fields_values': [
+                {
+                    'field_code': 'PHONE',
+                    'values': [{'value': f"Telegram: @{lead_info.get('username', 'no_username')}"}]
+                }
+            ]
         }
 
-        # Формируем читаемое описание проблемы
-        pain_points_map = {
-            'pain_messages': 'Ответы на повторяющиеся вопросы клиентов',
-            'pain_data': 'Сведение данных из таблиц',
-            'pain_deadlines': 'Напоминания о дедлайнах команде',
-            'pain_documents': 'Формирование документов',
-            'pain_copying': 'Копирование данных между системами'
-        }
+    # Данные лида
+    lead_data = {
+        'name': f"Вайб-лид: {lead_info.get('first_name', 'Неизвестно')}",
+        'price': 0,
+        '_embedded': {'contacts': [contact]},
+        'custom_fields_values': [
+            {
+                **({'field_id': field_ids[name]} if name in field_ids else {'field_name': name}),
+                'values': [{'value': value}]
+            }
+            for name, value in values.items()
+        ]
+    }
 
-        time_map = {
-            'time_low': 'Меньше 5 часов в неделю',
-            'time_medium': '5-10 часов в неделю',
-            'time_high': 'Больше 10 часов в неделю'
-        }
+    return lead_data
 
-        emotion_map = {
-            'emotion_tired': 'Выжатый как лимон',
-            'emotion_annoyed': 'Раздраженный',
-            'emotion_confused': 'Запутавшийся'
-        }
 
-        pain_text = pain_points_map.get(lead_info.get('pain_point', ''), 'Не указано')
-        time_text = time_map.get(lead_info.get('time_spent', ''), 'Не указано')
-        emotion_text = emotion_map.get(lead_info.get('emotion', ''), 'Не указано')
-
-        # Данные лида
-        lead_data = [{
-            'name': f"Вайб-лид: {lead_info.get('first_name', 'Неизвестно')}",
-            'price': 0,
-            '_embedded': {
-                'contacts': [{
-                    'first_name': lead_info.get('first_name', ''),
-                    'custom_fields_values': [
-                        {
-                            'field_code': 'PHONE',
-                            'values': [{'value': f"Telegram: @{lead_info.get('username', 'no_username')}"}]
-                        }
-                    ]
-                }]
-            },
-            'custom_fields_values': [
-                {
-                    'field_name': 'Основная проблема',
-                    'values': [{'value': pain_text}]
-                },
-                {
-                    'field_name': 'Время на рутину',
-                    'values': [{'value': time_text}]
-                },
-                {
-                    'field_name': 'Эмоциональное состояние',
-                    'values': [{'value': emotion_text}]
-                },
-                {
-                    'field_name': 'Telegram ID',
-                    'values': [{'value': str(lead_info.get('user_id', ''))}]
-                }
-            ]
-        }]
+def _request_ids(lead):
+    """request_id из ответа: строка в /leads, список в /leads/complex"""
+    request_id = lead.get('request_id')
+    return [str(rid) for rid in request_id] if isinstance(request_id, list) else [str(request_id)]
 
-        response = requests.post(url, json=lead_data, headers=headers, timeout=10)
+
+async def _post_amocrm_leads(client, path, items, limiter=None):
+    """Отправить элементы одним запросом (повтор без отклоненных — еще одним); результаты в порядке items"""
+    try:
+        if limiter is not None:
+            await limiter.acquire()
+        response = await client.post(path, json=items)
 
         if response.status_code in [200, 201]:
-            logger.info(f"✅ Лид успешно отправлен в AmoCRM: {lead_info.get('first_name')}")
-            return {'success': True, 'response': response.json()}
-        else:
-            logger.error(f"❌ Ошибка отправки в AmoCRM: {response.status_code} - {response.text}")
-            return {'success': False, 'error': response.text}
+            body = response.json()
+            # /leads отвечает {'_embedded': {'leads': [...]}}, /leads/complex — списком
+            created = body if isinstance(body, list) else body.get('_embedded', {}).get('leads', [])
+            by_request = {rid: lead for lead in created for rid in _request_ids(lead)}
+            logger.info(f"✅ Лиды отправлены в AmoCRM: {len(by_request)} из {len(items)}")
+            results = []
+            for item in items:
+                lead = by_request.get(item['request_id'])
+                if lead is None:
+                    results.append({'success': False, 'error': 'AmoCRM не вернула лид в ответе'})
+                    continue
+                result = {'success': True, 'lead_id': lead.get('id')}
+                if lead.get('contact_id'):
+                    result['contact_id'] = lead['contact_id']
+                results.append(result)
+            return results
+
+        # При ошибке валидации AmoCRM отклоняет всю пачку и перечисляет плохие элементы:
+        # им возвращаем ошибку, остальные отправляем повторно без них
+        errors = {}
+        if response.status_code == 400 and len(items) > 1:
+            try:
+                for item in response.json().get('validation-errors', []):
+                    errors[str(item.get('request_id'))] = str(item.get('errors'))
+            except ValueError:
+                pass
+        if errors:
+            valid = [item for item in items if item['request_id'] not in errors]
+            resent = iter(await _post_amocrm_leads(client, path, valid, limiter) if valid else [])
+            return [
+                {'success': False, 'error': errors[item['request_id']], 'status': 400}
+                if item['request_id'] in errors else next(resent)
+                for item in items
+            ]
+
+        logger.error(f"❌ Ошибка отправки в AmoCRM: {response.status_code} - {response.text}")
+        error = {'success': False, 'error': response.text, 'status': response.status_code}
+        if response.status_code == 429:
+            error['retry_after'] = _retry_after(response)
+        return [error] * len(items)
 
     except Exception as e:
         logger.error(f"❌ Исключение при отправке в AmoCRM: {e}")
-        return {'success': False, 'error': str(e)}
+        return [{'success': False, 'error': str(e), 'status': None}] * len(items)
 
 
-def send_to_bitrix24(lead_info):
-    """Отправка лида в Bitrix24"""
-    # Здесь можно реализовать интеграцию с Bitrix24
-    logger.info("Bitrix24 интеграция еще не реализована")
-    pass
+async def send_leads_to_amocrm(leads, client=None, field_ids=None, contacts=None, limiter=None):
+    """
+    Отправка нескольких лидов в AmoCRM
+
+    Каждому лиду присваивается request_id (его номер в пачке), по которому
+    ответ AmoCRM раскладывается обратно. Лиды пользователей с известным
+    контактом (contacts: user_id -> contact_id) привязываются к нему через
+    /api/v4/leads, остальные уходят в /api/v4/leads/complex, который создает
+    контакт вместе со сделкой и возвращает его ID. Каждый HTTP-запрос
+    ждет разрешения limiter (TokenBucket), если он передан. Возвращает список
+    результатов в порядке leads: {'success': True, 'lead_id': ..., 'contact_id': ...}
+    или {'success': False, 'error': ...}
+    """
+    client = client or get_http_client()
+    contacts = contacts or {}
+    groups = {'/api/v4/leads': [], '/api/v4/leads/complex': []}
+    for i, lead_info in enumerate(leads):
+        contact_id = contacts.get(lead_info.get('user_id'))
+        item = {**build_amocrm_lead(lead_info, field_ids, contact_id), 'request_id': str(i)}
+        groups['/api/v4/leads' if contact_id else '/api/v4/leads/complex'].append((i, item))
+
+    groups = {path: group for path, group in groups.items() if group}
+    responses = await asyncio.gather(*(
+        _post_amocrm_leads(client, path, [item for _, item in group], limiter) for path, group in groups.items()
+    ))
+
+    results = [None] * len(leads)
+    for group, group_results in zip(groups.values(), responses):
+        for (i, _), result in zip(group, group_results):
+            contact_id = contacts.get(leads[i].get('user_id'))
+            if result['success'] and contact_id:
+                result = {**result, 'contact_id': contact_id}
+            results[i] = result
+    return results
+
+
+def _retry_after(response):
+    """Retry-After в секундах (формат даты не поддерживаем — тогда None)"""
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
 
 
-def send_to_google_sheets(lead_info):
+async def send_to_amocrm(lead_info, client=None, field_ids=None, contacts=None):
+    """Отправка одного лида в AmoCRM через общий клиент"""
+    return (await send_leads_to_amocrm([lead_info], client, field_ids, contacts))[0]
+
+
+class AmoCrmBatcher:
     """
-    Отправка лида в Google Sheets
-    Простое решение для старта без настройки CRM
+    Сборщик лидов в пачки для AmoCRM
+
+    submit() ждет результата своего лида, а сами лиды копятся до
+    CRM_BATCH_SIZE штук или CRM_BATCH_WINDOW_MS миллисекунд и уходят
+    одним запросом. Результат (и повторы через crm_outbox) остается
+    отдельным для каждого лида. Каждый HTTP-запрос идет через ограничитель частоты,
+    а при разомкнутом предохранителе submit() сразу бросает CircuitOpen:
+    лид остается в crm_outbox, попытка не тратится.
+
+    На пачку приходится один запрос к crm_contacts: повторные лиды
+    привязываются к уже созданному контакту пользователя, а контакты
+    новых пользователей сохраняются после ответа AmoCRM.
     """
-    try:
-        from datetime import datetime
-
-        # Здесь нужно настроить Google Sheets API
-        # Для примера просто логируем
-
-        lead_row = [
-            datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            lead_info.get('first_name', ''),
-            lead_info.get('username', ''),
-            lead_info.get('user_id', ''),
-            lead_info.get('pain_point', ''),
-            lead_info.get('time_spent', ''),
-            lead_info.get('emotion', '')
+
+    def __init__(self, window=CRM_BATCH_WINDOW_MS / 1000, max_batch=CRM_BATCH_SIZE, client=None,
+                 breaker=None, limiter=None, fields=None):
+        self.window = window
+        self.max_batch = max_batch
+        self.client = client
+        self.breaker = breaker or CircuitBreaker('AmoCRM', CRM_BREAKER_FAILURES, CRM_BREAKER_RESET_TIMEOUT)
+        self.limiter = limiter or TokenBucket(CRM_RATE_LIMIT, CRM_RATE_BURST)
+        self.fields = fields or AmoCrmFieldCache()
+
+        self._batch = []  # (lead_info, future)
+        self._timer = None
+        self.batches = 0
+        self.leads = 0
+
+    async def submit(self, lead_info):
+        """Поставить лид в пачку и дождаться результата его отправки"""
+        future = asyncio.get_running_loop().create_future()
+        entry = (lead_info, future)
+        self._batch.append(entry)
+        if len(self._batch) >= self.max_batch:
+            self._send_batch()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._send_batch)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # Лид, который еще ждет пачку, не должен уйти в AmoCRM после отмены:
+            # crm_outbox повторит его, и сделка задвоится
+            if entry in self._batch:
+                self._batch.remove(entry)
+            raise
+
+    def _send_batch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._batch = self._batch, []
+        if batch:
+            asyncio.get_running_loop().create_task(self._deliver(batch))
+
+    async def _deliver(self, batch):
+        if not self.breaker.allow():
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(CircuitOpen(f"{self.breaker.name}: предохранитель разомкнут"))
+            return
+
+        self.batches += 1
+        self.leads += len(batch)
+        leads = [lead_info for lead_info, _ in batch]
+        try:
+            client = self.client or get_http_client()
+            # Ограничитель считает HTTP-запросы, а не пачки: пачка — это до двух POST
+            # (и повторы без отклоненных элементов) плюс страницы списка полей
+            field_ids = await self.fields.get(client, self.limiter)
+            contacts = await self._known_contacts(leads)
+            results = await send_leads_to_amocrm(leads, client, field_ids, contacts, self.limiter)
+        except Exception as e:
+            results = [{'success': False, 'error': str(e), 'status': None}] * len(batch)
+        self._observe(results)
+        if any(result.get('status') == 400 for result in results):
+            self.fields.invalidate()
+        await self._remember_contacts(leads, results)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _known_contacts(self, leads):
+        """Контакты пользователей пачки из crm_contacts (один запрос)"""
+        import database_async
+
+        user_ids = [lead_info['user_id'] for lead_info in leads if lead_info.get('user_id')]
+        try:
+            return await database_async.get_crm_contacts(AmoCrmSink.name, user_ids)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось прочитать контакты AmoCRM: {e}")
+            return {}
+
+    async def _remember_contacts(self, leads, results):
+        import database_async
+
+        contacts = [
+            (lead_info['user_id'], result['contact_id'], result.get('lead_id'))
+            for lead_info, result in zip(leads, results)
+            if result['success'] and result.get('contact_id') and lead_info.get('user_id')
         ]
+        if not contacts:
+            return
+        try:
+            await database_async.save_crm_contacts(AmoCrmSink.name, contacts)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить контакты AmoCRM: {e}")
+
+    def _observe(self, results):
+        """Обновить предохранитель и ограничитель по ответу CRM"""
+        failed = [result for result in results if not result['success']]
+        statuses = {result.get('status') for result in failed}
+        if 429 in statuses:
+            # CRM жива, но просит реже: это забота ограничителя, не предохранителя
+            self.limiter.throttle(max((result.get('retry_after') or 0) for result in failed) or None)
+            self.breaker.record_success()
+        elif len(failed) == len(results) and any(status is None or status >= 500 for status in statuses):
+            # Таймаут, обрыв соединения или 5xx
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+            self.limiter.recover()
+
+    def stats(self):
+        """Сколько запросов и лидов отправлено, состояние предохранителя и ограничителя"""
+        return {
+            'batches': self.batches,
+            'leads': self.leads,
+            'avg_batch': self.leads / self.batches if self.batches else 0.0,
+            'breaker': self.breaker.stats(),
+            'limiter': self.limiter.stats(),
+            'fields': self.fields.stats()
+        }
+
+
+amocrm_batcher = AmoCrmBatcher()
+
 
-        logger.info(f"📊 Лид для Google Sheets: {lead_row}")
+def build_bitrix24_lead(lead_info):
+    """Поля для crm.lead.add"""
+    pain_text, time_text, emotion_text = lead_labels(lead_info)
+    username = lead_info.get('username') or 'no_username'
+    return {
+        'TITLE': f"Вайб-лид: {lead_info.get('first_name', 'Неизвестно')}",
+        'NAME': lead_info.get('first_name', ''),
+        'SOURCE_DESCRIPTION': f"Telegram: @{username}, ID {lead_info.get('user_id', '')}",
+        'IM': [{'VALUE': username, 'VALUE_TYPE': 'TELEGRAM'}],
+        'COMMENTS': (
+            f"Основная проблема: {pain_text}\n"
+            f"Время на рутину: {time_text}\n"
+            f"Эмоциональное состояние: {emotion_text}"
+        )
+    }
 
-        # Здесь должна быть логика добавления в таблицу
-        # Пример: sheet.append_row(lead_row)
 
-        return {'success': True, 'message': 'Logged for Google Sheets'}
+async def send_to_bitrix24(lead_info, client):
+    """Отправка лида в Bitrix24 через входящий вебхук (crm.lead.add)"""
+    try:
+        response = await client.post('crm.lead.add.json', json={
+            'fields': build_bitrix24_lead(lead_info),
+            'params': {'REGISTER_SONET_EVENT': 'N'}
+        })
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+
+        if response.status_code == 200 and body.get('result'):
+            logger.info(f"✅ Лид успешно отправлен в Bitrix24: {lead_info.get('first_name')}")
+            return {'success': True, 'lead_id': body['result']}
+
+        error = body.get('error_description') or body.get('error') or response.text
+        logger.error(f"❌ Ошибка отправки в Bitrix24: {response.status_code} - {error}")
+        return {'success': False, 'error': error, 'status': response.status_code}
+
+    except Exception as e:
+        logger.error(f"❌ Исключение при отправке в Bitrix24: {e}")
+        return {'success': False, 'error': str(e), 'status': None}
+
+
+def build_sheet_row(lead_info):
+    """Строка таблицы Google Sheets для лида"""
+    from datetime import datetime
+
+    return [
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        lead_info.get('first_name', ''),
+        lead_info.get('username', ''),
+        lead_info.get('user_id', ''),
+        lead_info.get('pain_point', ''),
+        lead_info.get('time_spent', ''),
+        lead_info.get('emotion', '')
+    ]
+
+
+def send_to_google_sheets(lead_info):
+    """
+    Отправка лида в Google Sheets
+    Простое решение для старта без настройки CRM
+
+    Строка ставится в буфер sheets_appender (и в локальный файл), а в
+    таблицу строки уходят пачками — см. sheets_appender.py
+    """
+    from sheets_appender import sheets_appender
+
+    try:
+        sheets_appender.add(build_sheet_row(lead_info))
+        return {'success': True, 'message': 'Строка поставлена в очередь Google Sheets'}
 
     except Exception as e:
         logger.error(f"Ошибка отправки в Google Sheets: {e}")
         return {'success': False, 'error': str(e)}
 
 
-def send_notification_to_telegram(admin_chat_id, lead_info):
+# ==================== СИСТЕМЫ-ПРИЕМНИКИ ЛИДОВ ====================
+# Каждая система — LeadSink с именем из CRM_SINKS. crm_outbox заводит
+# на каждый лид отдельную строку для каждой включенной системы, поэтому
+# повторы, таймауты и dead-letter у систем независимы. Свою систему можно
+# подключить через register_sink('имя', фабрика) и добавить имя в CRM_SINKS.
+
+class LeadSink:
+    """Система, в которую отправляются лиды"""
+
+    name = None
+
+    def __init__(self, timeout=CRM_SINK_TIMEOUT):
+        self.timeout = timeout  # None — без общего таймаута
+
+    async def send(self, lead_info):
+        """Отправить лид; вернуть {'success': bool, ...} или бросить CircuitOpen"""
+        raise NotImplementedError
+
+    async def close(self):
+        """Освободить соединения при остановке бота"""
+
+    def stats(self):
+        return {}
+
+
+class AmoCrmSink(LeadSink):
     """
-    Отправка уведомления админу в Telegram о новом лиде
+    AmoCRM: лиды собираются в пачки, запросы идут через общий клиент
+
+    Общего таймаута у системы нет: ушедшую пачку AmoCRM может принять и после
+    него, а повтор из crm_outbox создал бы вторую сделку. Исход решает ответ
+    на пачку, а время запроса ограничивают таймауты HTTP-клиента.
     """
-    from telegram import Bot
-    from config import TELEGRAM_BOT_TOKEN
 
-    try:
-        bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    name = 'amocrm'
 
-        message = f"""
-🎯 **Новый лид из Вайб-Компаса!**
+    def __init__(self, batcher=None, timeout=None):
+        super().__init__(timeout)
+        self.batcher = batcher or amocrm_batcher
 
-👤 Имя: {lead_info.get('first_name', 'Неизвестно')}
-📱 Telegram: @{lead_info.get('username', 'нет username')}
-🆔 ID: {lead_info.get('user_id', '')}
+    async def send(self, lead_info):
+        return await self.batcher.submit(lead_info)
 
-📋 Проблема: {lead_info.get('pain_point', '')}
-⏰ Время на рутину: {lead_info.get('time_spent', '')}
-😔 Состояние: {lead_info.get('emotion', '')}
-        """
+    def stats(self):
+        return self.batcher.stats()
 
-        bot.send_message(chat_id=admin_chat_id, text=message, parse_mode='Markdown')
-        logger.info(f"✅ Уведомление отправлено админу")
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка отправки уведомления: {e}")
+class Bitrix24Sink(LeadSink):
+    """Bitrix24 через входящий вебхук, со своим клиентом и предохранителем"""
+
+    name = 'bitrix24'
+
+    def __init__(self, webhook_url=BITRIX24_WEBHOOK_URL, client=None, breaker=None, timeout=CRM_SINK_TIMEOUT):
+        super().__init__(timeout)
+        self.webhook_url = webhook_url
+        self.client = client
+        self._own_client = client is None
+        self.breaker = breaker or CircuitBreaker('Bitrix24', CRM_BREAKER_FAILURES, CRM_BREAKER_RESET_TIMEOUT)
+
+    async def send(self, lead_info):
+        if not self.webhook_url and self.client is None:
+            return {'success': False, 'error': 'BITRIX24_WEBHOOK_URL не задан'}
+        self.breaker.check()
+        if self.client is None:
+            self.client = create_http_client(base_url=self.webhook_url.rstrip('/') + '/')
+
+        try:
+            result = await send_to_bitrix24(lead_info, self.client)
+        except BaseException:
+            # Отмена по таймауту deliver_to_sink: без записи пробный запрос half_open
+            # так и числился бы в полете, и предохранитель отклонял бы все следующие
+            self.breaker.record_failure()
+            raise
+        if not result['success'] and (result.get('status') is None or result['status'] >= 500):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return result
+
+    async def close(self):
+        if self._own_client and self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def stats(self):
+        return {'breaker': self.breaker.stats()}
+
+
+class GoogleSheetsSink(LeadSink):
+    """
+    Google Sheets: лид считается принятым, когда строка сохранена в буфере
+    sheets_appender — дальше за отправку отвечает он
+    """
+
+    name = 'google_sheets'
+
+    async def send(self, lead_info):
+        return send_to_google_sheets(lead_info)
+
+    def stats(self):
+        from sheets_appender import sheets_appender
+        return sheets_appender.stats()
+
+
+class LogSink(LeadSink):
+    """Лид только пишется в лог — поведение, когда CRM не настроена"""
+
+    name = 'log'
+
+    async def send(self, lead_info):
+        logger.info(f"📋 Новый лид (CRM не настроена): {lead_info}")
+        return {'success': True, 'message': 'CRM не настроена, лид залогирован'}
+
+
+class FunctionSink(LeadSink):
+    """Система из обычной функции: синхронная выполняется в пуле потоков"""
+
+    def __init__(self, name, func, timeout=CRM_SINK_TIMEOUT):
+        super().__init__(timeout)
+        self.name = name
+        self.func = func
+
+    async def send(self, lead_info):
+        if asyncio.iscoroutinefunction(self.func):
+            return await self.func(lead_info)
+        return await blocking_pool.run(self.func, lead_info)
+
+
+SINK_TYPES = {sink.name: sink for sink in (AmoCrmSink, Bitrix24Sink, GoogleSheetsSink, LogSink)}
+
+_sinks = None
+
+
+def register_sink(name, factory):
+    """Добавить тип системы: factory() возвращает LeadSink"""
+    SINK_TYPES[name] = factory
+
+
+def build_sinks(names=CRM_SINKS):
+    """Создать системы по списку имен"""
+    sinks = {}
+    for name in names:
+        if name not in SINK_TYPES:
+            logger.error(f"❌ Неизвестная система для лидов: {name}. Доступны: {', '.join(SINK_TYPES)}")
+            continue
+        sinks[name] = SINK_TYPES[name]()
+    return sinks
+
+
+def get_sinks():
+    """Системы из CRM_SINKS (создаются один раз)"""
+    global _sinks
+    if _sinks is None:
+        _sinks = build_sinks()
+    return _sinks
+
+
+async def close_sinks():
+    """Закрыть соединения всех систем (вызывается при остановке бота)"""
+    global _sinks
+    if _sinks is not None:
+        for sink in _sinks.values():
+            await sink.close()
+        _sinks = None
+
+
+async def deliver_to_sink(sink, lead_info):
+    """Отправить лид в одну систему с ее таймаутом; CircuitOpen пробрасывается"""
+    try:
+        return await asyncio.wait_for(sink.send(lead_info), sink.timeout)
+    except asyncio.TimeoutError:
+        return {'success': False, 'error': f"{sink.name}: нет ответа за {sink.timeout:.0f} с", 'status': None}
 
 
 # ==================== WEBHOOK для получения обновлений из CRM ====================
 
-def setup_webhook(webhook_url):
+async def setup_webhook(webhook_url, client=None):
     """
-    Настройка webhook для получения обновлений из CRM
-    Например, когда менеджер обработал лида
+    Подписка на смену статусов сделок AmoCRM (POST /api/v4/webhooks)
+
+    Повторная подписка на тот же адрес только обновляет настройки, поэтому
+    вызывается при каждом запуске. События принимает crm_webhook.py
     """
-    # Здесь можно настроить webhook в CRM системе
-    pass
+    try:
+        client = client or get_http_client()
+        response = await client.post('/api/v4/webhooks', json={
+            'destination': webhook_url,
+            'settings': ['status_lead']
+        })
+        if response.status_code in [200, 201]:
+            logger.info("✅ Вебхук AmoCRM о смене статусов сделок подключен")
+            return True
+        logger.error(f"❌ Не удалось подключить вебхук AmoCRM: {response.status_code} - {response.text}")
+    except Exception as e:
+        logger.error(f"❌ Исключение при подключении вебхука AmoCRM: {e}")
+    return False
@@ -0,0 +1,152 @@
+"""
+Фоновая отправка лидов из crm_outbox в CRM
+
+Обработчик конверсии только кладет лид в буфер записи, а в БД он
+попадает в crm_outbox одной транзакцией с отметкой 'converted' — по
+строке на каждую систему из CRM_SINKS. У каждой системы свой цикл:
+раз в CRM_OUTBOX_POLL_INTERVAL секунд он забирает ее лиды, которым пора,
+и отправляет их с таймаутом системы, поэтому медленная CRM не задерживает
+остальные. Неудачная попытка откладывается с экспоненциальной паузой и
+случайным разбросом, после CRM_OUTBOX_MAX_ATTEMPTS попыток лид уходит
+в crm_dead_letters, откуда его возвращает команда /replay_leads.
+"""
+import asyncio
+import logging
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+
+from config import (
+    CRM_OUTBOX_POLL_INTERVAL,
+    CRM_OUTBOX_BATCH_SIZE,
+    CRM_OUTBOX_MAX_ATTEMPTS,
+    CRM_OUTBOX_BACKOFF_BASE,
+    CRM_OUTBOX_BACKOFF_MAX
+)
+import database_async
+from blocking_pool import PoolSaturated
+from resilience import CircuitOpen
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxDispatcher:
+    """Отправка лидов из crm_outbox с повторами и dead-letter, отдельно по системам"""
+
+    def __init__(self, sinks=None, poll_interval=CRM_OUTBOX_POLL_INTERVAL,
+                 batch_size=CRM_OUTBOX_BATCH_SIZE, max_attempts=CRM_OUTBOX_MAX_ATTEMPTS,
+                 backoff_base=CRM_OUTBOX_BACKOFF_BASE, backoff_max=CRM_OUTBOX_BACKOFF_MAX):
+        self._sinks = sinks  # имя -> LeadSink; по умолчанию системы из CRM_SINKS
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.sent = Counter()
+        self.retried = Counter()
+        self.dead = Counter()
+        self._wakeup = {}
+        self._tasks = []
+        self._stopping = False
+
+    @property
+    def sinks(self):
+        if self._sinks is None:
+            from crm_integration import get_sinks
+            self._sinks = get_sinks()
+        return self._sinks
+
+    def backoff(self, attempts):
+        """Пауза перед попыткой номер attempts + 1: половина фиксированная, половина случайная"""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _deliver(self, sink, outbox_id, user_id, lead_info, attempts):
+        from crm_integration import deliver_to_sink
+        try:
+            result = await deliver_to_sink(sink, lead_info)
+            error = None if result and result.get('success') else str((result or {}).get('error', 'нет ответа'))
+        except (PoolSaturated, CircuitOpen):
+            # Пул занят или система отключена предохранителем — попытка не засчитывается,
+            # лид остается в outbox до следующего цикла
+            return
+        except Exception as e:
+            error = str(e)
+
+        if error is None:
+            await database_async.complete_outbox(outbox_id, user_id)
+            self.sent[sink.name] += 1
+            logger.info(f"Лид {user_id} отправлен в {sink.name}")
+            return
+
+        attempts += 1
+        if attempts >= self.max_attempts:
+            await database_async.dead_letter_outbox(outbox_id, error)
+            self.dead[sink.name] += 1
+            logger.error(f"❌ Лид {user_id} не отправлен в {sink.name} за {attempts} попыток, "
+                         f"перенесен в dead-letter: {error}")
+        else:
+            next_attempt_at = datetime.now() + timedelta(seconds=self.backoff(attempts))
+            await database_async.retry_outbox(outbox_id, error, next_attempt_at)
+            self.retried[sink.name] += 1
+            logger.warning(f"Лид {user_id} -> {sink.name}: попытка {attempts} не удалась ({error}), "
+                           f"повтор в {next_attempt_at:%H:%M:%S}")
+
+    async def dispatch_sink(self, name):
+        """Отправить лиды системы name, которым пора; возвращает их количество"""
+        sink = self.sinks[name]
+        due = await database_async.due_outbox(name, datetime.now(), self.batch_size)
+        await asyncio.gather(*(self._deliver(sink, *row) for row in due))
+        return len(due)
+
+    async def dispatch_once(self):
+        """Один проход по всем системам одновременно; возвращает число лидов"""
+        counts = await asyncio.gather(*(self.dispatch_sink(name) for name in self.sinks))
+        return sum(counts)
+
+    async def _run(self, name):
+        wakeup = self._wakeup[name]
+        while not self._stopping:
+            try:
+                await self.dispatch_sink(name)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки очереди {name}: {e}")
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+
+    def wakeup(self):
+        """Не ждать конца паузы (например, после /replay_leads)"""
+        for event in self._wakeup.values():
+            event.set()
+
+    async def start(self):
+        """Запустить фоновую отправку: по циклу на систему"""
+        if not self._tasks:
+            self._stopping = False
+            for name in self.sinks:
+                self._wakeup[name] = asyncio.Event()
+                self._tasks.append(asyncio.create_task(self._run(name)))
+
+    async def stop(self):
+        """Остановить фоновую отправку (неотправленные лиды остаются в БД)"""
+        if self._tasks:
+            # Текущие пачки доотправляем, чтобы не прервать запрос на середине
+            self._stopping = True
+            self.wakeup()
+            await asyncio.gather(*self._tasks)
+            self._tasks = []
+            self._wakeup = {}
+
+    def stats(self):
+        """Счетчики с момента запуска: имя системы -> {sent, retried, dead}"""
+        return {
+            name: {'sent': self.sent[name], 'retried': self.retried[name], 'dead': self.dead[name]}
+            for name in self.sinks
+        }
+
+
+outbox_dispatcher = OutboxDispatcher()
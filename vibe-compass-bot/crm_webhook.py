@@ -0,0 +1,184 @@
+"""
+Прием вебхуков AmoCRM о смене статуса сделок
+
+Когда менеджер двигает сделку по воронке, AmoCRM присылает POST
+(application/x-www-form-urlencoded) с полями leads[status][N][...].
+Обработчик только проверяет секрет, разбирает события и кладет их
+в буфер — ответ уходит сразу. Фоновая задача раз в CRM_WEBHOOK_FLUSH_MS
+миллисекунд (или по CRM_WEBHOOK_BATCH_SIZE событий) применяет буфер
+одной транзакцией: пакетный UPDATE conversion_status в users. Каждое
+событие применяется один раз: его ID запоминается в crm_webhook_events
+той же транзакцией, поэтому повторная доставка ничего не меняет.
+"""
+import asyncio
+import hmac
+import logging
+import re
+
+from config import (
+    CRM_WEBHOOK_PATH,
+    CRM_WEBHOOK_SECRET,
+    CRM_WEBHOOK_FLUSH_MS,
+    CRM_WEBHOOK_BATCH_SIZE,
+    CRM_WEBHOOK_EVENT_TTL_DAYS,
+    AMOCRM_STATUS_MAP,
+    AMOCRM_STATUS_DEFAULT
+)
+import database_async
+from web_server import Response
+
+logger = logging.getLogger(__name__)
+
+STATUS_FIELD = re.compile(r'^leads\[status\]\[(\d+)\]\[(\w+)\]$')
+
+
+def parse_amocrm_status_events(form):
+    """
+    События смены статуса из тела вебхука: [(event_id, lead_id, status_id)]
+
+    У вебхуков AmoCRM нет собственного ID события, поэтому он составляется
+    из сделки, перехода и времени изменения (если AmoCRM его прислала)
+    """
+    items = {}
+    for key, value in form.items():
+        match = STATUS_FIELD.match(key)
+        if match:
+            items.setdefault(int(match.group(1)), {})[match.group(2)] = value
+
+    events = []
+    for _, item in sorted(items.items()):
+        if not item.get('id') or not item.get('status_id'):
+            continue
+        event_id = (
+            f"amocrm:{form.get('account[id]', '')}:{item['id']}:"
+            f"{item.get('old_status_id', '')}->{item['status_id']}:{item.get('last_modified', '')}"
+        )
+        events.append((event_id, int(item['id']), int(item['status_id'])))
+    return events
+
+
+class CrmWebhookReceiver:
+    """Буфер событий вебхуков CRM со сбросом пачками"""
+
+    sink = 'amocrm'
+
+    def __init__(self, secret=CRM_WEBHOOK_SECRET, status_map=AMOCRM_STATUS_MAP,
+                 default_status=AMOCRM_STATUS_DEFAULT, flush_interval=CRM_WEBHOOK_FLUSH_MS / 1000,
+                 max_batch=CRM_WEBHOOK_BATCH_SIZE, keep_days=CRM_WEBHOOK_EVENT_TTL_DAYS):
+        self.secret = secret
+        self.status_map = status_map  # status_id AmoCRM -> conversion_status
+        self.default_status = default_status
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.keep_days = keep_days
+
+        self._events = {}  # event_id -> (lead_id, conversion_status); повторы в буфере схлопываются
+        self._flush_lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+        self.received = 0
+        self.applied = 0
+        self.duplicates = 0
+        self.unknown_leads = 0
+        self.failures = 0
+
+    def conversion_status(self, status_id):
+        """conversion_status для статуса AmoCRM (None — статус не отслеживается)"""
+        return self.status_map.get(status_id, self.default_status)
+
+    def add(self, events):
+        """Поставить события [(event_id, lead_id, status_id)] в буфер"""
+        for event_id, lead_id, status_id in events:
+            status = self.conversion_status(status_id)
+            if status:
+                self._events[event_id] = (lead_id, status)
+                self.received += 1
+        if len(self._events) >= self.max_batch:
+            self._full.set()
+
+    @property
+    def pending(self):
+        return len(self._events)
+
+    async def handle(self, request):
+        """POST CRM_WEBHOOK_PATH?secret=...: принять события и сразу ответить"""
+        if not self.secret or not hmac.compare_digest(request.query.get('secret', ''), self.secret):
+            return Response(403)
+        try:
+            events = parse_amocrm_status_events(request.form())
+        except (ValueError, UnicodeDecodeError):
+            return Response(400)
+        self.add(events)
+        return Response(200, 'ok')
+
+    async def flush(self):
+        """Применить накопленные события одной транзакцией; возвращает число обновленных пользователей"""
+        async with self._flush_lock:
+            if not self._events:
+                return 0
+            events, self._events = self._events, {}
+            try:
+                result = await database_async.apply_crm_status_events(
+                    self.sink, [(event_id, lead_id, status) for event_id, (lead_id, status) in events.items()],
+                    self.keep_days
+                )
+            except Exception as e:
+                # Возвращаем пачку в буфер; события, пришедшие за это время, новее
+                self._events = {**events, **self._events}
+                self.failures += 1
+                logger.error(f"❌ Ошибка применения {len(events)} событий CRM: {e}")
+                raise
+
+            self.applied += len(result['applied'])
+            self.duplicates += result['duplicates']
+            self.unknown_leads += result['unknown_leads']
+            logger.info(f"🔄 Статусы из CRM: обновлено {len(result['applied'])} пользователей, "
+                        f"повторов {result['duplicates']}, неизвестных сделок {result['unknown_leads']}")
+            return len(result['applied'])
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # Пачка вернулась в буфер, повторим на следующем цикле
+                await asyncio.sleep(self.flush_interval)
+
+    def register(self, server, path=CRM_WEBHOOK_PATH):
+        """Подключить прием вебхуков к HTTP-серверу"""
+        server.route('POST', path, self.handle)
+
+    async def start(self):
+        """Запустить фоновое применение событий"""
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую задачу, применив оставшиеся события"""
+        if self._task is not None:
+            self._stopping = True
+            self._full.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            'pending': len(self._events),
+            'received': self.received,
+            'applied': self.applied,
+            'duplicates': self.duplicates,
+            'unknown_leads': self.unknown_leads,
+            'failures': self.failures
+        }
+
+
+crm_webhook_receiver = CrmWebhookReceiver()
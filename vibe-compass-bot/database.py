@@ -8,15 +8,76 @@ import os
 if sys.platform == 'win32':
     os.environ['PYTHONIOENCODING'] = 'utf-8'
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text
+from sqlalchemy import create_engine, event, inspect, Column, Integer, SmallInteger, String, DateTime, Boolean, Text, select, bindparam, func, delete, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
-from config import DATABASE_URL
+from datetime import datetime, timedelta
+from collections import Counter
+import json
+import logging
+from dataclasses import dataclass
+from config import (
+    DATABASE_URL,
+    DB_PROFILE,
+    SQLITE_BUSY_TIMEOUT_MS,
+    SQLITE_MMAP_SIZE,
+    SQLITE_CACHE_SIZE_KB,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_RECYCLE,
+    CRM_SINKS,
+    AMOCRM_STATUS_MAP,
+    AMOCRM_STATUS_DEFAULT
+)
+
+logger = logging.getLogger(__name__)
+
+
+def engine_options(url, profile=DB_PROFILE):
+    """Параметры create_engine для профиля (общие для sync и async движков)"""
+    if profile != 'production' or url.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': True
+    }
+
+
+def apply_engine_profile(engine, profile=DB_PROFILE):
+    """Настроить каждое новое соединение SQLite под профиль production"""
+    if profile != 'production' or engine.dialect.name != 'sqlite':
+        return
+    if engine.url.database in (None, '', ':memory:'):
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL: читатели не блокируются писателем, synchronous=NORMAL
+        # в WAL безопасен и убирает fsync на каждый коммит
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        # Отрицательное значение cache_size задается в килобайтах
+        cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
+
+def create_db_engine(url=DATABASE_URL, profile=DB_PROFILE):
+    """Создать синхронный движок с настройками профиля"""
+    engine = create_engine(url, **engine_options(url, profile))
+    apply_engine_profile(engine, profile)
+    return engine
+
 
 Base = declarative_base()
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(bind=engine)
+engine = create_db_engine()
+# expire_on_commit=False: хелперы возвращают объекты после закрытия сессии
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
 
 
 class User(Base):
@@ -29,16 +90,17 @@ class User(Base):
     first_name = Column(String(255))
     last_name = Column(String(255))
     created_at = Column(DateTime, default=datetime.now)
-    current_step = Column(String(50))
-    is_completed = Column(Boolean, default=False)
+    # Шаг, ответы и статус хранятся кодами из value_codes (см. ENCODED_COLUMNS)
+    current_step = Column(SmallInteger)
+    is_completed = Column(Boolean, default=False, index=True)
 
     # Ответы пользователя
-    emotion = Column(String(50))  # Эмоциональное состояние
-    pain_point = Column(String(50))  # Основная проблема
-    time_spent = Column(String(50))  # Часы в неделю
+    emotion = Column(SmallInteger)  # Эмоциональное состояние
+    pain_point = Column(SmallInteger, index=True)  # Основная проблема
+    time_spent = Column(SmallInteger)  # Часы в неделю
 
     # Результаты
-    conversion_status = Column(String(50))  # pending, contacted, converted
+    conversion_status = Column(SmallInteger, index=True)  # pending, contacted, converted
     lead_sent_to_crm = Column(Boolean, default=False)
 
     def __repr__(self):
@@ -50,39 +112,988 @@ class UserAnswer(Base):
     __tablename__ = 'user_answers'
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False)
-    question = Column(String(100))
-    answer = Column(Text)
+    user_id = Column(Integer, nullable=False, index=True)
+    question = Column(SmallInteger)  # код имени поля (emotion, pain_point, ...)
+    answer = Column(SmallInteger)  # код ответа
     timestamp = Column(DateTime, default=datetime.now)
 
     def __repr__(self):
         return f"<Answer {self.user_id} - {self.question}>"
 
 
+class ValueCode(Base):
+    """Словарь кодов: ключ ответа, шага или статуса -> небольшое целое"""
+    __tablename__ = 'value_codes'
+
+    code = Column(Integer, primary_key=True)
+    key = Column(String(100), unique=True, nullable=False)
+
+    def __repr__(self):
+        return f"<ValueCode {self.code} = {self.key}>"
+
+
+class FunnelCounter(Base):
+    """Счетчики воронки для /stats, обновляются вместе с users"""
+    __tablename__ = 'funnel_counters'
+
+    metric = Column(String(50), primary_key=True)  # users или имя колонки users
+    key = Column(String(100), primary_key=True)  # total/completed или значение колонки
+    value = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<Counter {self.metric}:{self.key} = {self.value}>"
+
+
+class CrmOutbox(Base):
+    """Лиды, ожидающие отправки в CRM (пишутся в одной транзакции с конверсией)"""
+    __tablename__ = 'crm_outbox'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    sink = Column(String(50), nullable=False, default='amocrm', index=True)  # имя системы из CRM_SINKS
+    payload = Column(Text, nullable=False)  # lead_info в JSON
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.now, index=True)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"<CrmOutbox {self.id} - {self.user_id} -> {self.sink}>"
+
+
+class CrmDeadLetter(Base):
+    """Лиды, которые не удалось отправить за CRM_OUTBOX_MAX_ATTEMPTS попыток"""
+    __tablename__ = 'crm_dead_letters'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    sink = Column(String(50), nullable=False, default='amocrm')
+    payload = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    last_error = Column(Text)
+    created_at = Column(DateTime)
+    failed_at = Column(DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"<CrmDeadLetter {self.id} - {self.user_id} -> {self.sink}>"
+
+
+class CrmContact(Base):
+    """Контакт пользователя в CRM: повторные лиды привязываются к нему, а не создают новый"""
+    __tablename__ = 'crm_contacts'
+
+    sink = Column(String(50), primary_key=True)  # имя системы из CRM_SINKS
+    user_id = Column(Integer, primary_key=True)  # Telegram ID
+    contact_id = Column(Integer, nullable=False)
+    lead_id = Column(Integer, index=True)  # последний созданный лид
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    def __repr__(self):
+        return f"<CrmContact {self.sink}:{self.user_id} -> {self.contact_id}>"
+
+
+class CrmWebhookEvent(Base):
+    """Уже примененные события вебхуков CRM: повторная доставка события ничего не меняет"""
+    __tablename__ = 'crm_webhook_events'
+
+    event_id = Column(String(200), primary_key=True)
+    received_at = Column(DateTime, nullable=False, default=datetime.now, index=True)
+
+    def __repr__(self):
+        return f"<CrmWebhookEvent {self.event_id}>"
+
+
+class ConversationState(Base):
+    """Состояние незавершенного диалога ConversationHandler (db_persistence.py)"""
+    __tablename__ = 'conversation_states'
+
+    name = Column(String(100), primary_key=True)  # имя ConversationHandler
+    key = Column(String(100), primary_key=True)  # ключ диалога в JSON, например [chat_id, user_id]
+    state = Column(Text, nullable=False)  # состояние в JSON
+    updated_at = Column(DateTime, nullable=False, default=datetime.now, index=True)
+
+    def __repr__(self):
+        return f"<ConversationState {self.name}:{self.key} = {self.state}>"
+
+
+class PersistedUserData(Base):
+    """context.user_data пользователя (db_persistence.py)"""
+    __tablename__ = 'persisted_user_data'
+
+    user_id = Column(Integer, primary_key=True)  # Telegram ID
+    data = Column(Text, nullable=False)  # словарь в JSON
+    updated_at = Column(DateTime, nullable=False, default=datetime.now, index=True)
+
+    def __repr__(self):
+        return f"<PersistedUserData {self.user_id}>"
+
+
+# Колонки users, по значениям которых ведутся счетчики воронки
+COUNTED_COLUMNS = ('current_step', 'emotion', 'pain_point', 'time_spent', 'conversion_status')
+
+# Колонки, которые хранятся кодами value_codes; наружу отдаются ключами
+ENCODED_COLUMNS = {
+    'users': ('current_step', 'emotion', 'pain_point', 'time_spent', 'conversion_status'),
+    'user_answers': ('question', 'answer')
+}
+
+# Разбивки в результате get_statistics -> колонка users
+STATS_BREAKDOWNS = {
+    'steps': 'current_step',
+    'pain_points': 'pain_point',
+    'emotions': 'emotion',
+    'time_spent': 'time_spent',
+    'conversion_statuses': 'conversion_status'
+}
+
+
+# ==================== СЛОВАРЬ КОДОВ ====================
+# Ключи вида 'pain_messages' или 'question_2' хранятся в БД небольшими
+# целыми: строки и индексы меньше, GROUP BY быстрее. Перевод происходит
+# только внутри этого модуля. Коды назначаются один раз и не меняются,
+# новые ключи получают следующий свободный код автоматически.
+
+_codes_by_key = {}
+_keys_by_code = {}
+
+
+def _known_values():
+    """Ключи из клавиатур и сообщений, которые получают коды заранее"""
+    from messages import EMOTION_RESPONSES, INSIGHTS
+
+    keys = list(EMOTION_RESPONSES) + list(INSIGHTS)
+    for insight in INSIGHTS.values():
+        keys += [key for key in insight['time_calculation'] if key not in keys]
+    keys += ['emotion', 'pain_point', 'time_spent']
+    keys += ['question_1', 'question_2', 'question_3', 'show_insight']
+    keys += ['pending', 'contacted', 'converted', 'pdf_downloaded', 'postponed']
+    # Статусы из вебхуков CRM (crm_webhook.py)
+    keys += [status for status in (*AMOCRM_STATUS_MAP.values(), AMOCRM_STATUS_DEFAULT) if status and status not in keys]
+    return keys
+
+
+def _load_codes(session):
+    for code, key in session.execute(select(ValueCode.code, ValueCode.key)):
+        _codes_by_key[key] = code
+        _keys_by_code[code] = key
+
+
+def _ensure_codes(session, keys):
+    """
+    Гарантировать коды для ключей
+
+    Новые коды фиксируются отдельным коммитом до основной записи, поэтому
+    вызывать в начале транзакции: откат основной записи не оставит
+    в памяти коды, которых нет в БД.
+    """
+    missing = [key for key in dict.fromkeys(keys) if key is not None and key not in _codes_by_key]
+    if not missing:
+        return
+
+    # Код мог назначить другой процесс
+    _load_codes(session)
+    missing = [key for key in missing if key not in _codes_by_key]
+    if not missing:
+        return
+
+    table = ValueCode.__table__
+    insert = _dialect_insert(session)
+    rows = [{'key': key} for key in missing]
+    if insert is not None:
+        session.execute(insert(table).on_conflict_do_nothing(index_elements=['key']), rows)
+    else:
+        session.execute(table.insert(), rows)
+    session.commit()
+    _load_codes(session)
+
+
+def _encode(key):
+    return None if key is None else _codes_by_key[key]
+
+
+def _decode(session, code):
+    if code is None:
+        return None
+    if isinstance(code, str):
+        return code  # колонка еще не переведена на коды (миграции до версии 3)
+    key = _keys_by_code.get(code)
+    if key is None:
+        _load_codes(session)
+        key = _keys_by_code.get(code)
+    return key
+
+
+def _encode_values(table_name, values):
+    """Закодировать значения колонок, которые хранятся кодами"""
+    encoded = ENCODED_COLUMNS[table_name]
+    return {column: _encode(value) if column in encoded else value for column, value in values.items()}
+
+
+def _decode_values(session, table_name, values):
+    """Раскодировать значения колонок, которые хранятся кодами"""
+    encoded = ENCODED_COLUMNS[table_name]
+    return {column: _decode(session, value) if column in encoded else value for column, value in values.items()}
+
+
+def _dialect_insert(session):
+    """INSERT с поддержкой ON CONFLICT для текущего диалекта (или None)"""
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    return None
+
+
+@dataclass(frozen=True, slots=True)
+class UserSnapshot:
+    """
+    Неизменяемый снимок пользователя для обработчиков
+
+    Легче ORM-объекта User (нет инструментирования и identity map)
+    и безопасен после закрытия сессии: ленивых загрузок нет.
+    """
+    user_id: int
+    username: str = None
+    first_name: str = None
+    last_name: str = None
+    current_step: str = None
+    is_completed: bool = False
+    emotion: str = None
+    pain_point: str = None
+    time_spent: str = None
+    conversion_status: str = None
+    lead_sent_to_crm: bool = False
+
+    def __repr__(self):
+        return f"<UserSnapshot {self.user_id} - {self.first_name}>"
+
+
+# Колонки users, которые читаются в снимок (без загрузки ORM-объекта)
+SNAPSHOT_COLUMNS = [getattr(User, field) for field in UserSnapshot.__dataclass_fields__]
+
+
+def _load_snapshot(session, user_id):
+    row = session.execute(select(*SNAPSHOT_COLUMNS).where(User.user_id == user_id)).first()
+    if row is None:
+        return None
+    return UserSnapshot(**_decode_values(session, 'users', row._mapping))
+
+
+class SchemaVersion(Base):
+    """Примененные миграции схемы"""
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String(255))
+    applied_at = Column(DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"<SchemaVersion {self.version}>"
+
+
 def init_db():
     """Инициализация базы данных"""
+    # create_all создает недостающие таблицы, но не меняет существующие:
+    # изменения схемы рабочих БД доезжают через миграции
     Base.metadata.create_all(engine)
+    run_migrations()
     print("✅ База данных инициализирована")
 
 
-def get_or_create_user(user_id, username=None, first_name=None, last_name=None):
-    """Получить или создать пользователя"""
+# ==================== МИГРАЦИИ ====================
+# Каждая миграция — функция, принимающая сессию. Миграции выполняются
+# по порядку версий при старте и должны быть идемпотентными: на свежей БД
+# create_all уже создал актуальную схему, а миграция все равно запускается.
+
+def _migration_seed_funnel_counters(session):
+    has_counters = session.scalar(select(func.count()).select_from(FunnelCounter)) > 0
+    if not has_counters:
+        _rebuild_funnel_counters(session)
+
+
+def _migration_add_indexes(session):
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_user_answers_user_id ON user_answers (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_users_pain_point ON users (pain_point)",
+        "CREATE INDEX IF NOT EXISTS ix_users_is_completed ON users (is_completed)",
+        "CREATE INDEX IF NOT EXISTS ix_users_conversion_status ON users (conversion_status)",
+    ):
+        session.execute(text(statement))
+
+
+def _migration_encode_values(session):
+    _ensure_codes(session, _known_values())
+
+    inspector = inspect(session.get_bind())
+    for table_name, columns in ENCODED_COLUMNS.items():
+        column_types = {column['name']: column['type'] for column in inspector.get_columns(table_name)}
+        index_names = {index['name'] for index in inspector.get_indexes(table_name)}
+
+        for column in columns:
+            if isinstance(column_types[column], Integer):
+                continue  # уже коды (свежая БД)
+
+            existing_values = session.scalars(
+                text(f"SELECT DISTINCT {column} FROM {table_name} WHERE {column} IS NOT NULL")
+            ).all()
+            _ensure_codes(session, existing_values)
+
+            # Переносим значения в новую целочисленную колонку и подменяем ею старую.
+            # Работает и в SQLite (>= 3.35), и в PostgreSQL
+            index_name = f"ix_{table_name}_{column}"
+            session.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column}__code SMALLINT"))
+            session.execute(text(
+                f"UPDATE {table_name} SET {column}__code = "
+                f"(SELECT code FROM value_codes WHERE value_codes.key = {table_name}.{column})"
+            ))
+            if index_name in index_names:
+                session.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+            session.execute(text(f"ALTER TABLE {table_name} DROP COLUMN {column}"))
+            session.execute(text(f"ALTER TABLE {table_name} RENAME COLUMN {column}__code TO {column}"))
+            if index_name in index_names:
+                session.execute(text(f"CREATE INDEX {index_name} ON {table_name} ({column})"))
+
+
+def _migration_outbox_sinks(session):
+    # Лиды, поставленные в очередь до появления нескольких систем, шли в AmoCRM
+    inspector = inspect(session.get_bind())
+    for table_name in ('crm_outbox', 'crm_dead_letters'):
+        columns = {column['name'] for column in inspector.get_columns(table_name)}
+        if 'sink' not in columns:
+            session.execute(text(f"ALTER TABLE {table_name} ADD COLUMN sink VARCHAR(50) NOT NULL DEFAULT 'amocrm'"))
+    session.execute(text("CREATE INDEX IF NOT EXISTS ix_crm_outbox_sink ON crm_outbox (sink)"))
+
+
+def _migration_crm_contacts_lead_index(session):
+    # Вебхуки AmoCRM находят пользователя по ID сделки
+    session.execute(text("CREATE INDEX IF NOT EXISTS ix_crm_contacts_lead_id ON crm_contacts (lead_id)"))
+
+
+MIGRATIONS = [
+    (1, 'Заполнение счетчиков воронки из users', _migration_seed_funnel_counters),
+    (2, 'Индексы для фильтров по users и user_answers', _migration_add_indexes),
+    (3, 'Ответы, шаги и статусы хранятся целыми кодами', _migration_encode_values),
+    (4, 'Очередь CRM по системам-приемникам', _migration_outbox_sinks),
+    (5, 'Индекс сделок CRM для вебхуков', _migration_crm_contacts_lead_index),
+]
+
+
+def run_migrations():
+    """Применить миграции, которых еще нет в schema_version"""
+    # Словарь кодов перечитывается из той БД, которую мигрируем
+    _codes_by_key.clear()
+    _keys_by_code.clear()
+
     session = SessionLocal()
     try:
-        user = session.query(User).filter_by(user_id=user_id).first()
-
-        if not user:
-            user = User(
-                user_id=user_id,
-                username=username,
-                first_name=first_name,
-                last_name=last_name
-            )
-            session.add(user)
+        current = session.scalar(select(func.max(SchemaVersion.version))) or 0
+        for version, description, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            migrate(session)
+            session.add(SchemaVersion(version=version, description=description))
             session.commit()
-            print(f"✅ Создан новый пользователь: {first_name} ({user_id})")
+            print(f"✅ Миграция {version}: {description}")
+    finally:
+        session.close()
+
+
+# ==================== СЧЕТЧИКИ ВОРОНКИ ====================
+
+def _counted_values(session, user):
+    """Значения users (ключами, не кодами), от которых зависят счетчики"""
+    values = {column: _decode(session, getattr(user, column)) for column in COUNTED_COLUMNS}
+    values['is_completed'] = bool(user.is_completed)
+    return values
+
+
+def _counter_deltas(old, new):
+    """
+    Изменения счетчиков при переходе строки users из old в new
+
+    old=None означает, что пользователь только что создан.
+    """
+    deltas = Counter()
+    if old is None:
+        deltas[('users', 'total')] += 1
+        old = {}
 
-        return user
+    if new.get('is_completed') and not old.get('is_completed'):
+        deltas[('users', 'completed')] += 1
+
+    for column in COUNTED_COLUMNS:
+        before, after = old.get(column), new.get(column)
+        if before != after:
+            if before is not None:
+                deltas[(column, before)] -= 1
+            if after is not None:
+                deltas[(column, after)] += 1
+
+    return deltas
+
+
+def _bump_counters(session, deltas):
+    """Прибавить изменения к счетчикам в текущей транзакции"""
+    rows = [
+        {'metric': metric, 'key': key, 'value': delta}
+        for (metric, key), delta in deltas.items()
+        if delta
+    ]
+    if not rows:
+        return
+
+    table = FunnelCounter.__table__
+    insert = _dialect_insert(session)
+    if insert is not None:
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=['metric', 'key'],
+            set_={'value': table.c.value + statement.excluded.value}
+        )
+        session.execute(statement, rows)
+        return
+
+    for row in rows:
+        result = session.execute(
+            table.update()
+            .where(table.c.metric == row['metric'], table.c.key == row['key'])
+            .values(value=table.c.value + row['value'])
+        )
+        if result.rowcount == 0:
+            session.execute(table.insert().values(**row))
+
+
+def _change_user(session, user, **values):
+    """Изменить колонки пользователя и счетчики воронки (коды уже назначены)"""
+    old = _counted_values(session, user)
+    for column, value in _encode_values('users', values).items():
+        setattr(user, column, value)
+    _bump_counters(session, _counter_deltas(old, {**old, **values}))
+
+
+def _scan_counters(session):
+    """Посчитать счетчики воронки полным проходом по users"""
+    rows = session.execute(
+        select(User.is_completed, *(getattr(User, column) for column in COUNTED_COLUMNS), func.count())
+        .group_by(User.is_completed, *(getattr(User, column) for column in COUNTED_COLUMNS))
+    ).all()
+
+    counters = Counter()
+    for is_completed, *values, count in rows:
+        counters[('users', 'total')] += count
+        if is_completed:
+            counters[('users', 'completed')] += count
+        for column, value in zip(COUNTED_COLUMNS, values):
+            if value is not None:
+                counters[(column, _decode(session, value))] += count
+
+    return counters
+
+
+def _rebuild_funnel_counters(session):
+    counters = _scan_counters(session)
+    session.execute(delete(FunnelCounter))
+    if counters:
+        session.execute(
+            FunnelCounter.__table__.insert(),
+            [{'metric': metric, 'key': key, 'value': value} for (metric, key), value in counters.items()]
+        )
+    session.commit()
+    return counters[('users', 'total')]
+
+
+# ==================== ПОЛЬЗОВАТЕЛИ И ОТВЕТЫ ====================
+
+def _get_or_create_user(session, user_id, username=None, first_name=None, last_name=None):
+    insert = _dialect_insert(session)
+    if insert is None:
+        return _select_or_insert_user(session, user_id, username, first_name, last_name)
+
+    # Один атомарный INSERT ... ON CONFLICT DO UPDATE: без гонки по unique(user_id)
+    # при параллельных /start и без лишнего SELECT для вернувшихся пользователей.
+    # created_at при конфликте не меняется, поэтому по нему видно, была ли вставка
+    created_at = datetime.now()
+    statement = insert(User.__table__).values(
+        user_id=user_id,
+        username=username,
+        first_name=first_name,
+        last_name=last_name,
+        created_at=created_at,
+        is_completed=False,
+        lead_sent_to_crm=False
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={
+            'username': statement.excluded.username,
+            'first_name': statement.excluded.first_name,
+            'last_name': statement.excluded.last_name
+        }
+    ).returning(User.created_at, *SNAPSHOT_COLUMNS)
+
+    row = session.execute(statement).one()
+    values = dict(row._mapping)
+    created = values.pop('created_at') == created_at
+    if created:
+        _bump_counters(session, _counter_deltas(None, {'is_completed': False}))
+    session.commit()
+
+    if created:
+        print(f"✅ Создан новый пользователь: {first_name} ({user_id})")
+    return UserSnapshot(**_decode_values(session, 'users', values))
+
+
+def _select_or_insert_user(session, user_id, username=None, first_name=None, last_name=None):
+    """get_or_create_user для диалектов без ON CONFLICT"""
+    user = _load_snapshot(session, user_id)
+
+    if not user:
+        user = UserSnapshot(
+            user_id=user_id,
+            username=username,
+            first_name=first_name,
+            last_name=last_name
+        )
+        session.execute(User.__table__.insert().values(
+            user_id=user_id,
+            username=username,
+            first_name=first_name,
+            last_name=last_name,
+            is_completed=False,
+            lead_sent_to_crm=False
+        ))
+        _bump_counters(session, _counter_deltas(None, {'is_completed': False}))
+        session.commit()
+        print(f"✅ Создан новый пользователь: {first_name} ({user_id})")
+
+    return user
+
+
+def _update_user_step(session, user_id, step):
+    _ensure_codes(session, [step])
+    user = session.query(User).filter_by(user_id=user_id).first()
+    if user:
+        _change_user(session, user, current_step=step)
+        session.commit()
+
+
+def _save_answer(session, user_id, field, value):
+    _ensure_codes(session, [field, value])
+    user = session.query(User).filter_by(user_id=user_id).first()
+    if user:
+        _change_user(session, user, **{field: value})
+
+        # Также сохраняем в таблицу ответов для аналитики
+        answer = UserAnswer(
+            user_id=user_id,
+            question=_encode(field),
+            answer=_encode(value)
+        )
+        session.add(answer)
+        session.commit()
+
+
+def _mark_completed(session, user_id, conversion_status='pending'):
+    _ensure_codes(session, [conversion_status])
+    user = session.query(User).filter_by(user_id=user_id).first()
+    if user:
+        _change_user(session, user, is_completed=True, conversion_status=conversion_status)
+        session.commit()
+
+
+def _apply_batch(session, user_updates, answers, leads=(), sinks=CRM_SINKS):
+    """
+    Применить пачку отложенных изменений одной транзакцией
+
+    Args:
+        user_updates (dict): user_id -> {колонка: значение}
+        answers (list): кортежи (user_id, question, answer, timestamp)
+        leads (list): кортежи (user_id, lead_info, timestamp) для crm_outbox
+        sinks (list): системы, в каждую из которых ставится лид
+    """
+    user_ids = set(user_updates) | {answer[0] for answer in answers} | {lead[0] for lead in leads}
+    if not user_ids:
+        return
+
+    encoded_users = ENCODED_COLUMNS['users']
+    keys = {answer[1] for answer in answers} | {answer[2] for answer in answers}
+    for values in user_updates.values():
+        keys.update(value for column, value in values.items() if column in encoded_users)
+    _ensure_codes(session, keys)
+
+    current = {
+        row.user_id: _decode_values(session, 'users', {
+            'is_completed': bool(row.is_completed),
+            **{column: getattr(row, column) for column in COUNTED_COLUMNS}
+        })
+        for row in session.execute(
+            select(User.user_id, User.is_completed, *(getattr(User, column) for column in COUNTED_COLUMNS))
+            .where(User.user_id.in_(user_ids))
+        )
+    }
+
+    # executemany требует одинаковый набор колонок, поэтому группируем по нему
+    groups = {}
+    deltas = Counter()
+    for user_id, values in user_updates.items():
+        if user_id in current:
+            groups.setdefault(tuple(sorted(values)), []).append({'b_user_id': user_id, **_encode_values('users', values)})
+            deltas.update(_counter_deltas(current[user_id], {**current[user_id], **values}))
+
+    users_table = User.__table__
+    for columns, params in groups.items():
+        statement = (
+            users_table.update()
+            .where(users_table.c.user_id == bindparam('b_user_id'))
+            .values({column: bindparam(column) for column in columns})
+        )
+        session.execute(statement, params)
+
+    # Также сохраняем в таблицу ответов для аналитики
+    answer_rows = [
+        {'user_id': user_id, 'question': _encode(question), 'answer': _encode(answer), 'timestamp': timestamp}
+        for user_id, question, answer, timestamp in answers
+        if user_id in current
+    ]
+    if answer_rows:
+        session.execute(UserAnswer.__table__.insert(), answer_rows)
+
+    # Лид попадает в outbox только вместе с отметкой о конверсии,
+    # по строке на каждую систему: повторы у систем независимы.
+    # Лид без строки пользователя тоже ставится: заявка важнее отметки
+    for user_id in {lead[0] for lead in leads} - set(current):
+        logger.error(f"❌ Лид {user_id}: пользователя нет в БД, лид поставлен в outbox без отметки о конверсии")
+    outbox_rows = [
+        {'user_id': user_id, 'sink': sink, 'payload': json.dumps(lead_info, ensure_ascii=False),
+         'attempts': 0, 'next_attempt_at': timestamp, 'created_at': timestamp}
+        for user_id, lead_info, timestamp in leads
+        for sink in sinks
+    ]
+    if outbox_rows:
+        session.execute(CrmOutbox.__table__.insert(), outbox_rows)
+
+    _bump_counters(session, deltas)
+    session.commit()
+
+
+def _get_user_data(session, user_id):
+    return _load_snapshot(session, user_id)
+
+
+def _get_statistics(session):
+    # Читаем готовые счетчики воронки вместо сканирования users.
+    # Новые значения (например, новые pain_*) появляются без правок кода
+    counters = {
+        (metric, key): value
+        for metric, key, value in session.execute(
+            select(FunnelCounter.metric, FunnelCounter.key, FunnelCounter.value)
+        )
+    }
+
+    total_users = counters.get(('users', 'total'), 0)
+    completed = counters.get(('users', 'completed'), 0)
+
+    breakdowns = {name: {} for name in STATS_BREAKDOWNS}
+    columns = {column: name for name, column in STATS_BREAKDOWNS.items()}
+    for (metric, key), value in counters.items():
+        if metric in columns and value > 0:
+            breakdowns[columns[metric]][key] = value
+
+    return {
+        'total_users': total_users,
+        'completed': completed,
+        'completion_rate': (completed / total_users * 100) if total_users > 0 else 0,
+        **breakdowns
+    }
+
+
+# ==================== CRM OUTBOX ====================
+
+def _due_outbox(session, sink, now, limit):
+    """Лиды, которым пора в систему sink: [(id, user_id, lead_info, attempts)]"""
+    rows = session.execute(
+        select(CrmOutbox.id, CrmOutbox.user_id, CrmOutbox.payload, CrmOutbox.attempts)
+        .where(CrmOutbox.sink == sink, CrmOutbox.next_attempt_at <= now)
+        .order_by(CrmOutbox.next_attempt_at)
+        .limit(limit)
+    )
+    return [(row.id, row.user_id, json.loads(row.payload), row.attempts) for row in rows]
+
+
+def _complete_outbox(session, outbox_id, user_id):
+    """
+    Лид принят системой: убираем строку из outbox. Когда лид дошел
+    до всех систем (строк пользователя не осталось), отмечаем lead_sent_to_crm.
+    Возвращает True, если отметка поставлена.
+    """
+    session.execute(delete(CrmOutbox).where(CrmOutbox.id == outbox_id))
+    remaining = session.scalar(
+        select(func.count()).select_from(CrmOutbox).where(CrmOutbox.user_id == user_id)
+    ) + session.scalar(
+        select(func.count()).select_from(CrmDeadLetter).where(CrmDeadLetter.user_id == user_id)
+    )
+    if not remaining:
+        session.execute(User.__table__.update().where(User.user_id == user_id).values(lead_sent_to_crm=True))
+    session.commit()
+    return not remaining
+
+
+def _retry_outbox(session, outbox_id, error, next_attempt_at):
+    """Неудачная попытка: откладываем следующую"""
+    session.execute(
+        CrmOutbox.__table__.update()
+        .where(CrmOutbox.id == outbox_id)
+        .values(attempts=CrmOutbox.attempts + 1, last_error=error, next_attempt_at=next_attempt_at)
+    )
+    session.commit()
+
+
+def _dead_letter_outbox(session, outbox_id, error):
+    """Попытки исчерпаны: переносим лид в crm_dead_letters"""
+    row = session.get(CrmOutbox, outbox_id)
+    if row is None:
+        return
+    session.add(CrmDeadLetter(
+        user_id=row.user_id,
+        sink=row.sink,
+        payload=row.payload,
+        attempts=row.attempts + 1,
+        last_error=error,
+        created_at=row.created_at
+    ))
+    session.delete(row)
+    session.commit()
+
+
+def _replay_dead_letters(session, ids=None):
+    """Вернуть лиды из crm_dead_letters в outbox (все или по id)"""
+    query = select(CrmDeadLetter)
+    if ids:
+        query = query.where(CrmDeadLetter.id.in_(ids))
+    rows = session.scalars(query).all()
+    now = datetime.now()
+    for row in rows:
+        session.add(CrmOutbox(user_id=row.user_id, sink=row.sink, payload=row.payload, attempts=0,
+                              next_attempt_at=now, created_at=row.created_at))
+        session.delete(row)
+    session.commit()
+    return len(rows)
+
+
+def _outbox_stats(session):
+    by_sink = {
+        sink: count
+        for sink, count in session.execute(
+            select(CrmOutbox.sink, func.count()).group_by(CrmOutbox.sink)
+        )
+    }
+    return {
+        'pending': sum(by_sink.values()),
+        'retrying': session.scalar(select(func.count()).select_from(CrmOutbox).where(CrmOutbox.attempts > 0)),
+        'dead': session.scalar(select(func.count()).select_from(CrmDeadLetter)),
+        'by_sink': by_sink
+    }
+
+
+# ==================== КОНТАКТЫ В CRM ====================
+
+def _get_crm_contacts(session, sink, user_ids):
+    """ID контактов в системе sink для пользователей: {user_id: contact_id}"""
+    if not user_ids:
+        return {}
+    rows = session.execute(
+        select(CrmContact.user_id, CrmContact.contact_id)
+        .where(CrmContact.sink == sink, CrmContact.user_id.in_(set(user_ids)))
+    )
+    return {row.user_id: row.contact_id for row in rows}
+
+
+def _save_crm_contacts(session, sink, contacts):
+    """Запомнить контакты и последние лиды: contacts — [(user_id, contact_id, lead_id)]"""
+    rows = [
+        {'sink': sink, 'user_id': user_id, 'contact_id': contact_id, 'lead_id': lead_id, 'updated_at': datetime.now()}
+        for user_id, contact_id, lead_id in contacts
+    ]
+    if not rows:
+        return
+
+    table = CrmContact.__table__
+    insert = _dialect_insert(session)
+    if insert is not None:
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=['sink', 'user_id'],
+            set_={
+                'contact_id': statement.excluded.contact_id,
+                'lead_id': statement.excluded.lead_id,
+                'updated_at': statement.excluded.updated_at
+            }
+        )
+        session.execute(statement, rows)
+    else:
+        for row in rows:
+            session.merge(CrmContact(**row))
+    session.commit()
+
+
+# ==================== ВЕБХУКИ CRM ====================
+
+def _apply_crm_status_events(session, sink, events, keep_days=7):
+    """
+    Применить пачку смен статусов сделок одной транзакцией
+
+    Args:
+        sink (str): система, из которой пришли события (для поиска пользователя по сделке)
+        events (list): кортежи (event_id, lead_id, conversion_status) в порядке получения
+        keep_days (int): сколько дней помнить примененные события
+
+    Returns:
+        dict: applied — {user_id: conversion_status}, duplicates, unknown_leads
+    """
+    # Коды новых статусов фиксируются отдельным коммитом — до отметок событий,
+    # иначе отметки закоммитятся раньше самого UPDATE
+    _ensure_codes(session, [status for _, _, status in events])
+
+    event_ids = {event[0] for event in events}
+    seen = set(session.scalars(
+        select(CrmWebhookEvent.event_id).where(CrmWebhookEvent.event_id.in_(event_ids))
+    )) if event_ids else set()
+    fresh = {}
+    for event_id, lead_id, status in events:
+        if event_id not in seen:
+            fresh[event_id] = (lead_id, status)
+
+    now = datetime.now()
+    if fresh:
+        session.execute(
+            CrmWebhookEvent.__table__.insert(),
+            [{'event_id': event_id, 'received_at': now} for event_id in fresh]
+        )
+    session.execute(delete(CrmWebhookEvent).where(CrmWebhookEvent.received_at < now - timedelta(days=keep_days)))
+
+    lead_ids = {lead_id for lead_id, _ in fresh.values()}
+    users_by_lead = {
+        row.lead_id: row.user_id
+        for row in session.execute(
+            select(CrmContact.lead_id, CrmContact.user_id)
+            .where(CrmContact.sink == sink, CrmContact.lead_id.in_(lead_ids))
+        )
+    } if lead_ids else {}
+
+    # Из нескольких смен статуса одной сделки в пачке остается последняя
+    applied = {}
+    for lead_id, status in fresh.values():
+        if lead_id in users_by_lead:
+            applied[users_by_lead[lead_id]] = status
+
+    # Статусы пишутся тем же пакетным UPDATE, что и буфер записи (со счетчиками воронки);
+    # _apply_batch фиксирует транзакцию вместе с отметками событий
+    if applied:
+        _apply_batch(session, {user_id: {'conversion_status': status} for user_id, status in applied.items()}, [])
+    else:
+        session.commit()
+
+    return {
+        'applied': applied,
+        'duplicates': len(events) - len(fresh),
+        'unknown_leads': sum(1 for lead_id, _ in fresh.values() if lead_id not in users_by_lead)
+    }
+
+
+def _get_conversation_states(session, name):
+    """Незавершенные диалоги ConversationHandler name: {ключ: состояние}"""
+    rows = session.execute(
+        select(ConversationState.key, ConversationState.state).where(ConversationState.name == name)
+    )
+    return {tuple(json.loads(row.key)): json.loads(row.state) for row in rows}
+
+
+def _get_persisted_user_data(session):
+    """Сохраненные context.user_data: {user_id: словарь}"""
+    rows = session.execute(select(PersistedUserData.user_id, PersistedUserData.data))
+    return {row.user_id: json.loads(row.data) for row in rows}
+
+
+def _get_user_persistence(session, key, user_id):
+    """Состояния диалога key во всех ConversationHandler и user_data пользователя: ({name: состояние}, словарь)"""
+    rows = session.execute(
+        select(ConversationState.name, ConversationState.state).where(ConversationState.key == json.dumps(list(key)))
+    )
+    states = {row.name: json.loads(row.state) for row in rows}
+    data = session.scalar(select(PersistedUserData.data).where(PersistedUserData.user_id == user_id))
+    return states, json.loads(data) if data is not None else None
+
+
+def _upsert(session, model, rows, index_elements, columns):
+    """Вставить строки или обновить columns у существующих"""
+    insert = _dialect_insert(session)
+    if insert is not None:
+        statement = insert(model.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: statement.excluded[column] for column in columns}
+        )
+        session.execute(statement, rows)
+    else:
+        for row in rows:
+            session.merge(model(**row))
+
+
+def _save_persistence(session, conversations, user_data):
+    """
+    Записать изменения persistence одной транзакцией
+
+    conversations — {(name, key): состояние}, состояние None — диалог завершен;
+    user_data — {user_id: словарь}, None — данные пользователя удалены
+    """
+    now = datetime.now()
+    states, finished = [], {}
+    for (name, key), state in conversations.items():
+        key = json.dumps(list(key))
+        if state is None:
+            finished.setdefault(name, []).append(key)
+        else:
+            states.append({'name': name, 'key': key, 'state': json.dumps(state), 'updated_at': now})
+    if states:
+        _upsert(session, ConversationState, states, ['name', 'key'], ['state', 'updated_at'])
+    for name, keys in finished.items():
+        session.execute(
+            delete(ConversationState).where(ConversationState.name == name, ConversationState.key.in_(keys))
+        )
+
+    rows = [
+        {'user_id': user_id, 'data': json.dumps(data, ensure_ascii=False), 'updated_at': now}
+        for user_id, data in user_data.items() if data is not None
+    ]
+    if rows:
+        _upsert(session, PersistedUserData, rows, ['user_id'], ['data', 'updated_at'])
+    dropped = [user_id for user_id, data in user_data.items() if data is None]
+    if dropped:
+        session.execute(delete(PersistedUserData).where(PersistedUserData.user_id.in_(dropped)))
+    session.commit()
+
+
+def _prune_persistence(session, keep_days):
+    """Удалить диалоги и user_data, не менявшиеся keep_days дней; возвращает число удаленных строк"""
+    cutoff = datetime.now() - timedelta(days=keep_days)
+    removed = session.execute(delete(ConversationState).where(ConversationState.updated_at < cutoff)).rowcount
+    removed += session.execute(delete(PersistedUserData).where(PersistedUserData.updated_at < cutoff)).rowcount
+    session.commit()
+    return removed
+
+
+# Синхронные обертки. Логика запросов живет в функциях с префиксом "_",
+# которые принимают сессию: их же переиспользует database_async.py
+
+
+def get_or_create_user(user_id, username=None, first_name=None, last_name=None):
+    """Получить или создать пользователя"""
+    session = SessionLocal()
+    try:
+        return _get_or_create_user(session, user_id, username, first_name, last_name)
     finally:
         session.close()
 
@@ -91,10 +1102,7 @@ def update_user_step(user_id, step):
     """Обновить текущий шаг пользователя"""
     session = SessionLocal()
     try:
-        user = session.query(User).filter_by(user_id=user_id).first()
-        if user:
-            user.current_step = step
-            session.commit()
+        _update_user_step(session, user_id, step)
     finally:
         session.close()
 
@@ -103,19 +1111,7 @@ def save_answer(user_id, field, value):
     """Сохранить ответ пользователя"""
     session = SessionLocal()
     try:
-        user = session.query(User).filter_by(user_id=user_id).first()
-        if user:
-            setattr(user, field, value)
-            session.commit()
-
-            # Также сохраняем в таблицу ответов для аналитики
-            answer = UserAnswer(
-                user_id=user_id,
-                question=field,
-                answer=value
-            )
-            session.add(answer)
-            session.commit()
+        _save_answer(session, user_id, field, value)
     finally:
         session.close()
 
@@ -124,11 +1120,7 @@ def mark_completed(user_id, conversion_status='pending'):
     """Отметить прохождение теста как завершенное"""
     session = SessionLocal()
     try:
-        user = session.query(User).filter_by(user_id=user_id).first()
-        if user:
-            user.is_completed = True
-            user.conversion_status = conversion_status
-            session.commit()
+        _mark_completed(session, user_id, conversion_status)
     finally:
         session.close()
 
@@ -137,8 +1129,7 @@ def get_user_data(user_id):
     """Получить данные пользователя"""
     session = SessionLocal()
     try:
-        user = session.query(User).filter_by(user_id=user_id).first()
-        return user
+        return _get_user_data(session, user_id)
     finally:
         session.close()
 
@@ -147,21 +1138,25 @@ def get_statistics():
     """Получить статистику по боту"""
     session = SessionLocal()
     try:
-        total_users = session.query(User).count()
-        completed = session.query(User).filter_by(is_completed=True).count()
-
-        # Популярные проблемы
-        pain_points = {}
-        for pain in ['pain_messages', 'pain_data', 'pain_deadlines', 'pain_documents', 'pain_copying']:
-            count = session.query(User).filter_by(pain_point=pain).count()
-            pain_points[pain] = count
-
-        return {
-            'total_users': total_users,
-            'completed': completed,
-            'completion_rate': (completed / total_users * 100) if total_users > 0 else 0,
-            'pain_points': pain_points
-        }
+        return _get_statistics(session)
+    finally:
+        session.close()
+
+
+def rebuild_funnel_counters():
+    """Пересчитать счетчики воронки из users (исправляет расхождения)"""
+    session = SessionLocal()
+    try:
+        return _rebuild_funnel_counters(session)
+    finally:
+        session.close()
+
+
+def replay_dead_letters(ids=None):
+    """Вернуть лиды из crm_dead_letters в очередь отправки"""
+    session = SessionLocal()
+    try:
+        return _replay_dead_letters(session, ids)
     finally:
         session.close()
 
@@ -169,3 +1164,8 @@ def get_statistics():
 if __name__ == '__main__':
     # Инициализация БД при запуске файла
     init_db()
+
+    # python database.py --rebuild-counters
+    if '--rebuild-counters' in sys.argv:
+        total = rebuild_funnel_counters()
+        print(f"✅ Счетчики воронки пересчитаны ({total} пользователей)")
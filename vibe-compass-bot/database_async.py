@@ -0,0 +1,207 @@
+"""
+Асинхронный слой работы с базой данных
+
+Те же функции, что и в database.py, но в виде корутин поверх
+асинхронного движка SQLAlchemy (aiosqlite / asyncpg). Обработчики
+бота ждут их через await, поэтому задержка БД не блокирует event loop.
+"""
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from config import ASYNC_DATABASE_URL, DB_PROFILE, CRM_SINKS
+from user_cache import user_cache
+from database import (
+    engine_options,
+    apply_engine_profile,
+    _get_or_create_user,
+    _update_user_step,
+    _save_answer,
+    _mark_completed,
+    _apply_batch,
+    _get_user_data,
+    _get_statistics,
+    _rebuild_funnel_counters,
+    _due_outbox,
+    _complete_outbox,
+    _retry_outbox,
+    _dead_letter_outbox,
+    _replay_dead_letters,
+    _outbox_stats,
+    _get_crm_contacts,
+    _save_crm_contacts,
+    _apply_crm_status_events,
+    _get_conversation_states,
+    _get_persisted_user_data,
+    _get_user_persistence,
+    _save_persistence,
+    _prune_persistence
+)
+
+
+def create_async_db_engine(url=ASYNC_DATABASE_URL, profile=DB_PROFILE):
+    """Создать асинхронный движок с настройками профиля"""
+    engine = create_async_engine(url, **engine_options(url, profile))
+    apply_engine_profile(engine.sync_engine, profile)
+    return engine
+
+
+async_engine = create_async_db_engine()
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
+
+async def get_or_create_user(user_id, username=None, first_name=None, last_name=None):
+    """Получить или создать пользователя"""
+    user = user_cache.get(user_id)
+    if user is not None and (user.username, user.first_name, user.last_name) == (username, first_name, last_name):
+        return user
+
+    async with AsyncSessionLocal() as session:
+        user = await session.run_sync(_get_or_create_user, user_id, username, first_name, last_name)
+    user_cache.put(user_id, user)
+    return user
+
+
+async def update_user_step(user_id, step):
+    """Обновить текущий шаг пользователя"""
+    async with AsyncSessionLocal() as session:
+        await session.run_sync(_update_user_step, user_id, step)
+    user_cache.update(user_id, current_step=step)
+
+
+async def save_answer(user_id, field, value):
+    """Сохранить ответ пользователя"""
+    async with AsyncSessionLocal() as session:
+        await session.run_sync(_save_answer, user_id, field, value)
+    user_cache.update(user_id, **{field: value})
+
+
+async def mark_completed(user_id, conversion_status='pending'):
+    """Отметить прохождение теста как завершенное"""
+    async with AsyncSessionLocal() as session:
+        await session.run_sync(_mark_completed, user_id, conversion_status)
+    user_cache.update(user_id, is_completed=True, conversion_status=conversion_status)
+
+
+async def apply_batch(user_updates, answers, leads=(), sinks=CRM_SINKS):
+    """Применить пачку отложенных изменений одной транзакцией"""
+    async with AsyncSessionLocal() as session:
+        await session.run_sync(_apply_batch, user_updates, answers, leads, sinks)
+
+
+async def get_user_data(user_id):
+    """Получить данные пользователя"""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    async with AsyncSessionLocal() as session:
+        user = await session.run_sync(_get_user_data, user_id)
+    if user is not None:
+        user_cache.put(user_id, user)
+    return user
+
+
+async def get_statistics():
+    """Получить статистику по боту"""
+    async with AsyncSessionLocal() as session:
+        return await session.run_sync(_get_statistics)
+
+
+async def rebuild_funnel_counters():
+    """Пересчитать счетчики воронки из users (исправляет расхождения)"""
+    async with AsyncSessionLocal() as session:
+        return await session.run_sync(_rebuild_funnel_counters)
+
+
+async def due_outbox(sink, now, limit):
+    """Лиды, которым пора в систему sink"""
+    async with AsyncSessionLocal() as session:
+        return await session.run_sync(_due_outbox, sink, now, limit)
+
+
+async def complete_outbox(outbox_id, user_id):
+    """Лид принят системой"""
+    async with AsyncSessionLocal() as session:
+        sent_everywhere = await session.run_sync(_complete_outbox, outbox_id, user_id)
+    if sent_everywhere:
+        user_cache.update(user_id, lead_sent_to_crm=True)
+    return sent_everywhere
+
+
+async def retry_outbox(outbox_id, error, next_attempt_at):
+    """Отложить следующую попытку отправки лида"""
+    async with AsyncSessionLocal() as session:
+        await session.run_sync(_retry_outbox, outbox_id, error, next_attempt_at)
+
+
+async def dead_letter_outbox(outbox_id, error):
+    """Перенести лид в crm_dead_letters"""
+    async with AsyncSessionLocal() as session:
+        await session.run_sync(_dead_letter_outbox, outbox_id, error)
+
+
+async def replay_dead_letters(ids=None):
+    """Вернуть лиды из crm_dead_letters в очередь отправки"""
+    async with AsyncSessionLocal() as session:
+        return await session.run_sync(_replay_dead_letters, ids)
+
+
+async def get_outbox_stats():
+    """Размер очереди отправки и dead-letter"""
+    async with AsyncSessionLocal() as session:
+        return await session.run_sync(_outbox_stats)
+
+
+async def get_crm_contacts(sink, user_ids):
+    """Известные контакты пользователей в системе sink"""
+    async with AsyncSessionLocal() as session:
+        return await session.run_sync(_get_crm_contacts, sink, user_ids)
+
+
+async def save_crm_contacts(sink, contacts):
+    """Запомнить контакты пользователей в системе sink"""
+    async with AsyncSessionLocal() as session:
+        await session.run_sync(_save_crm_contacts, sink, contacts)
+
+
+async def apply_crm_status_events(sink, events, keep_days=7):
+    """Применить пачку смен статусов из вебхуков CRM и обновить кэш"""
+    async with AsyncSessionLocal() as session:
+        result = await session.run_sync(_apply_crm_status_events, sink, events, keep_days)
+    for user_id, status in result['applied'].items():
+        user_cache.update(user_id, conversion_status=status)
+    return result
+
+
+async def get_conversation_states(name):
+    """Незавершенные диалоги ConversationHandler name"""
+    async with AsyncSessionLocal() as session:
+        return await session.run_sync(_get_conversation_states, name)
+
+
+async def get_persisted_user_data():
+    """Сохраненные context.user_data всех пользователей"""
+    async with AsyncSessionLocal() as session:
+        return await session.run_sync(_get_persisted_user_data)
+
+
+async def get_user_persistence(key, user_id):
+    """Сохраненное состояние одного пользователя (при переходе к другому воркеру)"""
+    async with AsyncSessionLocal() as session:
+        return await session.run_sync(_get_user_persistence, key, user_id)
+
+
+async def save_persistence(conversations, user_data):
+    """Записать изменившиеся диалоги и user_data одной транзакцией"""
+    async with AsyncSessionLocal() as session:
+        await session.run_sync(_save_persistence, conversations, user_data)
+
+
+async def prune_persistence(keep_days):
+    """Удалить давно не менявшиеся диалоги и user_data"""
+    async with AsyncSessionLocal() as session:
+        return await session.run_sync(_prune_persistence, keep_days)
+
+
+async def close_db():
+    """Закрыть пул соединений асинхронного движка"""
+    await async_engine.dispose()
@@ -0,0 +1,213 @@
+"""
+Хранение незавершенных диалогов в БД (persistence для ConversationHandler)
+
+Без persistence перезапуск или падение бота обрывает все незавершенные
+тесты: ConversationHandler забывает состояние, а context.user_data —
+выбранную проблему. DatabasePersistence хранит их в таблицах
+conversation_states и persisted_user_data.
+
+Приложение раз в PERSISTENCE_UPDATE_INTERVAL секунд передает только
+изменившиеся диалоги и user_data. Они копятся в словарях (повторные
+изменения схлопываются) и пишутся одной транзакцией; при остановке бота
+остаток записывает flush(). Хранилище целиком не перезаписывается, как
+у PicklePersistence. Значения user_data должны сериализоваться в JSON.
+
+Воркер при BOT_WORKERS > 1 (sharding.py) загружает только диалоги своих
+пользователей (owns). Пользователя, перешедшего к нему от другого
+воркера, фронт помечает, и перед его апдейтом reload_moved перечитывает
+состояние из БД: копия в памяти могла устареть, пока он был у другого.
+"""
+import asyncio
+import logging
+
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+from config import PERSISTENCE_UPDATE_INTERVAL, PERSISTENCE_TTL_DAYS
+import database_async
+
+logger = logging.getLogger(__name__)
+
+
+class DatabasePersistence(BasePersistence):
+    """Persistence для диалогов и user_data с пакетной записью изменений"""
+
+    def __init__(self, update_interval=PERSISTENCE_UPDATE_INTERVAL, keep_days=PERSISTENCE_TTL_DAYS, owns=None):
+        # chat_data, bot_data и callback_data бот не использует
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.keep_days = keep_days
+        self.owns = owns  # user_id -> bool: чьи данные загружать при запуске; None — всех
+        self._moved = set()  # пользователи, чье состояние перечитать перед следующим апдейтом
+
+        self._conversations = {}  # (name, key) -> состояние; None — диалог завершен
+        self._user_data = {}  # user_id -> словарь; None — удалить
+        self._flush_lock = asyncio.Lock()
+        self._write_task = None
+        self._pruned = False
+
+        self.writes = 0
+        self.written = 0
+        self.failures = 0
+        self.reloaded = 0
+
+    # ==================== ЗАГРУЗКА ====================
+
+    async def _prune_once(self):
+        if not self._pruned and self.keep_days:
+            self._pruned = True
+            removed = await database_async.prune_persistence(self.keep_days)
+            if removed:
+                logger.info(f"🧹 Удалено {removed} устаревших записей persistence")
+
+    async def get_conversations(self, name):
+        await self._prune_once()
+        conversations = await database_async.get_conversation_states(name)
+        if self.owns is not None:
+            # Ключ диалога — (chat_id, user_id): последний элемент и есть пользователь
+            conversations = {key: state for key, state in conversations.items() if self.owns(key[-1])}
+        logger.info(f"💾 Восстановлено диалогов {name}: {len(conversations)}")
+        return conversations
+
+    async def get_user_data(self):
+        await self._prune_once()
+        user_data = await database_async.get_persisted_user_data()
+        if self.owns is not None:
+            user_data = {user_id: data for user_id, data in user_data.items() if self.owns(user_id)}
+        return user_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # ==================== ИЗМЕНЕНИЯ ====================
+
+    async def update_conversation(self, name, key, new_state):
+        self._conversations[(name, key)] = new_state
+        self._schedule_write()
+
+    async def update_user_data(self, user_id, data):
+        self._user_data[user_id] = data
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._user_data[user_id] = None
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # ==================== ПЕРЕХОД МЕЖДУ ВОРКЕРАМИ ====================
+
+    def mark_moved(self, user_id):
+        """Пользователь перешел к этому воркеру: перечитать его состояние перед апдейтом"""
+        self._moved.add(user_id)
+
+    async def reload_moved(self, update, context):
+        """
+        Обработчик TypeHandler(Update) в группе -1: выполняется раньше
+        ConversationHandler и подменяет состояние перешедшего пользователя
+        сохраненным в БД
+        """
+        user, chat = update.effective_user, update.effective_chat
+        if user is None or chat is None or user.id not in self._moved:
+            return
+        self._moved.discard(user.id)
+        key = (chat.id, user.id)  # как у ConversationHandler с per_chat и per_user
+        # Неотправленные изменения этого воркера старше того, что записал предыдущий
+        self._user_data.pop(user.id, None)
+        for name, pending_key in [item for item in self._conversations if item[1] == key]:
+            del self._conversations[(name, pending_key)]
+
+        states, data = await database_async.get_user_persistence(key, user.id)
+        for handlers in context.application.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler) and handler.persistent:
+                    # Публичного способа заменить состояние одного диалога у ConversationHandler нет
+                    if handler.name in states:
+                        handler._conversations[key] = states[handler.name]
+                    else:
+                        handler._conversations.pop(key, None)
+        context.user_data.clear()
+        context.user_data.update(data or {})
+        self.reloaded += 1
+
+    # ==================== ЗАПИСЬ ====================
+
+    @property
+    def pending(self):
+        return len(self._conversations) + len(self._user_data)
+
+    def _schedule_write(self):
+        # Приложение вызывает update_* для всех изменений прохода через asyncio.gather:
+        # задача записи встает в очередь цикла после них и забирает изменения одной пачкой
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_later())
+
+    async def _write_later(self):
+        try:
+            await self.write()
+        except Exception:
+            pass  # изменения остались в памяти, запишутся со следующей пачкой или при остановке
+
+    async def write(self):
+        """Записать накопленные изменения одной транзакцией; возвращает число записей"""
+        async with self._flush_lock:
+            if not self._conversations and not self._user_data:
+                return 0
+            conversations, self._conversations = self._conversations, {}
+            user_data, self._user_data = self._user_data, {}
+            try:
+                await database_async.save_persistence(conversations, user_data)
+            except Exception as e:
+                # Изменения, пришедшие за время записи, новее — они важнее возвращенных
+                self._conversations = {**conversations, **self._conversations}
+                self._user_data = {**user_data, **self._user_data}
+                self.failures += 1
+                logger.error(f"❌ Ошибка записи {len(conversations) + len(user_data)} записей persistence: {e}")
+                raise
+
+            count = len(conversations) + len(user_data)
+            self.writes += 1
+            self.written += count
+            return count
+
+    async def flush(self):
+        """Вызывается приложением при остановке: записать все, что осталось"""
+        if self._write_task is not None:
+            await self._write_task
+            self._write_task = None
+        await self.write()
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'writes': self.writes,
+            'written': self.written,
+            'failures': self.failures,
+            'reloaded': self.reloaded
+        }
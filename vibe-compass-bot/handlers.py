@@ -3,12 +3,21 @@
 """
 from telegram import Update
 from telegram.ext import ContextTypes, ConversationHandler
+from types import SimpleNamespace
+import asyncio
 import logging
 
 from config import *
 from messages import *
 from keyboards import *
-from database import *
+from database_async import *
+from write_buffer import write_buffer
+from user_cache import user_cache
+from blocking_pool import blocking_pool
+from crm_outbox import outbox_dispatcher
+from crm_integration import amocrm_batcher
+from sheets_appender import sheets_appender
+from admin_notifier import admin_notifier
 
 # Настройка логирования
 logging.basicConfig(
@@ -26,7 +35,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Пользователь {user.first_name} ({user.id}) запустил бота")
 
     # Создаем или получаем пользователя в БД
-    get_or_create_user(
+    await get_or_create_user(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -54,6 +63,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 **Команды:**
 /start - Начать диагностику
 /stats - Статистика бота (только для админов)
+/rebuild_stats - Пересчитать статистику (только для админов)
 /help - Эта справка
 
 Просто следуй инструкциям бота!
@@ -61,9 +71,81 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text)
 
 
+# Подписи для известных проблем; новые ключи выводятся как есть
+STATS_PAIN_LABELS = {
+    'pain_messages': '💬 Ответы клиентам',
+    'pain_data': '📊 Работа с данными',
+    'pain_deadlines': '👨‍🍼 Напоминания о дедлайнах',
+    'pain_documents': '📄 Формирование документов',
+    'pain_copying': '🔄 Копирование данных'
+}
+
+
+def is_admin(update: Update, mutating=False):
+    """
+    Проверка прав на админ-команды. Если ADMIN_IDS не задан, просмотр
+    доступен всем, а команды, меняющие данные (mutating), — никому
+    """
+    if not ADMIN_IDS:
+        return not mutating
+    return update.effective_user.id in ADMIN_IDS
+
+
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Статистика бота (для админов)"""
-    stats = get_statistics()
+    if not is_admin(update):
+        return
+
+    stats = await get_statistics()
+
+    pain_counts = {pain: 0 for pain in STATS_PAIN_LABELS}
+    pain_counts.update(stats['pain_points'])
+    pain_lines = "\n".join(
+        f"{STATS_PAIN_LABELS.get(pain, pain)}: {count}"
+        for pain, count in pain_counts.items()
+    )
+    status_lines = "\n".join(
+        f"• {status}: {count}"
+        for status, count in sorted(stats['conversion_statuses'].items(), key=lambda item: -item[1])
+    ) or "• нет данных"
+    cache = user_cache.stats()
+    processor = context.application.update_processor
+    updates_line = ""
+    if hasattr(processor, 'stats'):
+        updates = processor.stats()
+        updates_line = (
+            f"\n⚙️ Апдейты: в работе {updates['in_flight']}/{updates['max_concurrent_updates']}, "
+            f"в очередях {updates['queued_updates']}, макс. очередь пользователя {updates['max_queue_depth_seen']}"
+        )
+    outbox = await get_outbox_stats()
+    batches = amocrm_batcher.stats()
+    sheets_line = ""
+    if 'google_sheets' in CRM_SINKS:
+        sheets = sheets_appender.stats()
+        sheets_line = (
+            f"\n📊 Google Sheets: ждут {sheets['pending']} строк, отправлено {sheets['rows_sent']} "
+            f"за {sheets['flushes']} запросов ({sheets['avg_flush_ms']:.0f} мс в среднем), ошибок {sheets['failures']}"
+        )
+    notify_line = ""
+    if admin_notifier.chat_ids:
+        notify = admin_notifier.stats()
+        notify_line = (
+            f"\n🔔 Сводки админам: ждут {notify['pending']} лидов, отправлено {notify['digests']} сводок "
+            f"({notify['leads']} лидов), ошибок {notify['failures']}"
+        )
+    sink_queues = ""
+    if len(outbox['by_sink']) > 1:
+        sink_queues = " — " + ", ".join(f"{sink}: {count}" for sink, count in sorted(outbox['by_sink'].items()))
+    pool = blocking_pool.stats()
+    pool_line = (
+        f"\n🧵 Пул: в работе {pool['running']}/{pool['max_workers']}, в очереди {pool['queued']}, "
+        f"ожидание {pool['avg_wait_ms']:.0f} мс (макс. {pool['max_wait_ms']:.0f}), "
+        f"выполнение {pool['avg_run_ms']:.0f} мс, отклонено {pool['rejected']}"
+    )
+    step_lines = "\n".join(
+        f"• {step}: {count}"
+        for step, count in sorted(stats['steps'].items())
+    ) or "• нет данных"
 
     stats_text = f"""
 📊 **Статистика бота**
@@ -73,16 +155,51 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📈 Конверсия: {stats['completion_rate']:.1f}%
 
 **Популярные проблемы:**
-💬 Ответы клиентам: {stats['pain_points'].get('pain_messages', 0)}
-📊 Работа с данными: {stats['pain_points'].get('pain_data', 0)}
-👨‍🍼 Напоминания о дедлайнах: {stats['pain_points'].get('pain_deadlines', 0)}
-📄 Формирование документов: {stats['pain_points'].get('pain_documents', 0)}
-🔄 Копирование данных: {stats['pain_points'].get('pain_copying', 0)}
+{pain_lines}
+
+**Статусы:**
+{status_lines}
+
+**Где сейчас пользователи:**
+{step_lines}
+
+🗄 Кэш: {cache['size']}/{cache['max_size']}, попадания {cache['hit_rate']:.0f}% ({cache['hits']}/{cache['hits'] + cache['misses']}), вытеснено {cache['evictions']}{updates_line}{pool_line}
+📮 CRM: в очереди {outbox['pending']}{sink_queues} (повторы {outbox['retrying']}), в dead-letter {outbox['dead']}, пачек {batches['batches']} (в среднем {batches['avg_batch']:.1f} лида)
+🔌 AmoCRM: {batches['breaker']['state']}, отклонено предохранителем {batches['breaker']['rejected']}, лимит {batches['limiter']['rate']:.1f} запр/с (429: {batches['limiter']['throttled']}){sheets_line}{notify_line}
     """
 
     await update.message.reply_text(stats_text)
 
 
+async def rebuild_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пересчет счетчиков воронки из таблицы users (для админов)"""
+    if not is_admin(update, mutating=True):
+        return
+
+    # Сначала дописываем буфер, чтобы пересчет видел последние ответы
+    await write_buffer.flush()
+    total = await rebuild_funnel_counters()
+
+    await update.message.reply_text(f"✅ Счетчики статистики пересчитаны ({total} пользователей)")
+
+
+async def replay_leads_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Вернуть лиды из dead-letter в очередь CRM (для админов): /replay_leads [id ...]"""
+    if not is_admin(update, mutating=True):
+        return
+
+    try:
+        ids = [int(arg) for arg in context.args or []]
+    except ValueError:
+        await update.message.reply_text("Использование: /replay_leads [id ...]")
+        return
+
+    replayed = await replay_dead_letters(ids or None)
+    outbox_dispatcher.wakeup()
+
+    await update.message.reply_text(f"✅ Возвращено в очередь CRM: {replayed}")
+
+
 # ==================== ОБРАБОТЧИКИ КНОПОК ====================
 
 async def start_quiz_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -91,7 +208,7 @@ async def start_quiz_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
 
     user_id = query.from_user.id
-    update_user_step(user_id, 'question_1')
+    write_buffer.update_user_step(user_id, 'question_1')
 
     await query.edit_message_text(
         QUESTION_1_MESSAGE,
@@ -110,22 +227,17 @@ async def emotion_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     emotion = query.data  # emotion_tired, emotion_annoyed, emotion_confused
 
     # Сохраняем ответ
-    save_answer(user_id, 'emotion', emotion)
-    update_user_step(user_id, 'question_2')
+    write_buffer.save_answer(user_id, 'emotion', emotion)
+    write_buffer.update_user_step(user_id, 'question_2')
 
     # Показываем промежуточный ответ
     response_text = EMOTION_RESPONSES.get(emotion, "Понял, идем дальше.")
 
     await query.edit_message_text(response_text)
 
-    # Через секунду показываем следующий вопрос
-    import asyncio
-    await asyncio.sleep(1.5)
-
-    await query.message.reply_text(
-        QUESTION_2_MESSAGE,
-        reply_markup=get_pain_point_keyboard()
-    )
+    # Через полторы секунды показываем следующий вопрос. Обработчик не ждет:
+    # отправка запланирована таймером, а состояние диалога меняется сразу
+    schedule_follow_up(context, send_pain_question, EMOTION_FOLLOW_UP_DELAY, query.message.chat_id)
 
     return QUESTION_2_PAIN
 
@@ -139,9 +251,9 @@ async def pain_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pain_point = query.data  # pain_messages, pain_data, etc.
 
     # Сохраняем ответ и в контекст для дальнейшего использования
-    save_answer(user_id, 'pain_point', pain_point)
+    write_buffer.save_answer(user_id, 'pain_point', pain_point)
     context.user_data['pain_point'] = pain_point
-    update_user_step(user_id, 'question_3')
+    write_buffer.update_user_step(user_id, 'question_3')
 
     await query.edit_message_text(
         QUESTION_3_MESSAGE,
@@ -160,11 +272,18 @@ async def time_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     time_spent = query.data  # time_low, time_medium, time_high
 
     # Сохраняем ответ
-    save_answer(user_id, 'time_spent', time_spent)
-    update_user_step(user_id, 'show_insight')
-
-    # Получаем pain_point из контекста
-    pain_point = context.user_data.get('pain_point', 'pain_messages')
+    write_buffer.save_answer(user_id, 'time_spent', time_spent)
+    write_buffer.update_user_step(user_id, 'show_insight')
+
+    # pain_point из контекста; если его там нет (например, user_data не
+    # восстановился), берем сохраненный ответ из кэша или БД
+    pain_point = context.user_data.get('pain_point')
+    if pain_point is None:
+        if write_buffer.has_pending(user_id) and user_id not in user_cache:
+            await write_buffer.flush()
+        user_data = await get_user_data(user_id)
+        pain_point = (user_data.pain_point if user_data else None) or 'pain_messages'
+        context.user_data['pain_point'] = pain_point
 
     # Генерируем персонализированный инсайт
     insight_text = get_insight_message(pain_point, time_spent)
@@ -172,14 +291,7 @@ async def time_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.edit_message_text(insight_text, parse_mode='Markdown')
 
     # Через 2 секунды показываем предложение
-    import asyncio
-    await asyncio.sleep(2)
-
-    await query.message.reply_text(
-        OFFER_MESSAGE,
-        reply_markup=get_offer_keyboard(),
-        parse_mode='Markdown'
-    )
+    schedule_follow_up(context, send_offer, OFFER_FOLLOW_UP_DELAY, query.message.chat_id)
 
     return SHOW_OFFER
 
@@ -190,26 +302,26 @@ async def consultation_callback(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer("Отлично! Отправляю заявку...")
 
     user_id = query.from_user.id
-    user_data = get_user_data(user_id)
-
-    # Отмечаем как конверсию
-    mark_completed(user_id, conversion_status='converted')
 
-    # Здесь можно отправить данные в CRM
-    try:
-        from crm_integration import send_lead_to_crm
-        lead_info = {
-            'user_id': user_id,
-            'first_name': query.from_user.first_name,
-            'username': query.from_user.username,
-            'pain_point': user_data.pain_point if user_data else 'unknown',
-            'time_spent': user_data.time_spent if user_data else 'unknown',
-            'emotion': user_data.emotion if user_data else 'unknown'
-        }
-        send_lead_to_crm(lead_info)
-        logger.info(f"Лид {user_id} отправлен в CRM")
-    except Exception as e:
-        logger.error(f"Ошибка отправки в CRM: {e}")
+    # Ответы могли еще не дойти до БД из буфера. Если пользователь в кэше,
+    # там уже свежие значения, но при промахе читаем из БД — сбрасываем буфер
+    if write_buffer.has_pending(user_id) and user_id not in user_cache:
+        await write_buffer.flush()
+    user_data = await get_user_data(user_id)
+
+    # Отмечаем как конверсию. Лид попадет в crm_outbox той же транзакцией,
+    # а в CRM его отправит фоновая задача (crm_outbox.py) с повторами
+    lead_info = {
+        'user_id': user_id,
+        'first_name': query.from_user.first_name,
+        'username': query.from_user.username,
+        'pain_point': user_data.pain_point if user_data else 'unknown',
+        'time_spent': user_data.time_spent if user_data else 'unknown',
+        'emotion': user_data.emotion if user_data else 'unknown'
+    }
+    write_buffer.mark_completed(user_id, conversion_status='converted', lead_info=lead_info)
+    # Админам лид придет в ближайшей сводке, а не отдельным сообщением
+    admin_notifier.add(lead_info)
 
     await query.edit_message_text(CONVERSION_MESSAGE)
 
@@ -224,7 +336,7 @@ async def pdf_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
 
     # Отмечаем как завершенного, но не конвертированного
-    mark_completed(user_id, conversion_status='pdf_downloaded')
+    write_buffer.mark_completed(user_id, conversion_status='pdf_downloaded')
 
     await query.edit_message_text(PDF_MESSAGE)
 
@@ -240,7 +352,7 @@ async def later_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     user_id = query.from_user.id
-    mark_completed(user_id, conversion_status='postponed')
+    write_buffer.mark_completed(user_id, conversion_status='postponed')
 
     await query.edit_message_text(
         REMIND_LATER_MESSAGE,
@@ -301,6 +413,45 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+# ==================== ОТЛОЖЕННЫЕ СООБЩЕНИЯ ====================
+
+def schedule_follow_up(context: ContextTypes.DEFAULT_TYPE, callback, delay, chat_id):
+    """
+    Запланировать отложенное сообщение, не занимая обработчик
+
+    Основной путь — JobQueue приложения. Если она недоступна (не установлен
+    python-telegram-bot[job-queue]), используется таймер event loop.
+    """
+    if context.job_queue is not None:
+        context.job_queue.run_once(callback, delay, chat_id=chat_id)
+        return
+
+    async def delayed():
+        await asyncio.sleep(delay)
+        await callback(SimpleNamespace(bot=context.bot, job=SimpleNamespace(chat_id=chat_id)))
+
+    context.application.create_task(delayed())
+
+
+async def send_pain_question(context: ContextTypes.DEFAULT_TYPE):
+    """Отложенная отправка вопроса о проблеме"""
+    await context.bot.send_message(
+        chat_id=context.job.chat_id,
+        text=QUESTION_2_MESSAGE,
+        reply_markup=get_pain_point_keyboard()
+    )
+
+
+async def send_offer(context: ContextTypes.DEFAULT_TYPE):
+    """Отложенная отправка предложения"""
+    await context.bot.send_message(
+        chat_id=context.job.chat_id,
+        text=OFFER_MESSAGE,
+        reply_markup=get_offer_keyboard(),
+        parse_mode='Markdown'
+    )
+
+
 # Функция для отправки напоминания (для JobQueue)
 async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
     """Отправка напоминания пользователю"""
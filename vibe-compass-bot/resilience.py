@@ -0,0 +1,148 @@
+"""
+Защита внешних CRM от перегрузки
+
+CircuitBreaker перестает обращаться к CRM после серии ошибок подряд
+и через паузу пропускает один пробный запрос. TokenBucket ограничивает
+частоту запросов и сам снижает ее, когда CRM отвечает 429 (с учетом
+Retry-After), а затем постепенно возвращает обратно.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """CRM временно отключена предохранителем, запрос не выполнялся"""
+
+
+class CircuitBreaker:
+    """Предохранитель: closed -> open после ошибок -> half_open -> closed"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.consecutive_failures = 0
+        self.rejected = 0
+        self.opened = 0
+
+    @property
+    def state(self):
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._trial_in_flight = False
+        return self._state
+
+    def allow(self):
+        """Можно ли сейчас обращаться к CRM; в half_open пропускает один пробный запрос"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def check(self):
+        """То же, что allow(), но с исключением CircuitOpen"""
+        if not self.allow():
+            raise CircuitOpen(f"{self.name}: предохранитель разомкнут")
+
+    def record_success(self):
+        if self._state != self.CLOSED:
+            logger.info(f"✅ {self.name}: CRM снова отвечает, предохранитель замкнут")
+        self._state = self.CLOSED
+        self.consecutive_failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self._state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                self.opened += 1
+                logger.warning(f"⚠️ {self.name}: {self.consecutive_failures} ошибок подряд, "
+                               f"запросы приостановлены на {self.reset_timeout} с")
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'rejected': self.rejected,
+            'opened': self.opened
+        }
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов с подстройкой под 429
+
+    На 429 частота уменьшается вдвое (не ниже min_rate) и запросы
+    приостанавливаются на Retry-After секунд; каждый успешный запрос
+    возвращает recovery_step запросов/с, пока не достигнут max_rate.
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=0.5, recovery_step=0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self.min_rate = min_rate
+        self.recovery_step = recovery_step
+
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self.throttled = 0
+        self.waited = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Дождаться разрешения на один запрос"""
+        started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.waited += now - started
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def throttle(self, retry_after=None):
+        """CRM ответила 429: снижаем частоту и ждем Retry-After"""
+        self.throttled += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._tokens = 0.0
+        if retry_after:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def recover(self):
+        """Успешный запрос: понемногу возвращаем частоту"""
+        self.rate = min(self.max_rate, self.rate + self.recovery_step)
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'max_rate': self.max_rate,
+            'throttled': self.throttled,
+            'waited_s': self.waited
+        }
@@ -34,7 +34,7 @@ def check_dependencies():
         'telegram',
         'sqlalchemy',
         'dotenv',
-        'requests'
+        'httpx'
     ]
 
     missing = []
@@ -0,0 +1,381 @@
+"""
+Шардирование апдейтов по процессам бота
+
+Один процесс Python упирается в одно ядро, поэтому при BOT_WORKERS > 1
+вебхук Telegram принимает процесс-фронт, а апдейты обрабатывают
+BOT_WORKERS обычных процессов бота (bot.py в режиме воркера). Фронт
+проверяет секрет, берет из апдейта user_id и пересылает тело запроса
+воркеру, выбранному консистентным хешем: все апдейты пользователя
+попадают в один процесс, поэтому состояние ConversationHandler
+и context.user_data остаются локальными.
+
+Если воркер не принимает соединения или его процесс завершился, он
+выбывает из кольца и его пользователи расходятся по остальным воркерам
+(пользователи живых воркеров не переезжают). WorkerSupervisor перезапускает
+упавший процесс, а проверка доступности возвращает его в кольцо.
+
+Незавершенные диалоги воркер при запуске загружает только для своих
+пользователей (owned_by). Когда пользователь переходит к другому воркеру
+(выбывание или возвращение воркера), фронт помечает его первый апдейт
+заголовком RELOAD_HEADER, и новый воркер перечитывает состояние
+пользователя из БД вместо устаревшей копии в памяти.
+"""
+import asyncio
+import bisect
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import sys
+from collections import Counter
+
+import httpx
+from telegram import Update
+
+from config import (
+    TELEGRAM_WEBHOOK_URL,
+    TELEGRAM_WEBHOOK_PATH,
+    TELEGRAM_WEBHOOK_SECRET,
+    TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+    BOT_WORKERS,
+    BOT_WORKER_BASE_PORT,
+    BOT_WORKER_HEALTH_INTERVAL,
+    BOT_WORKER_RESTART_DELAY
+)
+from telegram_webhook import SECRET_HEADER, RELOAD_HEADER
+from web_server import Response
+
+logger = logging.getLogger(__name__)
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+
+
+class HashRing:
+    """Консистентный хеш: у каждого узла replicas точек на кольце"""
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = []  # отсортированные хеши точек
+        self._owners = []  # узел каждой точки
+        self._nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def add(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for replica in range(self.replicas):
+            point = self._hash(f"{node}#{replica}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node):
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        kept = [(point, owner) for point, owner in zip(self._points, self._owners) if owner != node]
+        self._points = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def get(self, key):
+        """Узел для ключа (None — кольцо пустое)"""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[index]
+
+    @property
+    def nodes(self):
+        return sorted(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+def worker_name(index):
+    return f"worker-{index}"
+
+
+def owned_by(index, count=BOT_WORKERS, replicas=100):
+    """
+    Проверка «пользователь принадлежит воркеру index», когда все count
+    воркеров в кольце (для загрузки persistence при запуске воркера)
+    """
+    ring = HashRing([worker_name(i) for i in range(count)], replicas)
+    name = worker_name(index)
+    return lambda key: ring.get(key) == name
+
+
+def update_shard_key(data):
+    """
+    Ключ шардирования из JSON апдейта, как в PerUserUpdateProcessor:
+    ID пользователя, иначе ID чата (посты каналов), иначе update_id
+    """
+    chat_id = None
+    for field, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user['id']
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat_id is None and isinstance(chat, dict):
+            chat_id = chat.get('id')
+    return chat_id if chat_id is not None else data.get('update_id')
+
+
+class ShardDispatcher:
+    """Фронт вебхука: проверка секрета и пересылка апдейта воркеру пользователя"""
+
+    def __init__(self, secret=TELEGRAM_WEBHOOK_SECRET, worker_secret=None, path=TELEGRAM_WEBHOOK_PATH,
+                 health_interval=BOT_WORKER_HEALTH_INTERVAL, timeout=10, replicas=100):
+        self.secret = secret or secrets.token_urlsafe(32)
+        # Воркеры слушают только 127.0.0.1, но секрет все равно свой
+        self.worker_secret = worker_secret or secrets.token_urlsafe(32)
+        self.path = path
+        self.health_interval = health_interval
+        self.timeout = timeout
+
+        self.ring = HashRing(replicas=replicas)  # воркеры в работе
+        self.home = HashRing(replicas=replicas)  # все воркеры: кому пользователь принадлежит
+        self._away = {}  # ключ -> воркер, который обслуживает пользователя вместо домашнего
+        self._workers = {}  # имя -> (host, port)
+        self._client = None
+        self._task = None
+        self._stopping = asyncio.Event()
+
+        self.forwarded = Counter()
+        self.rerouted = 0
+        self.moved = 0
+        self.rejected = 0
+        self.forbidden = 0
+        self.failures = 0
+
+    def add_worker(self, name, host, port):
+        """Объявить воркера; в кольцо он попадет, когда начнет принимать соединения"""
+        self._workers[name] = (host, port)
+        self.home.add(name)
+
+    def mark_up(self, name):
+        if name not in self.ring:
+            self.ring.add(name)
+            logger.info(f"✅ Воркер {name} в работе ({len(self.ring)} из {len(self._workers)})")
+
+    def mark_down(self, name):
+        if name in self.ring:
+            self.ring.remove(name)
+            logger.warning(f"⚠️ Воркер {name} выбыл, его пользователи перераспределены "
+                           f"({len(self.ring)} из {len(self._workers)})")
+
+    def worker_for(self, data):
+        """Воркер, которому уйдет апдейт"""
+        return self.ring.get(update_shard_key(data))
+
+    def _needs_reload(self, key, name):
+        """Пользователь сменил воркера: новому нужно перечитать его состояние из БД"""
+        return self._away.get(key, self.home.get(key)) != name
+
+    def _served(self, key, name):
+        """Запомнить воркера, который принял апдейт пользователя (помним только чужих)"""
+        if name == self.home.get(key):
+            self._away.pop(key, None)
+        else:
+            self._away[key] = name
+
+    async def _forward(self, name, body, reload=False):
+        host, port = self._workers[name]
+        headers = {'Content-Type': 'application/json', SECRET_HEADER: self.worker_secret}
+        if reload:
+            headers[RELOAD_HEADER] = '1'
+        return await self._client.post(f"http://{host}:{port}{self.path}", content=body, headers=headers)
+
+    async def handle(self, request):
+        """POST от Telegram: переслать апдейт воркеру и вернуть Telegram его ответ"""
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            self.forbidden += 1
+            return Response(403)
+        try:
+            key = update_shard_key(request.json())
+        except (ValueError, AttributeError):
+            return Response(400)
+
+        while True:
+            name = self.ring.get(key)
+            if name is None:
+                # Живых воркеров нет: Telegram повторит доставку позже
+                self.rejected += 1
+                return Response(503)
+            reload = self._needs_reload(key, name)
+            try:
+                response = await self._forward(name, request.body, reload)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                # Запрос до воркера не дошел — безопасно отдать апдейт следующему
+                self.mark_down(name)
+                self.rerouted += 1
+                continue
+            except httpx.HTTPError as e:
+                # Воркер мог успеть принять апдейт, поэтому другому не отдаем: повтор — на стороне Telegram
+                self.failures += 1
+                self.mark_down(name)
+                logger.error(f"❌ Ошибка пересылки апдейта воркеру {name}: {e!r}")
+                return Response(503)
+            self.forwarded[name] += 1
+            if response.status_code == 200:
+                # Пока воркер не принял апдейт, пометка о переезде повторяется
+                self._served(key, name)
+                self.moved += reload
+            return Response(response.status_code)
+
+    async def _probe(self, name):
+        host, port = self._workers[name]
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+    async def check_workers(self):
+        """Вернуть в кольцо выбывших воркеров, которые снова принимают соединения"""
+        for name in list(self._workers):
+            if name not in self.ring and await self._probe(name):
+                self.mark_up(name)
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            await self.check_workers()
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.health_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def register(self, server, path=TELEGRAM_WEBHOOK_PATH):
+        """Подключить фронт к HTTP-серверу"""
+        server.route('POST', path, self.handle)
+
+    async def set_webhook(self, bot, url=TELEGRAM_WEBHOOK_URL, max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+                          allowed_updates=Update.ALL_TYPES):
+        """Сообщить Telegram адрес вебхука фронта и секрет"""
+        await bot.set_webhook(url=url, secret_token=self.secret, max_connections=max_connections,
+                              allowed_updates=allowed_updates)
+        logger.info(f"✅ Вебхук Telegram: {url} -> {len(self._workers)} воркеров")
+
+    async def start(self):
+        """Открыть соединения к воркерам и запустить проверку их доступности"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS)
+            )
+        if self._task is None:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self):
+        return {
+            'workers': len(self._workers),
+            'up': self.ring.nodes,
+            'forwarded': dict(self.forwarded),
+            'rerouted': self.rerouted,
+            'moved': self.moved,
+            'rejected': self.rejected,
+            'forbidden': self.forbidden,
+            'failures': self.failures
+        }
+
+
+class WorkerSupervisor:
+    """Запуск процессов-воркеров и перезапуск упавших"""
+
+    def __init__(self, dispatcher, count=BOT_WORKERS, base_port=BOT_WORKER_BASE_PORT, command=None,
+                 env=None, restart_delay=BOT_WORKER_RESTART_DELAY, host='127.0.0.1', admin_notify_url=None):
+        self.dispatcher = dispatcher
+        # Куда воркеры пересылают лиды для сводки админам (сводки шлет только фронт)
+        self.admin_notify_url = admin_notify_url
+        self.count = count
+        self.base_port = base_port
+        self.command = command or [sys.executable, BOT_SCRIPT]
+        self.env = env or {}
+        self.restart_delay = restart_delay
+        self.host = host
+
+        self.processes = {}  # имя -> asyncio.subprocess.Process
+        self._tasks = []
+        self._stopping = False
+        self.restarts = 0
+
+    def worker_env(self, index):
+        """Окружение воркера: свой порт на 127.0.0.1, секрет фронта и адрес для лидов"""
+        env = {
+            **os.environ,
+            **self.env,
+            'BOT_MODE': 'webhook',
+            'BOT_WORKER_ID': str(index),
+            'WEB_SERVER_HOST': self.host,
+            'WEB_SERVER_PORT': str(self.base_port + index),
+            'TELEGRAM_WEBHOOK_SECRET': self.dispatcher.worker_secret
+        }
+        if self.admin_notify_url:
+            env['ADMIN_NOTIFY_FORWARD_URL'] = self.admin_notify_url
+        return env
+
+    async def _supervise(self, index):
+        name = worker_name(index)
+        self.dispatcher.add_worker(name, self.host, self.base_port + index)
+        while not self._stopping:
+            process = await asyncio.create_subprocess_exec(*self.command, env=self.worker_env(index))
+            self.processes[name] = process
+            logger.info(f"🚀 Воркер {name} запущен (pid {process.pid}, порт {self.base_port + index})")
+            code = await process.wait()
+            if self._stopping:
+                break
+            self.dispatcher.mark_down(name)
+            self.restarts += 1
+            logger.error(f"❌ Воркер {name} завершился с кодом {code}, перезапуск через {self.restart_delay} с")
+            await asyncio.sleep(self.restart_delay)
+
+    async def start(self):
+        if not self._tasks:
+            self._stopping = False
+            self._tasks = [asyncio.create_task(self._supervise(index)) for index in range(self.count)]
+
+    async def stop(self, timeout=30):
+        """Остановить воркеров (SIGTERM: они дорабатывают очередь и сбрасывают буферы)"""
+        self._stopping = True
+        for process in self.processes.values():
+            if process.returncode is None:
+                process.terminate()
+        try:
+            await asyncio.wait_for(asyncio.gather(*self._tasks), timeout)
+        except asyncio.TimeoutError:
+            for process in self.processes.values():
+                if process.returncode is None:
+                    process.kill()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {
+            'workers': self.count,
+            'running': sum(1 for process in self.processes.values() if process.returncode is None),
+            'restarts': self.restarts
+        }
@@ -0,0 +1,215 @@
+"""
+Пакетное добавление строк лидов в Google Sheets
+
+Вызов values.append на каждый лид быстро упирается в квоту Sheets API,
+поэтому строки копятся в памяти и уходят одним запросом раз в
+GOOGLE_SHEETS_FLUSH_INTERVAL секунд или сразу по GOOGLE_SHEETS_BATCH_SIZE
+строк. Каждая строка сначала дописывается в локальный файл
+GOOGLE_SHEETS_PENDING_FILE, поэтому неотправленные строки переживают
+перезапуск бота и отправляются после него.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from urllib.parse import quote
+
+from config import (
+    GOOGLE_SHEETS_SPREADSHEET_ID,
+    GOOGLE_SHEETS_RANGE,
+    GOOGLE_SHEETS_CREDENTIALS_FILE,
+    GOOGLE_SHEETS_ACCESS_TOKEN,
+    GOOGLE_SHEETS_API_URL,
+    GOOGLE_SHEETS_FLUSH_INTERVAL,
+    GOOGLE_SHEETS_BATCH_SIZE,
+    GOOGLE_SHEETS_PENDING_FILE
+)
+from blocking_pool import blocking_pool
+
+logger = logging.getLogger(__name__)
+
+SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+
+class SheetsAppender:
+    """Буфер строк для Google Sheets с сохранением на диск"""
+
+    def __init__(self, spreadsheet_id=GOOGLE_SHEETS_SPREADSHEET_ID, value_range=GOOGLE_SHEETS_RANGE,
+                 pending_file=GOOGLE_SHEETS_PENDING_FILE, flush_interval=GOOGLE_SHEETS_FLUSH_INTERVAL,
+                 batch_size=GOOGLE_SHEETS_BATCH_SIZE, api_url=GOOGLE_SHEETS_API_URL,
+                 access_token=GOOGLE_SHEETS_ACCESS_TOKEN, credentials_file=GOOGLE_SHEETS_CREDENTIALS_FILE):
+        self.spreadsheet_id = spreadsheet_id
+        self.value_range = value_range
+        self.pending_file = pending_file
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.api_url = api_url
+        self.access_token = access_token
+        self.credentials_file = credentials_file
+
+        self._rows = self._load_pending()
+        self._credentials = None
+        self._client = None
+        self._flush_lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+        self.flushes = 0
+        self.failures = 0
+        self.rows_sent = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._flush_total = 0.0
+
+    # ==================== ЛОКАЛЬНЫЙ ФАЙЛ ====================
+
+    def _load_pending(self):
+        """Строки, не отправленные до прошлой остановки"""
+        if not self.pending_file or not os.path.exists(self.pending_file):
+            return []
+        rows = []
+        with open(self.pending_file, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    rows.append(json.loads(line))
+        if rows:
+            logger.info(f"📊 Google Sheets: восстановлено {len(rows)} неотправленных строк")
+        return rows
+
+    def _rewrite_pending(self):
+        """Переписать файл оставшимися строками (через временный файл)"""
+        if not self.pending_file:
+            return
+        if not self._rows:
+            if os.path.exists(self.pending_file):
+                os.remove(self.pending_file)
+            return
+        tmp_file = f"{self.pending_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for row in self._rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+        os.replace(tmp_file, self.pending_file)
+
+    # ==================== ДОБАВЛЕНИЕ ====================
+
+    def add(self, row):
+        """Поставить строку в очередь; после возврата она уже на диске"""
+        if self.pending_file:
+            with open(self.pending_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            self._full.set()
+
+    @property
+    def pending(self):
+        """Сколько строк ждут отправки"""
+        return len(self._rows)
+
+    # ==================== ОТПРАВКА ====================
+
+    async def _auth_headers(self):
+        if self.credentials_file:
+            if self._credentials is None:
+                # Необязательная зависимость: нужна только для сервисного аккаунта
+                from google.oauth2 import service_account
+                self._credentials = service_account.Credentials.from_service_account_file(
+                    self.credentials_file, scopes=SHEETS_SCOPES
+                )
+            if not self._credentials.valid:
+                from google.auth.transport.requests import Request
+                await blocking_pool.run(self._credentials.refresh, Request())
+            return {'Authorization': f'Bearer {self._credentials.token}'}
+        if self.access_token:
+            return {'Authorization': f'Bearer {self.access_token}'}
+        return {}
+
+    def _get_client(self):
+        if self._client is None:
+            from crm_integration import create_http_client
+            self._client = create_http_client(base_url=self.api_url)
+        return self._client
+
+    async def flush(self):
+        """Отправить накопленные строки одним запросом values.append"""
+        async with self._flush_lock:
+            if not self._rows:
+                return 0
+            if not self.spreadsheet_id:
+                logger.warning(f"📊 GOOGLE_SHEETS_SPREADSHEET_ID не задан, {len(self._rows)} строк ждут в {self.pending_file}")
+                return 0
+
+            rows = self._rows[:]
+            started = time.perf_counter()
+            try:
+                response = await self._get_client().post(
+                    f"/v4/spreadsheets/{self.spreadsheet_id}/values/{quote(self.value_range)}:append",
+                    params={'valueInputOption': 'USER_ENTERED', 'insertDataOption': 'INSERT_ROWS'},
+                    json={'values': rows},
+                    headers=await self._auth_headers()
+                )
+                response.raise_for_status()
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"❌ Ошибка добавления {len(rows)} строк в Google Sheets: {e}")
+                raise
+
+            elapsed = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.rows_sent += len(rows)
+            self.last_flush_ms = elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+            self._flush_total += elapsed
+
+            # Пока шел запрос, могли добавиться новые строки — они остаются
+            del self._rows[:len(rows)]
+            self._rewrite_pending()
+            logger.info(f"📊 В Google Sheets добавлено {len(rows)} строк за {elapsed:.0f} мс")
+            return len(rows)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # Строки остались в буфере и в файле, повторим на следующем цикле
+                pass
+
+    async def start(self):
+        """Запустить фоновую отправку"""
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую отправку; неотправленные строки остаются в файле"""
+        if self._task is not None:
+            self._stopping = True
+            self._full.set()
+            await self._task
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self):
+        """Счетчики для мониторинга"""
+        return {
+            'pending': len(self._rows),
+            'flushes': self.flushes,
+            'failures': self.failures,
+            'rows_sent': self.rows_sent,
+            'last_flush_ms': self.last_flush_ms,
+            'avg_flush_ms': self._flush_total / self.flushes if self.flushes else 0.0,
+            'max_flush_ms': self.max_flush_ms
+        }
+
+
+sheets_appender = SheetsAppender()
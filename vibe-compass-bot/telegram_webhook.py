@@ -0,0 +1,101 @@
+"""
+Прием апдейтов Telegram через вебхук
+
+В режиме BOT_MODE=webhook Telegram сам присылает апдейты POST-запросами
+на встроенный HTTP-сервер (web_server.py) вместо getUpdates. Обработчик
+запроса только сверяет секрет из заголовка X-Telegram-Bot-Api-Secret-Token,
+разбирает JSON и кладет апдейт в application.update_queue — ответ уходит
+сразу, а обработка идет обычным путем приложения (PerUserUpdateProcessor).
+Если очередь длиннее TELEGRAM_WEBHOOK_QUEUE_LIMIT или приложение не
+запущено (еще не стартовало или уже останавливается и апдейты из очереди
+никто не заберет), запрос отклоняется с 503 и Telegram повторит доставку позже.
+"""
+import hmac
+import logging
+import secrets
+
+from telegram import Update
+
+from config import (
+    TELEGRAM_WEBHOOK_URL,
+    TELEGRAM_WEBHOOK_PATH,
+    TELEGRAM_WEBHOOK_SECRET,
+    TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+    TELEGRAM_WEBHOOK_QUEUE_LIMIT
+)
+from web_server import Response
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+# Фронт (sharding.py) ставит заголовок, когда пользователь перешел к другому воркеру
+RELOAD_HEADER = 'x-shard-reload'
+
+
+class TelegramWebhook:
+    """Обработчик вебхука Telegram: проверка секрета и постановка апдейта в очередь"""
+
+    def __init__(self, application, secret=TELEGRAM_WEBHOOK_SECRET, queue_limit=TELEGRAM_WEBHOOK_QUEUE_LIMIT):
+        self.application = application
+        # Секрет передается Telegram в setWebhook, поэтому без настройки годится и случайный
+        self.secret = secret or secrets.token_urlsafe(32)
+        self.queue_limit = queue_limit
+
+        self.accepted = 0
+        self.rejected = 0
+        self.forbidden = 0
+
+    async def handle(self, request):
+        """POST от Telegram: быстро положить апдейт в очередь и ответить 200"""
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            self.forbidden += 1
+            return Response(403)
+
+        # После application.stop() очередь больше не разбирается: ответ 200 потерял бы апдейт
+        if not self.application.running:
+            self.rejected += 1
+            return Response(503)
+
+        queue = self.application.update_queue
+        if queue.qsize() >= self.queue_limit:
+            self.rejected += 1
+            return Response(503)
+
+        try:
+            update = Update.de_json(request.json(), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"⚠️ Некорректный апдейт в вебхуке: {e}")
+            return Response(400)
+
+        # Состояние пользователя, перешедшего от другого воркера, перечитывается из БД
+        # до обработки апдейта (DatabasePersistence.reload_moved)
+        persistence = getattr(self.application, 'persistence', None)
+        if request.headers.get(RELOAD_HEADER) and update.effective_user and persistence is not None:
+            persistence.mark_moved(update.effective_user.id)
+
+        queue.put_nowait(update)
+        self.accepted += 1
+        return Response(200)
+
+    def register(self, server, path=TELEGRAM_WEBHOOK_PATH):
+        """Подключить вебхук к HTTP-серверу"""
+        server.route('POST', path, self.handle)
+
+    async def set_webhook(self, url=TELEGRAM_WEBHOOK_URL, max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+                          allowed_updates=Update.ALL_TYPES):
+        """Сообщить Telegram адрес вебхука, секрет и число одновременных соединений"""
+        await self.application.bot.set_webhook(
+            url=url,
+            secret_token=self.secret,
+            max_connections=max_connections,
+            allowed_updates=allowed_updates
+        )
+        logger.info(f"✅ Вебхук Telegram: {url} (до {max_connections} соединений)")
+
+    def stats(self):
+        return {
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'forbidden': self.forbidden,
+            'queued': self.application.update_queue.qsize()
+        }
@@ -2,6 +2,18 @@
 Скрипт для тестирования функциональности бота
 Запуск: python test_bot.py
 """
+import os
+import tempfile
+
+# Тесты пишут во временную БД, а не в рабочую ./vibe_compass.db: каждый запуск
+# начинается с чистой базы. Адрес должен быть выставлен до импорта database.py
+TEST_DB = os.path.join(tempfile.gettempdir(), 'vibe_compass_test.db')
+for path in (TEST_DB, TEST_DB + '-wal', TEST_DB + '-shm'):
+    if os.path.exists(path):
+        os.remove(path)
+os.environ['DATABASE_URL'] = f'sqlite:///{TEST_DB}'
+os.environ.pop('ASYNC_DATABASE_URL', None)
+
 from database import *
 from messages import get_insight_message
 import random
@@ -37,6 +49,9 @@ def test_database():
 
         # Статистика
         stats = get_statistics()
+        assert stats['pain_points'].get('pain_messages', 0) >= 1
+        assert stats['emotions'].get('emotion_tired', 0) >= 1
+        assert stats['time_spent'].get('time_high', 0) >= 1
         print(f"✅ Статистика: {stats['total_users']} пользователей")
 
         print("\n✅ ВСЕ ТЕСТЫ БД ПРОЙДЕНЫ\n")
@@ -49,6 +64,1638 @@ def test_database():
         return False
 
 
+def test_async_database():
+    """Тест асинхронного слоя базы данных"""
+    print("\n=== ТЕСТ АСИНХРОННОЙ БАЗЫ ДАННЫХ ===")
+
+    import asyncio
+    import database_async
+
+    async def scenario():
+        try:
+            user = await database_async.get_or_create_user(
+                user_id=12346,
+                username='async_user',
+                first_name='Асинк'
+            )
+            print(f"✅ Создание пользователя: {user.first_name}")
+
+            await database_async.save_answer(12346, 'pain_point', 'pain_data')
+            await database_async.update_user_step(12346, 'question_3')
+            user_data = await database_async.get_user_data(12346)
+            assert user_data.pain_point == 'pain_data'
+            assert user_data.current_step == 'question_3'
+            print(f"✅ Сохранение и чтение ответа: {user_data.pain_point}")
+
+            hits = database_async.user_cache.hits
+            await database_async.get_user_data(12346)
+            assert database_async.user_cache.hits == hits + 1
+            print("✅ Повторное чтение из кэша")
+
+            stats = await database_async.get_statistics()
+            print(f"✅ Статистика: {stats['total_users']} пользователей")
+        finally:
+            await database_async.close_db()
+
+    try:
+        init_db()
+        asyncio.run(scenario())
+        print("\n✅ ВСЕ ТЕСТЫ АСИНХРОННОЙ БД ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ТЕСТАХ АСИНХРОННОЙ БД: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_write_buffer():
+    """Тест отложенной записи ответов"""
+    print("\n=== ТЕСТ БУФЕРА ЗАПИСИ ===")
+
+    import asyncio
+    import database_async
+    from write_buffer import WriteBehindBuffer
+
+    async def scenario():
+        try:
+            await database_async.get_or_create_user(user_id=12347, first_name='Буфер')
+            buffer = WriteBehindBuffer(flush_interval=60, max_records=1000)
+
+            buffer.update_user_step(12347, 'question_1')
+            buffer.save_answer(12347, 'emotion', 'emotion_annoyed')
+            buffer.update_user_step(12347, 'question_2')
+            buffer.save_answer(12347, 'pain_point', 'pain_copying')
+            buffer.mark_completed(12347, 'postponed')
+            assert buffer.pending == 5
+            print(f"✅ В буфере {buffer.pending} изменений")
+
+            await buffer.flush()
+            assert buffer.pending == 0
+            user_data = await database_async.get_user_data(12347)
+            assert user_data.current_step == 'question_2'
+            assert user_data.pain_point == 'pain_copying'
+            assert user_data.conversion_status == 'postponed'
+            print(f"✅ Пачка записана: шаг {user_data.current_step}, статус {user_data.conversion_status}")
+
+            buffer.save_answer(12347, 'time_spent', 'time_low')
+            await buffer.start()
+            await buffer.stop()
+            user_data = await database_async.get_user_data(12347)
+            assert user_data.time_spent == 'time_low'
+            print("✅ Остаток буфера записан при остановке")
+
+            # Пока пачка пишется, изменения пользователя еще не в БД
+            original_apply_batch = database_async.apply_batch
+            committed = asyncio.Event()
+
+            async def slow_apply_batch(*args):
+                await committed.wait()
+                await original_apply_batch(*args)
+
+            buffer.update_user_step(12347, 'show_insight')
+            database_async.apply_batch = slow_apply_batch
+            try:
+                flushing = asyncio.create_task(buffer.flush())
+                await asyncio.sleep(0.01)
+                assert buffer.pending == 0 and buffer.has_pending(12347)
+                committed.set()
+                await flushing
+            finally:
+                database_async.apply_batch = original_apply_batch
+            assert not buffer.has_pending(12347)
+            print("✅ Пишущаяся пачка считается незаписанной до коммита")
+        finally:
+            await database_async.close_db()
+
+    try:
+        init_db()
+        asyncio.run(scenario())
+        print("\n✅ ВСЕ ТЕСТЫ БУФЕРА ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ТЕСТАХ БУФЕРА: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_crm_outbox():
+    """Тест очереди отправки лидов в CRM"""
+    print("\n=== ТЕСТ ОЧЕРЕДИ CRM ===")
+
+    import asyncio
+    from datetime import datetime
+    import database
+    import database_async
+    from write_buffer import WriteBehindBuffer
+    from crm_outbox import OutboxDispatcher
+    from crm_integration import FunctionSink
+
+    async def scenario():
+        try:
+            buffer = WriteBehindBuffer(flush_interval=60, max_records=1000, sinks=['flaky', 'stable'])
+            for user_id in (12360, 12361):
+                await database_async.get_or_create_user(user_id=user_id, first_name='Лид')
+                buffer.mark_completed(user_id, 'converted', lead_info={'user_id': user_id, 'first_name': 'Лид'})
+            await buffer.flush()
+            stats = await database_async.get_outbox_stats()
+            assert stats['by_sink'] == {'flaky': 2, 'stable': 2}
+            print("✅ Лиды записаны в outbox вместе с конверсией, по строке на систему")
+
+            # CRM дважды отвечает ошибкой, потом принимает; лид 12361 не принимает никогда
+            calls = []
+
+            def flaky_send(lead_info):
+                calls.append(lead_info['user_id'])
+                if lead_info['user_id'] == 12360 and calls.count(12360) >= 3:
+                    return {'success': True}
+                return {'success': False, 'error': 'CRM недоступна'}
+
+            async def stable_send(lead_info):
+                return {'success': True}
+
+            dispatcher = OutboxDispatcher(
+                sinks={'flaky': FunctionSink('flaky', flaky_send), 'stable': FunctionSink('stable', stable_send)},
+                max_attempts=4, backoff_base=0.001, backoff_max=0.001
+            )
+            for _ in range(6):
+                await dispatcher.dispatch_once()
+                await asyncio.sleep(0.01)
+
+            # 12360 дошел до обеих систем; 12361 — только до stable
+            assert database.get_user_data(12360).lead_sent_to_crm
+            assert not database.get_user_data(12361).lead_sent_to_crm
+            assert calls.count(12360) == 3 and calls.count(12361) == 4
+            stats = await database_async.get_outbox_stats()
+            assert stats['pending'] == 0 and stats['dead'] == 1
+            assert dispatcher.stats() == {
+                'flaky': {'sent': 1, 'retried': 5, 'dead': 1},
+                'stable': {'sent': 2, 'retried': 0, 'dead': 0}
+            }
+            print("✅ Повторы с паузой, отметка lead_sent_to_crm, отравленный лид в dead-letter")
+
+            backoff = OutboxDispatcher(backoff_base=5, backoff_max=60)
+            assert 5 <= backoff.backoff(2) <= 10 and backoff.backoff(10) <= 60
+
+            assert await database_async.replay_dead_letters() == 1
+            stats = await database_async.get_outbox_stats()
+            assert stats['pending'] == 1 and stats['dead'] == 0
+            print("✅ Лид из dead-letter возвращен в очередь")
+
+            # Строки пользователя нет в БД — лид все равно не теряется
+            await database_async.apply_batch({}, [], [(12369, {'user_id': 12369}, datetime.now())], sinks=['stable'])
+            stats = await database_async.get_outbox_stats()
+            assert stats['pending'] == 2 and stats['by_sink'] == {'flaky': 1, 'stable': 1}
+            print("✅ Лид пользователя без строки в БД поставлен в outbox")
+        finally:
+            await database_async.close_db()
+
+    try:
+        init_db()
+        asyncio.run(scenario())
+        print("\n✅ ВСЕ ТЕСТЫ ОЧЕРЕДИ CRM ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ОЧЕРЕДИ CRM: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_crm_http_client():
+    """Тест общего HTTP-клиента AmoCRM"""
+    print("\n=== ТЕСТ HTTP-КЛИЕНТА CRM ===")
+
+    import asyncio
+    import json
+    import httpx
+    import crm_integration
+    import database_async
+    from resilience import TokenBucket
+
+    init_db()
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(request)
+        if request.method == 'GET':
+            return httpx.Response(200, json={'_embedded': {'custom_fields': [
+                {'id': 501, 'name': 'Основная проблема'},
+                {'id': 502, 'name': 'Telegram ID'}
+            ]}})
+        leads = json.loads(request.content)
+        contacts = [lead['_embedded']['contacts'][0] for lead in leads]
+        names = [contact.get('first_name') for contact in contacts]
+        if names[0] == 'Сбой':
+            return httpx.Response(500, text='internal error')
+        if 'Плохой' in names:
+            return httpx.Response(400, json={'validation-errors': [
+                {'request_id': lead['request_id'], 'errors': ['bad name']} for lead, name in zip(leads, names) if name == 'Плохой'
+            ]})
+        if request.url.path == '/api/v4/leads/complex':
+            # Сделка создается вместе с контактом, request_id приходит списком
+            return httpx.Response(200, json=[
+                {'id': 42 + i, 'contact_id': 900 + int(lead['request_id']), 'request_id': [lead['request_id']]}
+                for i, lead in enumerate(leads)
+            ])
+        return httpx.Response(200, json={'_embedded': {'leads': [
+            {'id': 42 + i, 'request_id': lead['request_id']} for i, lead in enumerate(leads)
+        ]}})
+
+    async def scenario():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url='https://example.amocrm.ru')
+        try:
+            result = await crm_integration.send_to_amocrm({'user_id': 1, 'first_name': 'Тест', 'pain_point': 'pain_data'}, client)
+            assert result == {'success': True, 'lead_id': 42, 'contact_id': 900}
+            assert requests_seen[0].url.path == '/api/v4/leads/complex'
+            lead = json.loads(requests_seen[0].content)[0]
+            assert lead['custom_fields_values'][0] == {
+                'field_name': 'Основная проблема', 'values': [{'value': 'Сведение данных из таблиц'}]
+            }
+            print("✅ Лид отправлен через переданный клиент")
+
+            # Известный контакт: сделка привязывается к нему по ID
+            requests_seen.clear()
+            result = await crm_integration.send_to_amocrm({'user_id': 1, 'first_name': 'Тест'}, client, contacts={1: 900})
+            assert result == {'success': True, 'lead_id': 42, 'contact_id': 900}
+            assert requests_seen[0].url.path == '/api/v4/leads'
+            assert json.loads(requests_seen[0].content)[0]['_embedded']['contacts'] == [{'id': 900}]
+            print("✅ Повторный лид привязан к существующему контакту")
+
+            result = await crm_integration.send_to_amocrm({'user_id': 2, 'first_name': 'Сбой'}, client)
+            assert not result['success'] and 'internal error' in result['error']
+            print("✅ Ошибка CRM возвращается как success=False")
+
+            # Одновременные лиды уходят одним запросом, результаты — каждому свой
+            user_ids = [910001 + i for i in range(6)]
+            async with database_async.AsyncSessionLocal() as session:
+                await session.execute(delete(CrmContact).where(CrmContact.user_id.in_(user_ids)))
+                await session.commit()
+            requests_seen.clear()
+            batcher = crm_integration.AmoCrmBatcher(window=0.05, max_batch=4, client=client)
+            results = await asyncio.gather(*(
+                batcher.submit({'user_id': user_id, 'first_name': f'Лид {i}'}) for i, user_id in enumerate(user_ids)
+            ))
+            posts = [request for request in requests_seen if request.method == 'POST']
+            assert len(posts) == 2  # 4 по размеру пачки + 2 по окну
+            assert [result['lead_id'] for result in results] == [42, 43, 44, 45, 42, 43]
+            assert batcher.stats()['avg_batch'] == 3
+            print("✅ Лиды собраны в пачки, ответ разложен по лидам")
+
+            # Поля запрошены один раз и передаются по ID, неизвестные — по названию
+            assert len(requests_seen) - len(posts) == 1
+            fields = json.loads(posts[1].content)[0]['custom_fields_values']
+            assert fields[0]['field_id'] == 501 and fields[1]['field_name'] == 'Время на рутину'
+            print("✅ ID полей AmoCRM закэшированы")
+
+            # Контакты сохранены в БД: повторные лиды тех же пользователей их не создают
+            saved = await database_async.get_crm_contacts('amocrm', user_ids)
+            assert saved == {user_id: result['contact_id'] for user_id, result in zip(user_ids, results)}
+            requests_seen.clear()
+            results = await asyncio.gather(*(
+                batcher.submit({'user_id': user_id, 'first_name': 'Снова'}) for user_id in user_ids[:3]
+            ))
+            assert [request.url.path for request in requests_seen] == ['/api/v4/leads']
+            linked = [lead['_embedded']['contacts'][0] for lead in json.loads(requests_seen[0].content)]
+            assert linked == [{'id': saved[user_id]} for user_id in user_ids[:3]]
+            print("✅ Контакты пользователей сохраняются и переиспользуются")
+
+            # Ошибка валидации одного лида не роняет остальную пачку
+            results = await crm_integration.send_leads_to_amocrm(
+                [{'first_name': 'Хороший'}, {'first_name': 'Плохой'}, {'first_name': 'Хороший'}], client
+            )
+            assert [result['success'] for result in results] == [True, False, True]
+            assert 'bad name' in results[1]['error']
+            print("✅ Отклоненный лид получает свою ошибку, остальные отправлены повторно")
+
+            # Ограничитель частоты считает каждый HTTP-запрос пачки, а не пачку целиком
+            class CountingBucket(TokenBucket):
+                acquired = 0
+
+                async def acquire(self):
+                    self.acquired += 1
+                    await super().acquire()
+
+            requests_seen.clear()
+            limiter = CountingBucket(1000)
+            batcher = crm_integration.AmoCrmBatcher(window=0.01, client=client, limiter=limiter)
+            results = await asyncio.gather(
+                batcher.submit({'user_id': user_ids[0], 'first_name': 'Снова'}),
+                batcher.submit({'first_name': 'Хороший'}),
+                batcher.submit({'first_name': 'Плохой'})
+            )
+            assert [result['success'] for result in results] == [True, True, False]
+            assert len(requests_seen) == 4 and limiter.acquired == 4  # поля, /leads, /leads/complex и его повтор
+            print("✅ Каждый запрос к AmoCRM берет свое разрешение у ограничителя")
+        finally:
+            await client.aclose()
+
+        # Общий клиент создается один раз и закрывается при остановке
+        first = await crm_integration.start_http_client()
+        assert crm_integration.get_http_client() is first
+        assert first.timeout.connect == crm_integration.CRM_CONNECT_TIMEOUT
+        await crm_integration.close_http_client()
+        assert first.is_closed
+        print("✅ Общий клиент переиспользуется и закрывается")
+
+    try:
+        asyncio.run(scenario())
+        print("\n✅ ВСЕ ТЕСТЫ HTTP-КЛИЕНТА CRM ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В HTTP-КЛИЕНТЕ CRM: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_lead_sinks():
+    """Тест систем-приемников лидов и Bitrix24 на локальном сервере"""
+    print("\n=== ТЕСТ СИСТЕМ-ПРИЕМНИКОВ ЛИДОВ ===")
+
+    import asyncio
+    import json
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import crm_integration
+    import httpx
+    from crm_integration import (
+        AmoCrmBatcher, AmoCrmSink, Bitrix24Sink, FunctionSink, build_sinks, deliver_to_sink, send_lead_to_crm
+    )
+    from resilience import CircuitBreaker
+
+    received = []
+
+    class FakeBitrix24(BaseHTTPRequestHandler):
+        """Имитация входящего вебхука Bitrix24"""
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            received.append((self.path, body))
+            if body['fields']['NAME'] == 'Медленно':
+                time.sleep(0.3)
+            if body['fields']['NAME'] == 'Сбой':
+                status, answer = 503, {'error': 'QUERY_LIMIT_EXCEEDED', 'error_description': 'Too many requests'}
+            else:
+                status, answer = 200, {'result': 100 + len(received)}
+            data = json.dumps(answer).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBitrix24)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    webhook_url = f"http://127.0.0.1:{server.server_address[1]}/rest/1/secret"
+
+    async def scenario():
+        bitrix = Bitrix24Sink(webhook_url=webhook_url)
+        try:
+            lead = {'user_id': 7, 'first_name': 'Анна', 'username': 'anna', 'pain_point': 'pain_documents'}
+            result = await bitrix.send(lead)
+            assert result == {'success': True, 'lead_id': 101}
+            path, body = received[0]
+            assert path == '/rest/1/secret/crm.lead.add.json'
+            assert body['fields']['TITLE'] == 'Вайб-лид: Анна'
+            assert 'Формирование документов' in body['fields']['COMMENTS']
+            print("✅ Bitrix24: лид создан через crm.lead.add")
+
+            result = await bitrix.send({'first_name': 'Сбой'})
+            assert not result['success'] and result['error'] == 'Too many requests' and result['status'] == 503
+            print("✅ Bitrix24: ошибка вебхука возвращается как success=False")
+
+            # Пробный запрос half_open оборван таймаутом: предохранитель снова размыкается, а не зависает
+            bitrix.breaker = CircuitBreaker('Bitrix24', failure_threshold=1, reset_timeout=0.05)
+            bitrix.timeout = 0.1
+            bitrix.breaker.record_failure()
+            await asyncio.sleep(0.06)
+            result = await deliver_to_sink(bitrix, {'first_name': 'Медленно'})
+            assert not result['success'] and bitrix.breaker.state == 'open'
+            await asyncio.sleep(0.06)
+            assert bitrix.breaker.allow()
+            print("✅ Bitrix24: таймаут пробного запроса учитывается предохранителем")
+        finally:
+            await bitrix.close()
+
+        # Лид, отмененный до отправки пачки, в AmoCRM не уходит
+        amocrm_posts = []
+
+        def amocrm_handler(request):
+            if request.method == 'GET':
+                return httpx.Response(204)
+            amocrm_posts.append(json.loads(request.content))
+            return httpx.Response(200, json={'_embedded': {'leads': [
+                {'id': 1, 'request_id': lead['request_id']} for lead in amocrm_posts[-1]
+            ]}})
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(amocrm_handler), base_url='https://example.amocrm.ru')
+        try:
+            batcher = AmoCrmBatcher(window=0.1, client=client)
+            cancelled = asyncio.create_task(batcher.submit({'first_name': 'Отменен'}))
+            kept = asyncio.create_task(batcher.submit({'first_name': 'Остался'}))
+            await asyncio.sleep(0.01)
+            cancelled.cancel()
+            assert (await kept)['success']
+            assert [[lead['name'] for lead in post] for post in amocrm_posts] == [['Вайб-лид: Остался']]
+            assert AmoCrmSink(batcher).timeout is None
+            print("✅ AmoCRM: отмененный лид убирается из пачки, исход ушедшей пачки решает ответ")
+        finally:
+            await client.aclose()
+
+        # Медленная система не задерживает остальные и обрывается по своему таймауту
+        async def slow(lead_info):
+            await asyncio.sleep(1)
+            return {'success': True}
+
+        async def fast(lead_info):
+            return {'success': True}
+
+        sinks = {'slow': FunctionSink('slow', slow, timeout=0.1), 'fast': FunctionSink('fast', fast)}
+        started = time.perf_counter()
+        results = await send_lead_to_crm({'user_id': 8}, sinks)
+        assert time.perf_counter() - started < 0.5
+        assert results['fast']['success'] and not results['slow']['success']
+        print("✅ Лид уходит во все системы одновременно, у каждой свой таймаут")
+
+        crm_integration.register_sink('custom', lambda: FunctionSink('custom', fast))
+        assert list(build_sinks(['log', 'custom', 'unknown'])) == ['log', 'custom']
+        del crm_integration.SINK_TYPES['custom']
+        print("✅ Системы собираются по списку имен, неизвестные пропускаются")
+
+    try:
+        asyncio.run(scenario())
+        print("\n✅ ВСЕ ТЕСТЫ СИСТЕМ-ПРИЕМНИКОВ ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В СИСТЕМАХ-ПРИЕМНИКАХ: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+    finally:
+        server.shutdown()
+
+
+def test_sheets_appender():
+    """Тест пакетного добавления строк в Google Sheets (локальная имитация API)"""
+    print("\n=== ТЕСТ GOOGLE SHEETS ===")
+
+    import asyncio
+    import json
+    import os
+    import tempfile
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs, unquote
+    from sheets_appender import SheetsAppender
+
+    appends = []
+    fail = {'next': False}
+
+    class FakeSheetsApi(BaseHTTPRequestHandler):
+        """Имитация spreadsheets.values.append"""
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            url = urlparse(self.path)
+            if fail['next']:
+                fail['next'] = False
+                status, answer = 429, {'error': {'code': 429, 'status': 'RESOURCE_EXHAUSTED'}}
+            else:
+                appends.append((unquote(url.path), parse_qs(url.query), self.headers.get('Authorization'), body['values']))
+                status, answer = 200, {'updates': {'updatedRows': len(body['values'])}}
+            data = json.dumps(answer).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSheetsApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pending_file = os.path.join(tempfile.mkdtemp(), 'sheets_pending.jsonl')
+
+    def make_appender(**kwargs):
+        return SheetsAppender(
+            spreadsheet_id='sheet123', value_range='Лиды!A:G', pending_file=pending_file,
+            api_url=f"http://127.0.0.1:{server.server_address[1]}", access_token='token',
+            credentials_file=None, **kwargs
+        )
+
+    async def scenario():
+        appender = make_appender(flush_interval=60, batch_size=100)
+        for i in range(3):
+            appender.add(['2024-01-01', f'Лид {i}', '', i, 'pain_data', 'time_low', 'emotion_tired'])
+        assert appender.pending == 3 and not appends
+
+        # Бот перезапустился, не успев отправить: строки читаются из файла
+        restarted = make_appender(flush_interval=60, batch_size=100)
+        assert restarted.pending == 3
+        print("✅ Неотправленные строки пережили перезапуск")
+
+        fail['next'] = True
+        try:
+            await restarted.flush()
+            raise AssertionError("Ошибка API не проброшена")
+        except AssertionError:
+            raise
+        except Exception:
+            pass
+        assert restarted.pending == 3 and os.path.exists(pending_file)
+
+        assert await restarted.flush() == 3
+        path, query, auth, values = appends[0]
+        assert path == '/v4/spreadsheets/sheet123/values/Лиды!A:G:append'
+        assert query['valueInputOption'] == ['USER_ENTERED'] and auth == 'Bearer token'
+        assert [row[1] for row in values] == ['Лид 0', 'Лид 1', 'Лид 2']
+        assert restarted.pending == 0 and not os.path.exists(pending_file)
+        stats = restarted.stats()
+        assert stats['flushes'] == 1 and stats['failures'] == 1 and stats['last_flush_ms'] > 0
+        print(f"✅ 3 строки добавлены одним запросом за {stats['last_flush_ms']:.0f} мс, ошибка API не теряет строки")
+        await restarted.stop()
+
+        # Фоновая отправка по порогу размера
+        appender = make_appender(flush_interval=60, batch_size=5)
+        await appender.start()
+        for i in range(5):
+            appender.add(['2024-01-01', f'Пачка {i}'])
+        for _ in range(50):
+            if len(appends) == 2:
+                break
+            await asyncio.sleep(0.02)
+        assert len(appends) == 2 and len(appends[1][3]) == 5
+        await appender.stop()
+        print("✅ Пачка отправлена по порогу размера")
+
+    try:
+        asyncio.run(scenario())
+        print("\n✅ ВСЕ ТЕСТЫ GOOGLE SHEETS ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В GOOGLE SHEETS: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+    finally:
+        server.shutdown()
+
+
+def test_admin_notifier():
+    """Тест сводок о лидах для администраторов"""
+    print("\n=== ТЕСТ СВОДОК АДМИНАМ ===")
+
+    import asyncio
+    from admin_notifier import AdminNotifier, format_digest
+    from web_server import WebServer
+
+    class FakeBot:
+        """Записывает сообщения; первая отправка в чат 2 падает"""
+
+        def __init__(self):
+            self.messages = []
+            self.fail_chats = {2}
+
+        async def send_message(self, chat_id, text, parse_mode=None):
+            if chat_id in self.fail_chats:
+                self.fail_chats.discard(chat_id)
+                raise RuntimeError('Flood control exceeded')
+            self.messages.append((chat_id, text, parse_mode))
+
+    async def scenario():
+        bot = FakeBot()
+        notifier = AdminNotifier(chat_ids=[1, 2], interval=60, max_rows=3, bot=bot)
+        for i in range(12):
+            notifier.add({'user_id': i, 'first_name': f'Лид {i}', 'username': f'lead{i}',
+                          'pain_point': 'pain_documents', 'time_spent': 'time_high'})
+        assert not bot.messages  # всплеск копится до конца интервала
+        await notifier.flush()
+
+        # Чат 1 получил одно сообщение на 12 лидов с последними 3 в таблице
+        assert [chat_id for chat_id, _, _ in bot.messages] == [1]
+        _, text, parse_mode = bot.messages[0]
+        assert parse_mode == 'HTML'
+        assert '12 новых лидов за последнюю минуту' in text
+        assert '@lead11' in text and '@lead8' not in text and 'и еще 9 ранее' in text
+        assert 'документы' in text and '&gt;10 ч' in text
+        print("✅ Всплеск лидов собран в одну сводку с таблицей")
+
+        # Чат 2 не получил сводку из-за ошибки — лиды дойдут следующей
+        await notifier.flush()
+        assert [chat_id for chat_id, _, _ in bot.messages] == [1, 2]
+        assert '12 новых лидов' in bot.messages[1][1]
+        assert notifier.stats()['failures'] == 1 and notifier.pending == 0
+        print("✅ Неудачная отправка повторяется в следующей сводке")
+
+        # Лид, не дождавшийся интервала, уходит последней сводкой при остановке
+        await notifier.start(bot)
+        notifier.add({'user_id': 99, 'first_name': 'Анна <b>', 'username': None})
+        await notifier.stop()
+        assert len(bot.messages) == 4
+        assert '1 новый лид' in bot.messages[-1][1] and 'Анна &lt;b&gt;' in bot.messages[-1][1]
+        print("✅ При остановке отправлена последняя сводка")
+
+        assert '21 новый лид' in format_digest(['x'], 21, 300) and 'за последние 5 мин' in format_digest(['x'], 3, 300)
+        print("✅ Склонение и период в заголовке")
+
+        # Несколько воркеров: лиды пересылаются фронту, сводку шлет только он
+        front_bot = FakeBot()
+        front_bot.fail_chats = set()
+        front = AdminNotifier(chat_ids=[1], interval=60, bot=front_bot)
+        server = WebServer(host='127.0.0.1', port=0)
+        front.register(server, 'inner', '/leads')
+        await server.start()
+        url = f"http://127.0.0.1:{server.port}/leads"
+        try:
+            workers = [AdminNotifier(chat_ids=[1], interval=60, forward_url=url, secret='inner') for _ in range(3)]
+            for worker in workers:
+                await worker.start(None)
+            for i, worker in enumerate(workers):
+                worker.add({'user_id': i, 'first_name': f'Воркер {i}', 'username': None})
+            await asyncio.sleep(0.2)
+            for worker in workers:
+                await worker.stop()
+            assert front.pending == 3 and all(worker.pending == 0 for worker in workers)
+            await front.flush()
+            assert len(front_bot.messages) == 1 and '3 новых лида' in front_bot.messages[0][1]
+
+            stranger = AdminNotifier(chat_ids=[1], forward_url=url, secret='wrong')
+            stranger.add({'user_id': 5, 'first_name': 'Чужой'})
+            assert await stranger.flush() == 0 and stranger.pending == 1 and stranger.stats()['failures'] == 1
+            assert front.pending == 0
+            await stranger.stop()
+            print("✅ Воркеры пересылают лиды фронту, админы получают одну сводку")
+
+            # Сводки отключены (нет чатов): воркер не копит лиды, которые никто не перешлет
+            silent = AdminNotifier(chat_ids=[], forward_url=url, secret='inner')
+            await silent.start(None)
+            for i in range(5):
+                silent.add({'user_id': i, 'first_name': 'Лид'})
+            assert silent.pending == 0 and not silent._forward
+            await silent.stop()
+            print("✅ Без чатов для сводок воркер не копит лиды")
+        finally:
+            await server.stop()
+
+    try:
+        asyncio.run(scenario())
+        print("\n✅ ВСЕ ТЕСТЫ СВОДОК АДМИНАМ ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В СВОДКАХ АДМИНАМ: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_crm_webhook():
+    """Тест приема вебхуков AmoCRM о смене статусов (локальный повторитель вебхуков)"""
+    print("\n=== ТЕСТ ВЕБХУКОВ CRM ===")
+
+    import asyncio
+    import httpx
+    import database_async
+    from crm_webhook import CrmWebhookReceiver
+    from web_server import WebServer
+
+    user_ids = [920001, 920002, 920003]
+
+    def status_form(*changes, account=1):
+        """Тело вебхука AmoCRM: (lead_id, old_status_id, status_id)"""
+        form = {'account[id]': str(account), 'account[subdomain]': 'test'}
+        for i, (lead_id, old_status, status) in enumerate(changes):
+            form.update({
+                f'leads[status][{i}][id]': str(lead_id),
+                f'leads[status][{i}][old_status_id]': str(old_status),
+                f'leads[status][{i}][status_id]': str(status),
+                f'leads[status][{i}][pipeline_id]': '1'
+            })
+        return form
+
+    async def scenario():
+        for user_id in user_ids:
+            await database_async.get_or_create_user(user_id, first_name='Вебхук')
+        await database_async.save_crm_contacts('amocrm', [
+            (user_id, 7000 + i, 5001 + i) for i, user_id in enumerate(user_ids)
+        ])
+
+        receiver = CrmWebhookReceiver(secret='s3cret', flush_interval=60)
+        server = WebServer(host='127.0.0.1', port=0, max_connections=10)
+        receiver.register(server, '/amocrm/webhook')
+        await server.start()
+        url = f"http://127.0.0.1:{server.port}/amocrm/webhook"
+        try:
+            async with httpx.AsyncClient() as client:
+                response = await client.post(url, params={'secret': 'wrong'}, data=status_form((5001, 1, 142)))
+                assert response.status_code == 403 and receiver.pending == 0
+                assert (await client.get(url)).status_code == 405
+                assert (await client.post(url + '/other')).status_code == 404
+                print("✅ Запросы без секрета отклоняются")
+
+                # Повторитель: пачка событий, повторная доставка и неизвестная сделка
+                delivery = status_form((5001, 1, 142), (5002, 1, 143), (5003, 1, 555), (9999, 1, 142))
+                for _ in range(2):
+                    response = await client.post(url, params={'secret': 's3cret'}, data=delivery)
+                    assert response.status_code == 200
+                assert receiver.pending == 4  # повтор схлопнулся в буфере
+                print("✅ События приняты в буфер, ответ без записи в БД")
+
+                await database_async.get_user_data(user_ids[0])  # пользователь в кэше
+                assert await receiver.flush() == 3
+                statuses = [(await database_async.get_user_data(user_id)).conversion_status for user_id in user_ids]
+                assert statuses == ['crm_won', 'crm_lost', 'crm_in_progress']
+                assert receiver.stats()['unknown_leads'] == 1
+                stats = await database_async.get_statistics()
+                assert stats['conversion_statuses'].get('crm_won', 0) >= 1
+                print("✅ Статусы применены одной транзакцией, кэш и счетчики обновлены")
+
+                # Та же доставка после применения ничего не меняет
+                await database_async.apply_batch({user_ids[0]: {'conversion_status': 'converted'}}, [])
+                database_async.user_cache.invalidate(user_ids[0])
+                await client.post(url, params={'secret': 'wrong'}, data=delivery)
+                await client.post(url, params={'secret': 's3cret'}, data=delivery)
+                assert await receiver.flush() == 0
+                assert (await database_async.get_user_data(user_ids[0])).conversion_status == 'converted'
+                assert receiver.stats()['duplicates'] == 4
+                print("✅ Повторная доставка события не применяется второй раз")
+            assert server.stats()['requests'] == 7
+
+            # UPDATE упал: отметка события откатывается вместе с ним, повторная доставка применяется
+            import database
+            original_counter_deltas = database._counter_deltas
+
+            def failing_counter_deltas(*args):
+                raise RuntimeError("сбой UPDATE")
+
+            event = [('amocrm:1:5003:1->2:rollback', 5003, 'crm_new_status')]
+            session = database.SessionLocal()
+            database._counter_deltas = failing_counter_deltas
+            try:
+                database._apply_crm_status_events(session, 'amocrm', event)
+                raise AssertionError("Сбой UPDATE не дошел до вызывающего")
+            except RuntimeError:
+                session.rollback()
+            finally:
+                database._counter_deltas = original_counter_deltas
+                session.close()
+            result = await database_async.apply_crm_status_events('amocrm', event)
+            assert result['duplicates'] == 0 and result['applied'] == {user_ids[2]: 'crm_new_status'}
+            print("✅ Событие не отмечается примененным, если UPDATE не прошел")
+        finally:
+            await server.stop()
+            await receiver.stop()
+
+    try:
+        init_db()
+        asyncio.run(scenario())
+        print("\n✅ ВСЕ ТЕСТЫ ВЕБХУКОВ CRM ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ВЕБХУКАХ CRM: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_telegram_webhook():
+    """Тест приема апдейтов Telegram через вебхук"""
+    print("\n=== ТЕСТ ВЕБХУКА TELEGRAM ===")
+
+    import asyncio
+    import httpx
+    from types import SimpleNamespace
+    from telegram import Update
+    from telegram_webhook import TelegramWebhook
+    from web_server import WebServer
+
+    def message_update(update_id, user_id=42):
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id, 'date': 0, 'text': '/start',
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Тест'}
+            }
+        }
+
+    async def scenario():
+        moved = []
+        application = SimpleNamespace(update_queue=asyncio.Queue(), bot=None, running=True,
+                                      persistence=SimpleNamespace(mark_moved=moved.append))
+        webhook = TelegramWebhook(application, secret='tg-secret', queue_limit=2)
+        server = WebServer(host='127.0.0.1', port=0, max_connections=2)
+        webhook.register(server, '/telegram')
+        await server.start()
+        url = f"http://127.0.0.1:{server.port}/telegram"
+        headers = {'X-Telegram-Bot-Api-Secret-Token': 'tg-secret'}
+        try:
+            async with httpx.AsyncClient() as client:
+                response = await client.post(url, json=message_update(1))
+                assert response.status_code == 403
+                response = await client.post(url, json=message_update(1), headers={'X-Telegram-Bot-Api-Secret-Token': 'x'})
+                assert response.status_code == 403 and application.update_queue.empty()
+                print("✅ Апдейты без секретного заголовка отклоняются")
+
+                for update_id in (1, 2):
+                    response = await client.post(url, json=message_update(update_id), headers=headers)
+                    assert response.status_code == 200
+                update = application.update_queue.get_nowait()
+                assert isinstance(update, Update) and update.update_id == 1
+                assert update.effective_user.id == 42 and update.message.text == '/start'
+                print("✅ Апдейт разобран и поставлен в update_queue")
+
+                # Пометка фронта о переезде пользователя передается в persistence
+                assert not moved
+                await client.post(url, json=message_update(5, user_id=77), headers={**headers, 'X-Shard-Reload': '1'})
+                assert moved == [77]
+                application.update_queue.get_nowait()
+
+                application.update_queue.put_nowait(update)
+                response = await client.post(url, json=message_update(3), headers=headers)
+                assert response.status_code == 503 and webhook.stats()['rejected'] == 1
+                print("✅ При переполненной очереди Telegram получает 503 и повторит доставку")
+
+                while not application.update_queue.empty():
+                    application.update_queue.get_nowait()
+                application.running = False
+                response = await client.post(url, json=message_update(4), headers=headers)
+                assert response.status_code == 503 and application.update_queue.empty()
+                application.running = True
+                print("✅ Остановленное приложение не подтверждает апдейты: Telegram повторит доставку")
+
+                response = await client.post(url, content=b'not json', headers=headers)
+                assert response.status_code == 400
+
+            # Сверх max_connections соединения сразу получают 503
+            connections = [await asyncio.open_connection('127.0.0.1', server.port) for _ in range(2)]
+            await asyncio.sleep(0.05)
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            assert (await reader.readline()).startswith(b'HTTP/1.1 503')
+            writer.close()
+            for _, extra_writer in connections:
+                extra_writer.close()
+            assert server.stats()['rejected'] == 1
+            print("✅ Лимит одновременных соединений соблюдается")
+        finally:
+            await server.stop()
+
+    try:
+        asyncio.run(scenario())
+        print("\n✅ ВСЕ ТЕСТЫ ВЕБХУКА TELEGRAM ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ВЕБХУКЕ TELEGRAM: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_worker_sharding():
+    """Тест раздачи апдейтов воркерам по консистентному хешу"""
+    print("\n=== ТЕСТ ШАРДИРОВАНИЯ ПО ВОРКЕРАМ ===")
+
+    import asyncio
+    import httpx
+    from collections import Counter
+    from telegram import Update
+    from types import SimpleNamespace
+    from telegram.ext import CommandHandler, ConversationHandler
+    import database_async
+    from db_persistence import DatabasePersistence
+    from sharding import HashRing, ShardDispatcher, WorkerSupervisor, owned_by, update_shard_key
+    from web_server import WebServer, Response
+
+    def message_update(update_id, user_id):
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id, 'date': 0, 'text': 'привет',
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Тест'}
+            }
+        }
+
+    async def scenario():
+        # Воркеры: серверы, которые запоминают, чьи апдейты к ним пришли
+        received = {}
+        reloads = []  # (user_id, воркер) апдейтов с пометкой о переезде пользователя
+        workers = {}
+
+        def make_handler(name):
+            async def handler(request):
+                if request.headers.get('x-telegram-bot-api-secret-token') != 'inner':
+                    return Response(403)
+                received.setdefault(update_shard_key(request.json()), set()).add(name)
+                if request.headers.get('x-shard-reload'):
+                    reloads.append((update_shard_key(request.json()), name))
+                return Response(200)
+            return handler
+
+        async def start_worker(name, port=0):
+            server = WebServer(host='127.0.0.1', port=port)
+            server.route('POST', '/telegram', make_handler(name))
+            await server.start()
+            workers[name] = server
+            return server
+
+        dispatcher = ShardDispatcher(secret='outer', worker_secret='inner', health_interval=0.05, timeout=2)
+        for name in ('worker-0', 'worker-1', 'worker-2'):
+            server = await start_worker(name)
+            dispatcher.add_worker(name, '127.0.0.1', server.port)
+        front = WebServer(host='127.0.0.1', port=0)
+        dispatcher.register(front, '/telegram')
+        await front.start()
+        await dispatcher.start()
+        url = f"http://127.0.0.1:{front.port}/telegram"
+        headers = {'X-Telegram-Bot-Api-Secret-Token': 'outer'}
+        try:
+            await asyncio.sleep(0.1)
+            assert dispatcher.ring.nodes == ['worker-0', 'worker-1', 'worker-2']
+            async with httpx.AsyncClient() as client:
+                response = await client.post(url, json=message_update(1, 1))
+                assert response.status_code == 403
+
+                for update_id in range(300):
+                    response = await client.post(url, json=message_update(update_id, update_id % 60), headers=headers)
+                    assert response.status_code == 200
+                assert all(len(names) == 1 for names in received.values()) and len(received) == 60
+                assert len(dispatcher.stats()['forwarded']) == 3 and not reloads
+                print("✅ Все апдейты пользователя попадают к одному воркеру")
+
+                env = WorkerSupervisor(dispatcher, admin_notify_url='http://127.0.0.1:8080/leads').worker_env(0)
+                assert env['ADMIN_NOTIFY_FORWARD_URL'] == 'http://127.0.0.1:8080/leads'
+                assert env['TELEGRAM_WEBHOOK_SECRET'] == 'inner' and env['BOT_WORKER_ID'] == '0'
+
+                # Воркер упал: его пользователи переходят к остальным, остальные остаются на месте
+                before = {user_id: next(iter(names)) for user_id, names in received.items()}
+                port = workers['worker-1'].port
+                await workers['worker-1'].stop()
+                received.clear()
+                for user_id in range(60):
+                    response = await client.post(url, json=message_update(1000 + user_id, user_id), headers=headers)
+                    assert response.status_code == 200
+                assert 'worker-1' not in dispatcher.ring and dispatcher.rerouted >= 1
+                for user_id, names in received.items():
+                    assert 'worker-1' not in names
+                    if before[user_id] != 'worker-1':
+                        assert names == {before[user_id]}
+                print("✅ Пользователи упавшего воркера перераспределены, остальные не переехали")
+
+                # Новый воркер перечитывает состояние переехавшего пользователя из БД один раз
+                moved_users = {user_id for user_id, name in before.items() if name == 'worker-1'}
+                assert {user_id for user_id, _ in reloads} == moved_users and len(reloads) == len(moved_users)
+                reloads.clear()
+                for user_id in moved_users:
+                    await client.post(url, json=message_update(1500 + user_id, user_id), headers=headers)
+                assert not reloads
+                print("✅ Первый апдейт переехавшего пользователя помечен для перечитывания состояния")
+
+                # Воркер снова слушает порт: проверка доступности возвращает его в кольцо
+                await start_worker('worker-1', port)
+                await asyncio.sleep(0.2)
+                assert 'worker-1' in dispatcher.ring
+                received.clear()
+                for user_id in range(60):
+                    await client.post(url, json=message_update(2000 + user_id, user_id), headers=headers)
+                assert {user_id: next(iter(names)) for user_id, names in received.items()} == before
+                assert sorted(reloads) == sorted((user_id, 'worker-1') for user_id in moved_users)
+                print("✅ Восстановленный воркер получает своих пользователей обратно и перечитывает их состояние")
+        finally:
+            await dispatcher.stop()
+            await front.stop()
+            for server in workers.values():
+                await server.stop()
+
+    async def persistence_scenario():
+        users = list(range(940000, 940030))
+        name = 'main_conversation'
+        try:
+            writer = DatabasePersistence()
+            for user_id in users:
+                await writer.update_conversation(name, (user_id, user_id), 2)
+                await writer.update_user_data(user_id, {'pain_point': 'pain_data'})
+            await writer.flush()
+
+            # Воркер загружает при запуске только своих пользователей
+            owns = owned_by(0, 3)
+            worker = DatabasePersistence(owns=owns)
+            conversations = await worker.get_conversations(name)
+            user_data = await worker.get_user_data()
+            own = {user_id for user_id in users if owns(user_id)}
+            assert own and len(own) < len(users)
+            assert {key[1] for key in conversations if key[1] in users} == own
+            assert {user_id for user_id in user_data if user_id in users} == own
+            print("✅ Воркер загружает диалоги только своих пользователей")
+
+            # Пользователь пришел с устаревшим состоянием в памяти воркера: перед апдейтом оно берется из БД
+            async def noop(update, context):
+                pass
+
+            handler = ConversationHandler(
+                entry_points=[CommandHandler('start', noop)], states={}, fallbacks=[], name=name, persistent=True
+            )
+            stranger, finished = users[0], users[1]
+            await writer.update_conversation(name, (finished, finished), None)
+            await writer.flush()
+            handler._conversations.update({(stranger, stranger): 5, (finished, finished): 5})
+            application = SimpleNamespace(handlers={0: [handler]})
+
+            def moved_update(user_id):
+                return SimpleNamespace(effective_user=SimpleNamespace(id=user_id),
+                                       effective_chat=SimpleNamespace(id=user_id))
+
+            context = SimpleNamespace(application=application, user_data={'pain_point': 'pain_copying'})
+            await worker.reload_moved(moved_update(stranger), context)
+            assert handler._conversations[(stranger, stranger)] == 5  # без пометки фронта ничего не меняется
+
+            for user_id in (stranger, finished):
+                worker.mark_moved(user_id)
+            await worker.reload_moved(moved_update(stranger), context)
+            assert handler._conversations[(stranger, stranger)] == 2
+            assert context.user_data == {'pain_point': 'pain_data'}
+            await worker.reload_moved(moved_update(finished), SimpleNamespace(application=application, user_data={}))
+            assert (finished, finished) not in handler._conversations
+            assert worker.stats()['reloaded'] == 2
+            print("✅ Состояние переехавшего пользователя перечитывается из БД")
+        finally:
+            await database_async.close_db()
+
+    try:
+        # Кольцо: равномерность и минимальные переезды ключей
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        owners = {key: ring.get(key) for key in range(10000)}
+        shares = Counter(owners.values())
+        assert all(1500 < share < 3500 for share in shares.values()), shares
+        ring.remove('c')
+        moved = [key for key, owner in owners.items() if ring.get(key) != owner]
+        assert moved and all(owners[key] == 'c' for key in moved)
+        ring.add('c')
+        assert all(ring.get(key) == owner for key, owner in owners.items())
+        print("✅ Консистентный хеш: при выбытии узла переезжают только его ключи")
+
+        samples = [
+            message_update(1, 7),
+            {'update_id': 2, 'callback_query': {'id': '1', 'chat_instance': '1', 'data': 'x',
+                                                'from': {'id': 8, 'is_bot': False, 'first_name': 'A'}}},
+            {'update_id': 3, 'inline_query': {'id': '1', 'query': '', 'offset': '',
+                                              'from': {'id': 9, 'is_bot': False, 'first_name': 'B'}}},
+            {'update_id': 4, 'channel_post': {'message_id': 1, 'date': 0, 'text': 'x',
+                                              'chat': {'id': -100, 'type': 'channel'}}}
+        ]
+        for data in samples:
+            update = Update.de_json(data, None)
+            expected = update.effective_user.id if update.effective_user else update.effective_chat.id
+            assert update_shard_key(data) == expected
+        print("✅ Ключ шардирования совпадает с effective_user / effective_chat")
+
+        asyncio.run(scenario())
+        init_db()
+        asyncio.run(persistence_scenario())
+        print("\n✅ ВСЕ ТЕСТЫ ШАРДИРОВАНИЯ ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ШАРДИРОВАНИИ: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_db_persistence():
+    """Тест хранения незавершенных диалогов в БД"""
+    print("\n=== ТЕСТ PERSISTENCE ДИАЛОГОВ ===")
+
+    import asyncio
+    from types import SimpleNamespace
+    import database_async
+    from config import SHOW_OFFER
+    from db_persistence import DatabasePersistence
+    from handlers import time_callback
+    from messages import get_insight_message
+    from user_cache import user_cache
+
+    user_id = 930001
+
+    async def scenario():
+        try:
+            persistence = DatabasePersistence(keep_days=30)
+            # Приложение передает изменения одного прохода пачкой — они пишутся одной транзакцией
+            await asyncio.gather(
+                persistence.update_conversation('main_conversation', (user_id, user_id), 2),
+                persistence.update_conversation('main_conversation', (user_id + 1, user_id + 1), 3),
+                persistence.update_user_data(user_id, {'pain_point': 'pain_data'}),
+                persistence.update_user_data(user_id + 1, {'pain_point': 'pain_deadlines'})
+            )
+            await asyncio.sleep(0)
+            await persistence._write_task
+            assert persistence.stats()['writes'] == 1 and persistence.pending == 0
+            print("✅ Изменения прохода записаны одной пачкой")
+
+            # Завершенный диалог и удаленные user_data пропадают из БД; до flush() ничего не теряется
+            await persistence.update_conversation('main_conversation', (user_id + 1, user_id + 1), None)
+            await persistence.drop_user_data(user_id + 1)
+            await persistence.flush()
+
+            # «Перезапуск»: новый экземпляр восстанавливает состояние из БД
+            restored = DatabasePersistence(keep_days=30)
+            conversations = await restored.get_conversations('main_conversation')
+            user_data = await restored.get_user_data()
+            assert conversations.get((user_id, user_id)) == 2
+            assert (user_id + 1, user_id + 1) not in conversations
+            assert user_data.get(user_id) == {'pain_point': 'pain_data'} and user_id + 1 not in user_data
+            print("✅ Диалоги и user_data восстанавливаются после перезапуска")
+
+            # Без pain_point в user_data инсайт строится по сохраненному ответу, а не по 'pain_messages'
+            await database_async.get_or_create_user(user_id, first_name='Persistence')
+            await database_async.save_answer(user_id, 'pain_point', 'pain_data')
+            user_cache.invalidate(user_id)
+            edited = []
+
+            async def answer(*args, **kwargs):
+                pass
+
+            async def edit_message_text(text, **kwargs):
+                edited.append(text)
+
+            query = SimpleNamespace(
+                answer=answer, edit_message_text=edit_message_text, data='time_high',
+                from_user=SimpleNamespace(id=user_id), message=SimpleNamespace(chat_id=user_id)
+            )
+            context = SimpleNamespace(user_data={}, job_queue=SimpleNamespace(run_once=lambda *args, **kwargs: None))
+            state = await time_callback(SimpleNamespace(callback_query=query), context)
+            assert state == SHOW_OFFER
+            assert edited == [get_insight_message('pain_data', 'time_high')]
+            assert context.user_data['pain_point'] == 'pain_data'
+            print("✅ time_callback берет pain_point из БД, если user_data пуст")
+        finally:
+            await database_async.close_db()
+
+    try:
+        init_db()
+        asyncio.run(scenario())
+        print("\n✅ ВСЕ ТЕСТЫ PERSISTENCE ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В PERSISTENCE: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_resilience():
+    """Тест предохранителя и ограничителя частоты CRM"""
+    print("\n=== ТЕСТ ЗАЩИТЫ CRM ===")
+
+    import asyncio
+    import time
+    import httpx
+    import crm_integration
+    from resilience import CircuitBreaker, CircuitOpen, TokenBucket
+
+    responses = []
+    requests_seen = []
+
+    def handler(request):
+        if request.method == 'GET':
+            return httpx.Response(204)  # дополнительных полей нет
+        requests_seen.append(request)
+        return responses.pop(0)
+
+    async def scenario():
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == 'open' and not breaker.allow()
+        await asyncio.sleep(0.06)
+        assert breaker.state == 'half_open'
+        assert breaker.allow() and not breaker.allow()  # только один пробный запрос
+        breaker.record_success()
+        assert breaker.state == 'closed' and breaker.stats()['rejected'] == 2
+        print("✅ Предохранитель: closed -> open -> half_open -> closed")
+
+        bucket = TokenBucket(rate=20, capacity=2)
+        started = time.perf_counter()
+        for _ in range(4):
+            await bucket.acquire()
+        assert 0.08 <= time.perf_counter() - started < 0.3
+        bucket.throttle(retry_after=0.1)
+        assert bucket.rate == 10
+        started = time.perf_counter()
+        await bucket.acquire()
+        assert time.perf_counter() - started >= 0.1
+        bucket.recover()
+        assert bucket.rate > 10
+        print("✅ Ограничитель частоты снижает темп по 429 и Retry-After")
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url='https://example.amocrm.ru')
+        try:
+            batcher = crm_integration.AmoCrmBatcher(
+                window=0.01, client=client,
+                breaker=CircuitBreaker('AmoCRM', failure_threshold=2, reset_timeout=60),
+                limiter=TokenBucket(rate=100)
+            )
+            responses.append(httpx.Response(429, headers={'Retry-After': '0.05'}, text='too many'))
+            result = await batcher.submit({'user_id': 1})
+            assert result['status'] == 429 and batcher.limiter.throttled == 1
+            assert batcher.breaker.state == 'closed'
+
+            responses.extend([httpx.Response(503, text='down'), httpx.Response(503, text='down')])
+            for _ in range(2):
+                assert not (await batcher.submit({'user_id': 1}))['success']
+            sent = len(requests_seen)
+            try:
+                await batcher.submit({'user_id': 1})
+                raise AssertionError("Разомкнутый предохранитель пропустил запрос")
+            except CircuitOpen:
+                pass
+            assert len(requests_seen) == sent
+            stats = batcher.stats()
+            assert stats['breaker']['state'] == 'open' and stats['breaker']['rejected'] == 1
+            print("✅ После серии 5xx лиды не отправляются, пока предохранитель разомкнут")
+        finally:
+            await client.aclose()
+
+    try:
+        asyncio.run(scenario())
+        print("\n✅ ВСЕ ТЕСТЫ ЗАЩИТЫ CRM ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ЗАЩИТЕ CRM: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_funnel_counters():
+    """Тест счетчиков воронки: инкрементальные значения совпадают с пересчетом"""
+    print("\n=== ТЕСТ СЧЕТЧИКОВ ВОРОНКИ ===")
+
+    import asyncio
+    import database_async
+    from write_buffer import WriteBehindBuffer
+
+    async def buffered_changes():
+        try:
+            buffer = WriteBehindBuffer(flush_interval=60, max_records=1000)
+            buffer.update_user_step(12349, 'question_2')
+            buffer.save_answer(12349, 'emotion', 'emotion_confused')
+            buffer.save_answer(12349, 'emotion', 'emotion_tired')
+            buffer.mark_completed(12349, 'converted')
+            await buffer.flush()
+        finally:
+            await database_async.close_db()
+
+    try:
+        init_db()
+        get_or_create_user(user_id=12348, first_name='Счетчик')
+        get_or_create_user(user_id=12349, first_name='Счетчик2')
+        update_user_step(12348, 'question_1')
+        save_answer(12348, 'pain_point', 'pain_data')
+        save_answer(12348, 'pain_point', 'pain_documents')
+        mark_completed(12348, 'pdf_downloaded')
+        mark_completed(12348, 'converted')
+        asyncio.run(buffered_changes())
+
+        incremental = get_statistics()
+        rebuild_funnel_counters()
+        rebuilt = get_statistics()
+        assert incremental == rebuilt, f"{incremental} != {rebuilt}"
+        print(f"✅ Счетчики совпадают с пересчетом: {rebuilt['total_users']} пользователей")
+
+        print("\n✅ ВСЕ ТЕСТЫ СЧЕТЧИКОВ ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ТЕСТАХ СЧЕТЧИКОВ: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_migrations():
+    """Тест миграций схемы и индексов"""
+    print("\n=== ТЕСТ МИГРАЦИЙ ===")
+
+    try:
+        from sqlalchemy import inspect
+
+        init_db()
+        # Повторный запуск не должен ничего ломать
+        run_migrations()
+
+        session = SessionLocal()
+        try:
+            version = session.scalar(select(func.max(SchemaVersion.version)))
+        finally:
+            session.close()
+        assert version == MIGRATIONS[-1][0]
+        print(f"✅ Версия схемы: {version}")
+
+        inspector = inspect(engine)
+        user_indexes = {index['name'] for index in inspector.get_indexes('users')}
+        answer_indexes = {index['name'] for index in inspector.get_indexes('user_answers')}
+        assert {'ix_users_pain_point', 'ix_users_is_completed', 'ix_users_conversion_status'} <= user_indexes
+        assert 'ix_user_answers_user_id' in answer_indexes
+        print("✅ Индексы созданы")
+
+        print("\n✅ ВСЕ ТЕСТЫ МИГРАЦИЙ ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В МИГРАЦИЯХ: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_value_codes():
+    """Тест хранения ответов целыми кодами"""
+    print("\n=== ТЕСТ КОДОВ ОТВЕТОВ ===")
+
+    try:
+        init_db()
+        get_or_create_user(user_id=12350, first_name='Коды')
+        save_answer(12350, 'pain_point', 'pain_messages')
+        # Новый ключ получает код без правок кода
+        save_answer(12350, 'emotion', 'emotion_brand_new')
+
+        user_data = get_user_data(12350)
+        assert user_data.pain_point == 'pain_messages'
+        assert user_data.emotion == 'emotion_brand_new'
+        print(f"✅ Ответы читаются ключами: {user_data.pain_point}, {user_data.emotion}")
+
+        with engine.connect() as connection:
+            raw = connection.execute(
+                text("SELECT pain_point, emotion FROM users WHERE user_id = 12350")
+            ).one()
+            answer = connection.execute(
+                text("SELECT question, answer FROM user_answers WHERE user_id = 12350 ORDER BY id DESC")
+            ).first()
+        assert all(isinstance(value, int) for value in (*raw, *answer))
+        print(f"✅ В БД хранятся коды: {tuple(raw)}, {tuple(answer)}")
+
+        print("\n✅ ВСЕ ТЕСТЫ КОДОВ ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ТЕСТАХ КОДОВ: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_start_storm():
+    """Тест параллельных /start одного пользователя: без IntegrityError и дублей"""
+    print("\n=== ТЕСТ ПАРАЛЛЕЛЬНЫХ /start ===")
+
+    import asyncio
+    import threading
+    import database_async
+
+    async def async_storm(user_id):
+        try:
+            await asyncio.gather(*(
+                database_async.get_or_create_user(user_id, username=f'name{i}', first_name='Шторм')
+                for i in range(50)
+            ))
+        finally:
+            await database_async.close_db()
+
+    try:
+        init_db()
+        total_before = get_statistics()['total_users']
+
+        errors = []
+
+        def tap():
+            try:
+                get_or_create_user(user_id=12351, username='storm', first_name='Шторм')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=tap) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+        print("✅ 16 потоков: без ошибок")
+
+        asyncio.run(async_storm(12352))
+        print("✅ 50 корутин: без ошибок")
+
+        assert get_statistics()['total_users'] == total_before + 2
+        user = get_or_create_user(user_id=12351, username='renamed', first_name='Новое имя')
+        assert user.username == 'renamed' and user.first_name == 'Новое имя'
+        print("✅ Пользователи созданы по одному разу, имя обновляется")
+
+        print("\n✅ ВСЕ ТЕСТЫ ПАРАЛЛЕЛЬНЫХ /start ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ТЕСТАХ ПАРАЛЛЕЛЬНЫХ /start: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_user_cache():
+    """Тест кэша пользователей: LRU, TTL и сквозная запись"""
+    print("\n=== ТЕСТ КЭША ПОЛЬЗОВАТЕЛЕЙ ===")
+
+    import time
+    from user_cache import UserCache
+
+    try:
+        cache = UserCache(max_size=100, ttl=60)
+        for user_id in range(1000):
+            cache.put(user_id, UserSnapshot(user_id=user_id))
+        assert len(cache) == 100 and cache.evictions == 900
+        assert cache.get(0) is None and cache.get(999).user_id == 999
+        print(f"✅ Размер ограничен: {len(cache)}, вытеснено {cache.evictions}")
+
+        cache.update(999, current_step='question_2')
+        assert cache.get(999).current_step == 'question_2'
+        cache.invalidate(999)
+        assert 999 not in cache
+        print("✅ Сквозная запись и инвалидация")
+
+        short_cache = UserCache(max_size=10, ttl=0.01)
+        short_cache.put(1, UserSnapshot(user_id=1))
+        time.sleep(0.02)
+        assert short_cache.get(1) is None and short_cache.expirations == 1
+        print("✅ Истечение TTL")
+
+        print("\n✅ ВСЕ ТЕСТЫ КЭША ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ТЕСТАХ КЭША: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_update_processor():
+    """Тест параллельной обработки апдейтов с порядком внутри пользователя"""
+    print("\n=== ТЕСТ ОБРАБОТКИ АПДЕЙТОВ ===")
+
+    import asyncio
+    import time
+    from types import SimpleNamespace
+    from update_processor import PerUserUpdateProcessor
+
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=16)
+        log = []
+
+        async def handle(user_id, tap):
+            log.append((user_id, tap, 'start'))
+            await asyncio.sleep(0.05)
+            log.append((user_id, tap, 'end'))
+
+        def update_for(user_id):
+            return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+        started = time.perf_counter()
+        tasks = [
+            asyncio.create_task(processor.process_update(update_for(user_id), handle(user_id, tap)))
+            for tap in range(3)
+            for user_id in (1, 2, 3, 4)
+        ]
+        await asyncio.sleep(0.01)
+        assert processor.queue_depth(1) == 3
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+        for user_id in (1, 2, 3, 4):
+            events = [(tap, kind) for uid, tap, kind in log if uid == user_id]
+            assert events == [(0, 'start'), (0, 'end'), (1, 'start'), (1, 'end'), (2, 'start'), (2, 'end')]
+        # 4 пользователя по 3 апдейта по 50 мс: параллельно ~150 мс, а не 600
+        assert elapsed < 0.4, elapsed
+        assert processor.stats()['active_users'] == 0 and processor.processed == 12
+        return elapsed
+
+    async def no_head_of_line_blocking():
+        # Очередь одного пользователя не занимает общий лимит: при лимите 4 и 6 ждущих
+        # апдейтах пользователя 1 мгновенный апдейт пользователя 2 не ждет
+        processor = PerUserUpdateProcessor(max_concurrent_updates=4)
+
+        def update_for(user_id):
+            return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+        slow = [
+            asyncio.create_task(processor.process_update(update_for(1), asyncio.sleep(0.05)))
+            for _ in range(6)
+        ]
+        await asyncio.sleep(0.01)
+        started = time.perf_counter()
+        await processor.process_update(update_for(2), asyncio.sleep(0))
+        waited = time.perf_counter() - started
+        assert waited < 0.05, waited
+        assert processor.queue_depth(1) == 6
+        await asyncio.gather(*slow)
+        return waited
+
+    try:
+        elapsed = asyncio.run(scenario())
+        print(f"✅ Порядок внутри пользователя сохранен, 12 апдейтов за {elapsed * 1000:.0f} мс")
+        waited = asyncio.run(no_head_of_line_blocking())
+        print(f"✅ Очередь одного пользователя не задерживает других ({waited * 1000:.1f} мс)")
+
+        print("\n✅ ВСЕ ТЕСТЫ ОБРАБОТКИ АПДЕЙТОВ ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ОБРАБОТКЕ АПДЕЙТОВ: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_blocking_pool():
+    """Тест пула блокирующих вызовов"""
+    print("\n=== ТЕСТ ПУЛА БЛОКИРУЮЩИХ ВЫЗОВОВ ===")
+
+    import asyncio
+    import time
+    from blocking_pool import BlockingPool, PoolSaturated
+
+    def slow(value, delay=0.1):
+        time.sleep(delay)
+        return value * 2
+
+    async def scenario():
+        pool = BlockingPool(max_workers=2, max_queue=1, acquire_timeout=0.05)
+        try:
+            # Цикл событий не блокируется, пока вызовы идут в потоках
+            started = time.perf_counter()
+            results = await asyncio.gather(pool.run(slow, 1), pool.run(slow, 2), asyncio.sleep(0.01))
+            assert results[:2] == [2, 4]
+            assert time.perf_counter() - started < 0.18
+            print("✅ Блокирующие вызовы выполняются параллельно в потоках")
+
+            # 2 потока + 1 место в очереди: четвертый вызов отклоняется
+            calls = [asyncio.create_task(pool.run(slow, i)) for i in range(3)]
+            await asyncio.sleep(0.01)
+            try:
+                await pool.run(slow, 3)
+                raise AssertionError("Переполненный пул принял вызов")
+            except PoolSaturated:
+                pass
+            await asyncio.gather(*calls)
+            print("✅ Переполненный пул отклоняет вызов после ожидания места")
+
+            try:
+                await pool.run(lambda: 1 / 0)
+                raise AssertionError("Исключение из потока потерялось")
+            except ZeroDivisionError:
+                pass
+
+            stats = pool.stats()
+            assert stats['completed'] == 5 and stats['failed'] == 1 and stats['rejected'] == 1
+            assert stats['in_flight'] == 0 and stats['max_wait_ms'] >= 50
+            print(f"✅ Метрики: ожидание макс. {stats['max_wait_ms']:.0f} мс, выполнение в среднем {stats['avg_run_ms']:.0f} мс")
+        finally:
+            pool.shutdown()
+
+    try:
+        asyncio.run(scenario())
+
+        print("\n✅ ВСЕ ТЕСТЫ ПУЛА ПРОЙДЕНЫ\n")
+        return True
+
+    except Exception as e:
+        print(f"\n❌ ОШИБКА В ПУЛЕ: {e}\n")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
 def test_messages():
     """Тест генерации сообщений"""
     print("\n=== ТЕСТ ГЕНЕРАЦИИ СООБЩЕНИЙ ===")
@@ -95,7 +1742,7 @@ def generate_test_data():
             last_name = random.choice(last_names)
 
             # Создаем пользователя
-            user = get_or_create_user(
+            get_or_create_user(
                 user_id=user_id,
                 username=f'user{i}',
                 first_name=first_name,
@@ -113,7 +1760,7 @@ def generate_test_data():
 
             print(f"✅ Создан тестовый пользователь {i}: {first_name} {last_name}")
 
-        print(f"\n✅ СОЗДАНО 20 ТЕСТОВЫХ ПОЛЬЗОВАТЕЛЕЙ\n")
+        print("\n✅ СОЗДАНО 20 ТЕСТОВЫХ ПОЛЬЗОВАТЕЛЕЙ\n")
 
         # Показываем статистику
         stats = get_statistics()
@@ -121,7 +1768,7 @@ def generate_test_data():
         print(f"   Всего пользователей: {stats['total_users']}")
         print(f"   Завершили тест: {stats['completed']}")
         print(f"   Конверсия: {stats['completion_rate']:.1f}%")
-        print(f"\n   Популярные проблемы:")
+        print("\n   Популярные проблемы:")
         for pain, count in stats['pain_points'].items():
             if count > 0:
                 print(f"   - {pain}: {count}")
@@ -195,6 +1842,32 @@ def test_config():
         else:
             print("⚠️  DATABASE_URL не установлен")
 
+        # Без ADMIN_IDS статистика открыта, а команды, меняющие данные, закрыты
+        import asyncio
+        from types import SimpleNamespace
+        import handlers
+
+        replies = []
+
+        async def reply_text(text):
+            replies.append(text)
+
+        def admin_update(user_id):
+            return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=SimpleNamespace(reply_text=reply_text))
+
+        admin_ids = handlers.ADMIN_IDS
+        try:
+            handlers.ADMIN_IDS = set()
+            assert handlers.is_admin(admin_update(5)) and not handlers.is_admin(admin_update(5), mutating=True)
+            for command in (handlers.rebuild_stats_command, handlers.replay_leads_command):
+                asyncio.run(command(admin_update(5), SimpleNamespace(args=[])))
+            assert not replies
+            handlers.ADMIN_IDS = {7}
+            assert handlers.is_admin(admin_update(7), mutating=True) and not handlers.is_admin(admin_update(5))
+        finally:
+            handlers.ADMIN_IDS = admin_ids
+        print("✅ Без ADMIN_IDS команды, меняющие данные, недоступны")
+
         print("\n✅ КОНФИГУРАЦИЯ ПРОВЕРЕНА\n")
         return True
 
@@ -270,6 +1943,25 @@ def main_menu():
             results = [
                 test_config(),
                 test_database(),
+                test_async_database(),
+                test_write_buffer(),
+                test_crm_outbox(),
+                test_crm_http_client(),
+                test_lead_sinks(),
+                test_sheets_appender(),
+                test_admin_notifier(),
+                test_crm_webhook(),
+                test_telegram_webhook(),
+                test_worker_sharding(),
+                test_db_persistence(),
+                test_resilience(),
+                test_funnel_counters(),
+                test_migrations(),
+                test_value_codes(),
+                test_start_storm(),
+                test_user_cache(),
+                test_update_processor(),
+                test_blocking_pool(),
                 test_messages(),
                 test_keyboards()
             ]
@@ -298,7 +1990,7 @@ def main_menu():
             print(f"   Всего пользователей: {stats['total_users']}")
             print(f"   Завершили тест: {stats['completed']}")
             print(f"   Конверсия: {stats['completion_rate']:.1f}%")
-            print(f"\n   Популярные проблемы:")
+            print("\n   Популярные проблемы:")
             for pain, count in stats['pain_points'].items():
                 print(f"   - {pain}: {count}")
         elif choice == '0':
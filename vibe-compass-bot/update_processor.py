@@ -0,0 +1,94 @@
+"""
+Параллельная обработка апдейтов с порядком внутри пользователя
+
+Разные пользователи обрабатываются одновременно (до MAX_CONCURRENT_UPDATES
+апдейтов), а апдейты одного пользователя — строго по очереди: два быстрых
+нажатия не проскочат состояния ConversationHandler наперегонки.
+
+Место в лимите MAX_CONCURRENT_UPDATES апдейт занимает только после того,
+как дошла его очередь у пользователя: апдейты, ждущие своей очереди, не
+отнимают места у других пользователей. Поэтому семафор PTB (его берет
+process_update еще до do_process_update) отключен, а лимит — свой.
+"""
+import asyncio
+import logging
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+# Лимит для семафора PTB: фактически без ограничения, ограничивает self._slots
+UNLIMITED = 2 ** 31 - 1
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обработчик апдейтов с блокировкой по Telegram user_id"""
+
+    def __init__(self, max_concurrent_updates):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates должен быть положительным")
+        super().__init__(UNLIMITED)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # user_id -> [asyncio.Lock, сколько апдейтов ждут или выполняются]
+        self._user_locks = {}
+        self.in_flight = 0
+        self.processed = 0
+        self.max_depth_seen = 0
+
+    @staticmethod
+    def _user_key(update):
+        user = getattr(update, 'effective_user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(update, 'effective_chat', None)
+        return chat.id if chat is not None else None
+
+    async def do_process_update(self, update, coroutine):
+        self.in_flight += 1
+        try:
+            key = self._user_key(update)
+            if key is None:
+                async with self._slots:
+                    await coroutine
+                return
+
+            entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            self.max_depth_seen = max(self.max_depth_seen, entry[1])
+            try:
+                async with entry[0], self._slots:
+                    await coroutine
+            finally:
+                entry[1] -= 1
+                # Блокировку держим только пока у пользователя есть апдейты
+                if entry[1] == 0:
+                    del self._user_locks[key]
+        finally:
+            self.in_flight -= 1
+            self.processed += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def queue_depth(self, user_id):
+        """Сколько апдейтов пользователя сейчас в работе или в очереди"""
+        entry = self._user_locks.get(user_id)
+        return entry[1] if entry else 0
+
+    def stats(self):
+        """Счетчики для мониторинга"""
+        depths = [entry[1] for entry in self._user_locks.values()]
+        return {
+            'max_concurrent_updates': self.limit,
+            'in_flight': self.in_flight,
+            'active_users': len(depths),
+            'queued_updates': sum(depth - 1 for depth in depths),
+            'max_queue_depth': max(depths, default=0),
+            'max_queue_depth_seen': self.max_depth_seen,
+            'processed': self.processed
+        }
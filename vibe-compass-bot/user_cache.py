@@ -0,0 +1,97 @@
+"""
+Кэш пользователей в памяти процесса
+
+LRU-кэш с ограничением размера и TTL перед чтениями из users. Записи
+обновляются сквозным образом (write-through): функции database_async.py
+и буфер отложенной записи кладут в кэш новые значения сразу, поэтому
+повторные чтения в рамках одного прохождения теста не ходят в БД.
+"""
+import time
+import dataclasses
+from collections import OrderedDict
+
+from config import USER_CACHE_MAX_SIZE, USER_CACHE_TTL
+
+
+class UserCache:
+    """Ограниченный LRU-кэш снимков пользователей (UserSnapshot) по Telegram user_id"""
+
+    def __init__(self, max_size=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (expires_at, user)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        entry = self._entries.get(user_id)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, user_id):
+        """Пользователь из кэша или None"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, user = entry
+        if expires_at <= time.monotonic():
+            del self._entries[user_id]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return user
+
+    def put(self, user_id, user):
+        """Положить пользователя в кэш, вытеснив самые старые записи"""
+        if self.max_size <= 0:
+            return
+        self._entries[user_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, user_id, **values):
+        """Сквозная запись: применить изменения к закэшированному пользователю"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        expires_at, user = entry
+        # Снимки неизменяемые: заменяем запись новой копией с тем же TTL.
+        # Колонки, которых нет в снимке, кэшу не нужны
+        values = {field: value for field, value in values.items() if field in user.__dataclass_fields__}
+        self._entries[user_id] = (expires_at, dataclasses.replace(user, **values))
+
+    def invalidate(self, user_id):
+        """Удалить пользователя из кэша"""
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Очистить кэш"""
+        self._entries.clear()
+
+    def stats(self):
+        """Счетчики кэша для мониторинга"""
+        requests = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': (self.hits / requests * 100) if requests else 0
+        }
+
+
+user_cache = UserCache()
@@ -0,0 +1,198 @@
+"""
+Встроенный асинхронный HTTP-сервер для входящих вебхуков
+
+Минимальный HTTP/1.1 поверх asyncio (без внешних зависимостей): работает
+в том же цикле событий, что и бот, держит keep-alive соединения и
+ограничивает их число WEB_SERVER_MAX_CONNECTIONS. Обработчики
+регистрируются по методу и пути через route() и должны отвечать быстро:
+тяжелая работа уходит в очереди и буферы.
+"""
+import asyncio
+import json
+import logging
+from urllib.parse import urlsplit, parse_qsl
+
+from config import WEB_SERVER_HOST, WEB_SERVER_PORT, WEB_SERVER_MAX_CONNECTIONS
+
+logger = logging.getLogger(__name__)
+
+REASONS = {
+    200: 'OK',
+    204: 'No Content',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable'
+}
+
+
+class Request:
+    """Входящий запрос: метод, путь, параметры строки запроса, заголовки, тело"""
+
+    def __init__(self, method, target, headers, body):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = dict(parse_qsl(url.query))
+        self.headers = headers  # имена в нижнем регистре
+        self.body = body
+
+    def form(self):
+        """Тело application/x-www-form-urlencoded как словарь"""
+        return dict(parse_qsl(self.body.decode('utf-8'), keep_blank_values=True))
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class Response:
+    """Ответ обработчика"""
+
+    def __init__(self, status=200, body=b'', content_type='text/plain; charset=utf-8'):
+        self.status = status
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.content_type = content_type
+
+
+class WebServer:
+    """HTTP-сервер с таблицей маршрутов и ограничением соединений"""
+
+    def __init__(self, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT, max_connections=WEB_SERVER_MAX_CONNECTIONS,
+                 max_body=1024 * 1024, keepalive_timeout=75):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.max_body = max_body
+        self.keepalive_timeout = keepalive_timeout
+
+        self._routes = {}  # (метод, путь) -> обработчик
+        self._server = None
+        self._connections = {}  # задача соединения -> writer
+
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+
+    def route(self, method, path, handler):
+        """Зарегистрировать async handler(request) -> Response"""
+        self._routes[(method.upper(), path)] = handler
+
+    @property
+    def routes(self):
+        return list(self._routes)
+
+    async def _dispatch(self, request):
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self._routes):
+                return Response(405)
+            return Response(404)
+        try:
+            return await handler(request)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"❌ Ошибка обработки {request.method} {request.path}: {e}")
+            return Response(500)
+
+    @staticmethod
+    async def _write(writer, response, keep_alive):
+        head = (
+            f"HTTP/1.1 {response.status} {REASONS.get(response.status, 'Unknown')}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + response.body)
+        await writer.drain()
+
+    async def _read_request(self, reader):
+        """Прочитать один запрос; None — клиент закрыл соединение или молчит"""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return None
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, _ = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            return Response(411)
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body:
+            return Response(413)
+        body = await reader.readexactly(length) if length else b''
+        return Request(method.upper(), target, headers, body)
+
+    async def _handle_connection(self, reader, writer):
+        if len(self._connections) >= self.max_connections:
+            # Лимит соединений: отвечаем сразу, отправитель повторит позже
+            self.rejected += 1
+            try:
+                await self._write(writer, Response(503), keep_alive=False)
+            finally:
+                writer.close()
+            return
+
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    await self._write(writer, Response(400), keep_alive=False)
+                    break
+                if request is None:
+                    break
+                if isinstance(request, Response):
+                    await self._write(writer, request, keep_alive=False)
+                    break
+
+                self.requests += 1
+                response = await self._dispatch(request)
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                await self._write(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    async def start(self):
+        """Начать принимать соединения"""
+        if self._server is None:
+            self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+            logger.info(f"🌐 HTTP-сервер слушает {self.host}:{self.port}: "
+                        f"{', '.join(f'{method} {path}' for method, path in self._routes)}")
+
+    async def stop(self):
+        """Перестать принимать соединения и закрыть открытые"""
+        if self._server is not None:
+            self._server.close()
+            # Закрываем сокеты: ждущие чтения соединения завершаются сами
+            for writer in list(self._connections.values()):
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    def stats(self):
+        return {
+            'connections': len(self._connections),
+            'max_connections': self.max_connections,
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'errors': self.errors
+        }
@@ -0,0 +1,134 @@
+"""
+Отложенная (write-behind) запись изменений пользователей
+
+Обработчики кнопок не ждут БД: save_answer, update_user_step и
+mark_completed только кладут изменение в буфер. Фоновая задача сбрасывает
+накопленное одной транзакцией раз в WRITE_BUFFER_FLUSH_MS миллисекунд
+или сразу после WRITE_BUFFER_MAX_RECORDS изменений. Повторные изменения
+одного пользователя схлопываются в одно обновление строки. Кэш
+пользователей обновляется сразу при постановке изменения в буфер.
+Лид для CRM пишется в crm_outbox той же транзакцией, что и конверсия.
+"""
+import asyncio
+import logging
+from datetime import datetime
+
+from config import WRITE_BUFFER_FLUSH_MS, WRITE_BUFFER_MAX_RECORDS, CRM_SINKS
+import database_async
+from user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Буфер изменений пользователей со сбросом пачками"""
+
+    def __init__(self, flush_interval=WRITE_BUFFER_FLUSH_MS / 1000, max_records=WRITE_BUFFER_MAX_RECORDS, sinks=CRM_SINKS):
+        self.flush_interval = flush_interval
+        self.max_records = max_records
+        self.sinks = sinks  # системы, в которые ставится каждый лид
+
+        self._user_updates = {}  # user_id -> {колонка: значение}
+        self._answers = []  # (user_id, question, answer, timestamp)
+        self._leads = []  # (user_id, lead_info, timestamp)
+        self._pending = 0
+        self._in_flight = set()  # пользователи пачки, которая пишется прямо сейчас
+        self._flush_lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    # ==================== ИЗМЕНЕНИЯ ====================
+
+    def _update_user(self, user_id, **values):
+        # Кэш видит изменение сразу, еще до записи в БД
+        user_cache.update(user_id, **values)
+        self._user_updates.setdefault(user_id, {}).update(values)
+        self._pending += 1
+        if self._pending >= self.max_records:
+            self._full.set()
+
+    def save_answer(self, user_id, field, value):
+        """Сохранить ответ пользователя"""
+        self._answers.append((user_id, field, value, datetime.now()))
+        self._update_user(user_id, **{field: value})
+
+    def update_user_step(self, user_id, step):
+        """Обновить текущий шаг пользователя"""
+        self._update_user(user_id, current_step=step)
+
+    def mark_completed(self, user_id, conversion_status='pending', lead_info=None):
+        """Отметить прохождение теста как завершенное (и поставить лид в очередь CRM)"""
+        if lead_info is not None:
+            self._leads.append((user_id, lead_info, datetime.now()))
+        self._update_user(user_id, is_completed=True, conversion_status=conversion_status)
+
+    def has_pending(self, user_id):
+        """Есть ли у пользователя изменения, еще не записанные в БД (в том числе в пишущейся пачке)"""
+        return user_id in self._user_updates or user_id in self._in_flight
+
+    @property
+    def pending(self):
+        """Количество изменений, ожидающих записи"""
+        return self._pending
+
+    # ==================== СБРОС В БД ====================
+
+    async def flush(self):
+        """Записать все накопленные изменения одной транзакцией"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            user_updates, answers, leads, pending = self._user_updates, self._answers, self._leads, self._pending
+            self._user_updates, self._answers, self._leads, self._pending = {}, [], [], 0
+            # До коммита строка в БД старая: читатель с промахом кэша должен дождаться flush()
+            self._in_flight = set(user_updates)
+
+            try:
+                await database_async.apply_batch(user_updates, answers, leads, self.sinks)
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи пачки изменений ({pending} шт.): {e}")
+                self._requeue(user_updates, answers, leads, pending)
+                raise
+            finally:
+                self._in_flight = set()
+
+    def _requeue(self, user_updates, answers, leads, pending):
+        """Вернуть несохраненную пачку в буфер, не затирая более свежие изменения"""
+        for user_id, values in user_updates.items():
+            self._user_updates[user_id] = {**values, **self._user_updates.get(user_id, {})}
+        self._answers[:0] = answers
+        self._leads[:0] = leads
+        self._pending += pending
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # Пачка уже возвращена в буфер, повторим на следующем цикле
+                await asyncio.sleep(self.flush_interval)
+
+    async def start(self):
+        """Запустить фоновый сброс"""
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновый сброс и записать остаток"""
+        if self._task is not None:
+            self._stopping = True
+            self._full.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+write_buffer = WriteBehindBuffer()